@@ -8,34 +8,345 @@
     :copyright: (c) 2012-2013 by Heungsub Lee
     :license: BSD, see LICENSE for more details.
 """
+from __future__ import with_statement
+from array import array
+from bisect import bisect_left, bisect_right
 from calendar import timegm
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+from functools import partial
+try:
+    from math import gcd as _gcd
+except ImportError:
+    from fractions import gcd as _gcd
+import heapq
+import itertools
+from operator import itemgetter
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+import struct
 import sys
-from time import gmtime, struct_time
+import threading
+from time import gmtime, struct_time, time as _now
+from timeit import default_timer
+try:
+    from time import monotonic as _monotonic
+except ImportError:
+    _monotonic = _now
+from weakref import WeakValueDictionary
 
 
 __version__ = '0.1.9'
-__all__ = ['Energy']
+__all__ = ['Energy', 'EnergyArray', 'EnergyPolicy', 'EnergyStatus',
+           'EnergyJournal', 'EnergyStore', 'MemoryEnergyStore',
+           'SQLiteEnergyStore', 'RecoveryScheduler', 'Clock', 'SystemClock',
+           'FixedClock', 'OffsetClock', 'MonotonicClock', 'frozen_now',
+           'pack_many', 'Metrics', 'add_sink', 'remove_sink',
+           'register_sqlite_functions', 'unpack_many', 'SharedEnergyTable',
+           'UseResult', 'EnergyPool', 'EnergyWallet', 'RecoverySchedule',
+           'use_many', 'EnergyView', 'MemoizedEnergy', 'RecoveryIndex',
+           'EnergySnapshot', 'config_many', 'AsyncEnergyStore']
 
 
-def timestamp(time=None, default_time_getter=gmtime):
+def timestamp(time=None, default_time_getter=gmtime, resolution=1):
     """Makes some timestamp.
 
     1. If you pass a :class:`datetime` object, it makes a timestamp from the
        argument.
     2. If you pass a timestamp(`int` or `float`), it just returns that.
-    3. If you call it without parameter, it makes a timestamp from the result
-       of `default_time_getter`.
+    3. If you call it without parameter in a :func:`frozen_now` block, it
+       returns the frozen timestamp.
+    4. Otherwise, it makes a timestamp from the result of
+       `default_time_getter`.
+
+    :param resolution: the number of ticks in a second. The timestamp is
+                       counted in the ticks. A given timestamp number is
+                       regarded as ticks already. See :data:`RESOLUTIONS`.
+
+    .. versionchanged:: 0.2
+       The `resolution` parameter was added.
     """
+    if type(time) is int:
+        return time
     if time is None:
+        frozen = getattr(_frozen, 'stack', None)
+        if frozen:
+            seconds, precise = frozen[-1]
+            if resolution == 1:
+                return seconds
+            return int(precise * resolution)
+        if default_time_getter is gmtime:
+            # skip the round-trip of struct_time
+            return int(_now() * resolution)
         time = default_time_getter()
+        if isinstance(time, (int, float)):
+            return int(time * resolution)
     if isinstance(time, datetime):
-        return timegm(time.timetuple())
+        seconds = timegm(time.timetuple())
+        if resolution == 1:
+            return seconds
+        return (seconds * resolution +
+                time.microsecond * resolution // 1000000)
     elif isinstance(time, struct_time):
-        return timegm(time)
+        return timegm(time) * resolution
     return int(time)
 
 
+class Clock(object):
+    """A source of the present timestamp. Calling a clock returns an integer
+    timestamp. A clock can be attached to an :class:`Energy` or to a
+    :func:`frozen_now` block.
+
+    .. versionadded:: 0.2
+    """
+
+    def now(self):
+        """Returns the present timestamp."""
+        raise NotImplementedError
+
+    def __call__(self):
+        return self.now()
+
+
+class SystemClock(Clock):
+    """The system clock in UTC.
+
+    .. versionadded:: 0.2
+    """
+
+    def now(self):
+        return int(_now())
+
+
+class FixedClock(Clock):
+    """A clock which always returns a fixed timestamp until it is changed. It
+    is useful for testing.
+
+    :param time: the fixed time
+
+    .. versionadded:: 0.2
+    """
+
+    def __init__(self, time):
+        self.time = timestamp(time)
+
+    def now(self):
+        return self.time
+
+    def set(self, time):
+        """Changes the fixed time."""
+        self.time = timestamp(time)
+
+    def advance(self, seconds):
+        """Moves the fixed time forward."""
+        self.time += int(seconds)
+
+
+class OffsetClock(Clock):
+    """A clock which is skewed from another clock by the offset. It can mimic
+    the clock of another server.
+
+    :param offset: the offset in seconds
+    :param clock: the base clock. Defaults to the system clock.
+
+    .. versionadded:: 0.2
+    """
+
+    def __init__(self, offset, clock=None):
+        self.offset = int(offset)
+        self.clock = SystemClock() if clock is None else clock
+
+    def now(self):
+        return self.clock() + self.offset
+
+
+class MonotonicClock(Clock):
+    """A clock which is based on the monotonic clock of the system. It is
+    anchored to the system clock once, so it never goes backward even if the
+    system clock is adjusted.
+
+    .. versionadded:: 0.2
+    """
+
+    def __init__(self):
+        self.anchor = _now() - _monotonic()
+
+    def now(self):
+        return int(self.anchor + _monotonic())
+
+
+_frozen = threading.local()
+
+
+@contextmanager
+def frozen_now(time=None, clock=None):
+    """Freezes the present time in the block. Every :func:`timestamp` call
+    without argument in the block, including the calls in :class:`Energy`,
+    reuses one cached timestamp. It is thread-local.
+
+    ::
+
+       with frozen_now() as now:
+           energy.use()
+           print energy.current(), energy.recover_in()
+
+    :param time: the time to freeze. Defaults to the present time of the
+                 clock.
+    :param clock: the clock to get the present time. Defaults to the system
+                  clock.
+
+    .. versionadded:: 0.2
+    """
+    if isinstance(time, (int, float)):
+        time, precise = int(time), time
+    elif time is not None:
+        precise = timestamp(time, resolution=1000000) / 1e6
+        time = timestamp(time)
+    elif clock is not None:
+        time = precise = clock()
+    else:
+        # keep the sub-second part for the energies of a fine resolution
+        ticks = timestamp(resolution=1000000)
+        time, precise = ticks // 1000000, ticks / 1e6
+    try:
+        stack = _frozen.stack
+    except AttributeError:
+        stack = _frozen.stack = []
+    stack.append((time, precise))
+    try:
+        yield time
+    finally:
+        stack.pop()
+
+
+#: The functions which receive the events of energy. See :func:`add_sink`.
+_sinks = []
+
+
+def add_sink(sink):
+    """Installs a function which receives the events of energy for
+    instrumentation. It is called with the name and the value of an event:
+
+    ``use``, ``set``, ``config`` (1)
+       :meth:`Energy.use`, :meth:`Energy.set` or :meth:`Energy.config`
+       succeeded. Setting an energy under the current energy also reports
+       ``use``.
+    ``use_rejected`` (1)
+       :meth:`Energy.use` failed because of not enough energy.
+    ``use_debt`` (1)
+       :meth:`Energy.use` made a debt by ``force``.
+    ``future_tolerated`` (seconds)
+       :meth:`Energy.passed` ignored a time before :attr:`Energy.used_at`
+       within :attr:`Energy.future_tolerance`. The value is the clock skew.
+    ``future_rejected`` (seconds)
+       :meth:`Energy.passed` raised :exc:`ValueError` for a time before
+       :attr:`Energy.used_at`. The value is the clock skew.
+    ``store_get_many``, ``store_put_many``, ``store_use`` (seconds)
+       An :class:`EnergyStore` operation finished. The value is the latency.
+
+    While no sink is installed, the events cost almost nothing.
+
+    .. versionadded:: 0.2
+    """
+    _sinks.append(sink)
+
+
+def remove_sink(sink):
+    """Uninstalls a sink which has been installed by :func:`add_sink`.
+
+    .. versionadded:: 0.2
+    """
+    _sinks.remove(sink)
+
+
+def _emit(event, value=1):
+    for sink in _sinks:
+        sink(event, value)
+
+
+@contextmanager
+def _timing(event):
+    """Emits the seconds which the block takes."""
+    if not _sinks:
+        yield
+        return
+    started_at = default_timer()
+    try:
+        yield
+    finally:
+        _emit(event, default_timer() - started_at)
+
+
+class Metrics(object):
+    """An in-process aggregator of the events of energy. Install it by
+    :func:`add_sink` and export it in the Prometheus text format:
+
+    ::
+
+       metrics = Metrics()
+       add_sink(metrics)
+       ...
+       print metrics.prometheus()
+
+    :param buckets: the upper bounds of the histogram buckets.
+
+    .. versionadded:: 0.2
+    """
+
+    #: The events which are aggregated as histograms in seconds.
+    histogram_events = frozenset(['future_tolerated', 'future_rejected',
+                                  'store_get_many', 'store_put_many',
+                                  'store_use'])
+
+    def __init__(self, buckets=(.001, .005, .01, .05, .1, .5, 1, 5, 10, 60)):
+        self.buckets = sorted(buckets)
+        self.counts = {}
+        self.sums = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, event, value=1):
+        with self._lock:
+            self.counts[event] = self.counts.get(event, 0) + 1
+            if event not in self.histogram_events:
+                return
+            self.sums[event] = self.sums.get(event, 0) + value
+            try:
+                histogram = self.histograms[event]
+            except KeyError:
+                histogram = self.histograms[event] = [0] * len(self.buckets)
+            for x, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[x] += 1
+
+    def prometheus(self, prefix='energy'):
+        """Exports the aggregated metrics in the Prometheus text format."""
+        lines = []
+        with self._lock:
+            for event, count in sorted(self.counts.items()):
+                name = '%s_%s' % (prefix, event)
+                if event not in self.histogram_events:
+                    lines.append('# TYPE %s_total counter' % name)
+                    lines.append('%s_total %d' % (name, count))
+                    continue
+                name += '_seconds'
+                lines.append('# TYPE %s histogram' % name)
+                histogram = self.histograms[event]
+                for bound, bucket in zip(self.buckets, histogram):
+                    lines.append('%s_bucket{le="%s"} %d' %
+                                 (name, bound, bucket))
+                lines.append('%s_bucket{le="+Inf"} %d' % (name, count))
+                lines.append('%s_sum %r' % (name, float(self.sums[event])))
+                lines.append('%s_count %d' % (name, count))
+        return '\n'.join(lines) + '\n'
+
+
 if sys.version_info < (2, 6):
     # A fallback of property under Python 2.6. The code is from
     # http://blog.devork.be/2008/04/xsetter-syntax-in-python-25.html
@@ -60,10 +371,162 @@ if not hasattr(timedelta, 'total_seconds'):
         return (ms + (s + d * 24 * 3600) * (10 ** 6)) / (10 ** 6)
 
 
-class Energy(object):
-    """A consumable and recoverable stuff in social gamers. Think over
-    reasonable energy parameters for your own game. Energy may decide return
-    period of your players.
+#: The supported resolutions of time: seconds, milliseconds and microseconds.
+#: See :class:`EnergyPolicy`.
+RESOLUTIONS = (1, 1000, 1000000)
+
+
+class RecoverySchedule(object):
+    """Time-varying recovery such as "double regen weekend". The recovery
+    interval and quantity change at the given times. Before the first change
+    and after a change to ``None``, the recovery follows the
+    :class:`EnergyPolicy`. Attach a schedule to a policy, then every energy of
+    the policy follows the schedule without any rewrite.
+
+    >>> weekend = RecoverySchedule([(1000, 150, 1), (2000, None, None)])
+    >>> energy = Energy(10, 300, schedule=weekend)
+    >>> energy.use(10, time=700)
+    >>> energy.current(2000)
+    7
+
+    The recovery is evaluated in closed form by binary search over the changes
+    and the prefix sums of the recovery progress. The times are integers in
+    the resolution of the energies.
+
+    :param changes: the triples of the start time, the recovery interval and
+                    the recovery quantity. ``None`` in the interval or the
+                    quantity means the one of the policy.
+
+    :raise TypeError: some change isn't valid type
+
+    .. versionadded:: 0.2
+    """
+
+    def __init__(self, changes=()):
+        # the later one of the changes at the same time wins
+        changes = sorted(((timestamp(start), interval, quantity)
+                          for start, interval, quantity in changes),
+                         key=itemgetter(0))
+        for start, interval, quantity in changes:
+            if not isinstance(interval, (int, type(None))):
+                raise TypeError('recovery_interval should be int')
+            if not isinstance(quantity, (int, type(None))):
+                raise TypeError('recovery_quantity should be int')
+        self.changes = tuple(changes)
+        self._starts = [start for start, interval, quantity in changes]
+        self._tables = {}
+
+    def _table(self, recovery_interval, recovery_quantity):
+        """Makes the tables for the base recovery of a policy. The progress of
+        recovery is counted in integers. A recovery happens whenever the
+        progress gets a multiple of the scale.
+        """
+        try:
+            return self._tables[recovery_interval, recovery_quantity]
+        except KeyError:
+            pass
+        intervals = [recovery_interval]
+        quantities = [recovery_quantity]
+        for start, interval, quantity in self.changes:
+            intervals.append(recovery_interval if interval is None
+                             else interval)
+            quantities.append(recovery_quantity if quantity is None
+                              else quantity)
+        scale = 1
+        for interval in intervals:
+            scale = scale * interval // _gcd(scale, interval)
+        weights = [scale // interval for interval in intervals]
+        # the progress at each start time
+        starts = self._starts
+        prefix = [0]
+        for x in range(1, len(starts)):
+            prefix.append(prefix[-1] + (starts[x] - starts[x - 1]) *
+                          weights[x])
+        table = (scale, weights, quantities, prefix)
+        return self._tables.setdefault((recovery_interval, recovery_quantity),
+                                       table)
+
+    def _progress(self, table, time):
+        scale, weights, quantities, prefix = table
+        starts = self._starts
+        x = bisect_right(starts, time)
+        if x == 0:
+            return (time - (starts[0] if starts else 0)) * weights[0]
+        return prefix[x - 1] + (time - starts[x - 1]) * weights[x]
+
+    def recovered(self, used_at, time, recovery_interval,
+                  recovery_quantity=1):
+        """Calculates the quantity recovered from `used_at` until `time`. It
+        is not limited by the used energy.
+        """
+        if time <= used_at:
+            return 0
+        table = self._table(recovery_interval, recovery_quantity)
+        scale, weights, quantities, prefix = table
+        starts = self._starts
+        origin = self._progress(table, used_at)
+        first = bisect_right(starts, used_at)
+        last = bisect_right(starts, time)
+        recovered = 0
+        # the number of the recoveries since used_at until the time
+        count = 0
+        for x in range(first, last + 1):
+            until = time if x == last else starts[x] - 1
+            until_count = (self._progress(table, until) - origin) // scale
+            recovered += quantities[x] * (until_count - count)
+            count = until_count
+        return recovered
+
+    def recovered_at(self, used_at, quantity, recovery_interval,
+                     recovery_quantity=1):
+        """Calculates the time when the quantity has been recovered since
+        `used_at`.
+        """
+        if quantity <= 0:
+            return used_at
+        table = self._table(recovery_interval, recovery_quantity)
+        scale, weights, quantities, prefix = table
+        starts = self._starts
+        origin = self._progress(table, used_at)
+        x = bisect_right(starts, used_at)
+        count = 0
+        while x < len(starts):
+            until_count = (self._progress(table, starts[x] - 1) -
+                           origin) // scale
+            recovered = quantities[x] * (until_count - count)
+            if recovered >= quantity:
+                break
+            quantity -= recovered
+            count = until_count
+            x += 1
+        # the recovery which fills the quantity is in this period
+        count += -(-quantity // quantities[x])
+        if x == 0:
+            anchor, anchor_progress = (starts[0] if starts else 0), 0
+        else:
+            anchor, anchor_progress = starts[x - 1], prefix[x - 1]
+        needed = origin + count * scale - anchor_progress
+        if x and needed < 0:
+            # the recovery happened at the change but it is counted in the
+            # period after the change
+            needed = 0
+        return anchor + -(-needed // weights[x])
+
+    def __reduce__(self):
+        return (type(self), (self.changes,))
+
+    def __repr__(self):
+        return '<%s %r>' % (type(self).__name__, list(self.changes))
+
+
+class EnergyPolicy(object):
+    """An immutable set of the energy parameters. Most games have only a few
+    kinds of energy, so an energy policy is shared by many :class:`Energy`
+    objects. Energy policies are interned: making a policy with the same
+    parameters returns the same object.
+
+    >>> EnergyPolicy(10, 300) is EnergyPolicy(10, 300)
+    True
 
     :param max: maximum energy
     :param recovery_interval: an interval in seconds to recover energy
@@ -72,55 +535,382 @@ class Energy(object):
                               ``1``.
     :param future_tolerance: near seconds to ignore exception when used at the
                              future
-    :param used: set this when retrieve an energy, otherwise don't touch
-    :param used_at: set this when retrieve an energy, otherwise don't touch
-    :type used_at: timestamp number or ``datetime``
+    :param resolution: the number of ticks in a second. Defaults to ``1``.
+                       See :data:`RESOLUTIONS`.
+    :param schedule: the :class:`RecoverySchedule` which changes the recovery
+                     over time.
 
     :raise TypeError: some argument isn't valid type
+    :raise ValueError: unsupported resolution
+
+    With a resolution other than ``1``, every time of the energy is counted in
+    integer ticks instead of seconds. `recovery_interval` and
+    `future_tolerance` should be ticks, and the time arguments and the results
+    of the energy methods are ticks too. The recovery is calculated by exact
+    integer arithmetic.
+
+    >>> policy = EnergyPolicy(3, 250, resolution=1000)
+    >>> Energy.from_policy(policy, used=3, used_at=0).current(600)
+    2
+
+    .. versionadded:: 0.2
     """
 
-    #: Quantity of used energy.
-    used = 0
+    __slots__ = ('max', 'recovery_interval', 'recovery_quantity',
+                 'future_tolerance', 'resolution', 'schedule', '__weakref__')
 
-    #: A time when using the energy first.
-    used_at = None
+    _interned = WeakValueDictionary()
 
-    def __init__(self, max, recovery_interval, recovery_quantity=1,
-                 future_tolerance=None, used=used, used_at=used_at):
+    #: The recently made policies by the raw arguments. It skips the
+    #: validation and the weak reference for the repeated arguments.
+    _recent = {}
+    _recent_limit = 1024
+
+    def __new__(cls, max, recovery_interval, recovery_quantity=1,
+                future_tolerance=None, resolution=1, schedule=None):
+        # 10 and 10.0 are equivalent as a key but the type should be kept.
+        raw_key = (cls, max, recovery_interval, recovery_quantity,
+                   future_tolerance, resolution, schedule, type(max),
+                   type(recovery_interval), type(recovery_quantity),
+                   type(future_tolerance), type(resolution))
+        try:
+            return cls._recent[raw_key]
+        except KeyError:
+            pass
+        except TypeError:
+            # unhashable arguments are rejected by the validation
+            raw_key = None
+        policy = cls._make(max, recovery_interval, recovery_quantity,
+                           future_tolerance, resolution, schedule)
+        if raw_key is not None:
+            recent = cls._recent
+            if len(recent) >= cls._recent_limit:
+                recent.clear()
+            recent[raw_key] = policy
+        return policy
+
+    @classmethod
+    def _make(cls, max, recovery_interval, recovery_quantity,
+              future_tolerance, resolution, schedule):
+        """Validates the arguments and interns the policy."""
         if not isinstance(max, int):
             raise TypeError('max should be int')
         if not isinstance(recovery_quantity, int):
             raise TypeError('recovery_quantity should be int')
+        if not isinstance(resolution, int):
+            raise TypeError('resolution should be int')
+        if resolution not in RESOLUTIONS:
+            raise ValueError('Unsupported resolution: %d' % resolution)
         if isinstance(recovery_interval, timedelta):
             try:
                 recovery_interval = recovery_interval.total_seconds()
             except AttributeError:
                 recovery_interval = total_seconds(recovery_interval)
-        if not isinstance(recovery_interval, (int, float)):
+            if resolution != 1:
+                recovery_interval = int(round(recovery_interval * resolution))
+        if resolution != 1:
+            if not isinstance(recovery_interval, int):
+                raise TypeError('recovery_interval should be int in ticks')
+        elif not isinstance(recovery_interval, (int, float)):
             raise TypeError('recovery_interval should be number')
-        self._max = max
-        #: The interval in seconds to recover energy.
-        self.recovery_interval = recovery_interval
-        #: The quantity of once energy recovery.
-        self.recovery_quantity = recovery_quantity
-        #: The near seconds to ignore exception when used at the future.
-        #:
-        #: .. versionadded:: 0.1.3
-        self.future_tolerance = future_tolerance
+        if schedule is not None and not isinstance(recovery_interval, int):
+            raise TypeError('recovery_interval should be int with schedule')
+        key = (cls, max, recovery_interval, type(recovery_interval),
+               recovery_quantity, future_tolerance, type(future_tolerance),
+               resolution, schedule)
+        try:
+            return cls._interned[key]
+        except KeyError:
+            pass
+        policy = object.__new__(cls)
+        set_ = super(EnergyPolicy, policy).__setattr__
+        set_('max', max)
+        set_('recovery_interval', recovery_interval)
+        set_('recovery_quantity', recovery_quantity)
+        set_('future_tolerance', future_tolerance)
+        set_('resolution', resolution)
+        set_('schedule', schedule)
+        return cls._interned.setdefault(key, policy)
+
+    def replace(self, **params):
+        """Makes an energy policy which has the replaced parameters."""
+        for param in self.__slots__[:-1]:
+            params.setdefault(param, getattr(self, param))
+        return type(self)(**params)
+
+    def __setattr__(self, attr, value):
+        raise AttributeError('%s is immutable' % type(self).__name__)
+
+    __delattr__ = __setattr__
+
+    def __reduce__(self):
+        return (type(self), (self.max, self.recovery_interval,
+                             self.recovery_quantity, self.future_tolerance,
+                             self.resolution, self.schedule))
+
+    def __repr__(self):
+        rv = '<%s max=%d recovery_interval=%r recovery_quantity=%d' % \
+             (type(self).__name__, self.max, self.recovery_interval,
+              self.recovery_quantity)
+        if self.resolution != 1:
+            rv += ' resolution=%d' % self.resolution
+        return rv + '>'
+
+
+class EnergyStatus(object):
+    """An immutable snapshot of the derived values of an energy at a time.
+    :meth:`Energy.status` makes it in one pass.
+
+    It can be compared with a number like :class:`Energy`.
+
+    .. versionadded:: 0.2
+    """
+
+    __slots__ = ('time', 'current', 'debt', 'max', 'recover_in',
+                 'recover_fully_in', 'resolution')
+
+    def __init__(self, time, current, debt, max, recover_in,
+                 recover_fully_in, resolution=1):
+        set_ = super(EnergyStatus, self).__setattr__
+        #: The time of the snapshot.
+        set_('time', time)
+        #: The same as :meth:`Energy.current`.
+        set_('current', current)
+        #: The same as :meth:`Energy.debt`.
+        set_('debt', debt)
+        #: The same as :attr:`Energy.max`.
+        set_('max', max)
+        #: The same as :meth:`Energy.recover_in`.
+        set_('recover_in', recover_in)
+        #: The same as :meth:`Energy.recover_fully_in`.
+        set_('recover_fully_in', recover_fully_in)
+        #: The same as :attr:`Energy.resolution`.
+        set_('resolution', resolution)
+
+    def __setattr__(self, attr, value):
+        raise AttributeError('%s is immutable' % type(self).__name__)
+
+    __delattr__ = __setattr__
+
+    def __int__(self):
+        return self.current
+
+    def __eq__(self, other):
+        if isinstance(other, EnergyStatus):
+            return all(getattr(self, attr) == getattr(other, attr)
+                       for attr in self.__slots__)
+        elif isinstance(other, (int, float)):
+            return self.current == other
+        return False
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __lt__(self, other):
+        return self.current < other
+
+    def __le__(self, other):
+        return self.current <= other
+
+    def __gt__(self, other):
+        return self.current > other
+
+    def __ge__(self, other):
+        return self.current >= other
+
+    __hash__ = None
+
+    def __repr__(self):
+        rv = '<%s %d/%d' % (type(self).__name__, self.current, self.max)
+        if self.current < self.max:
+            recover_in = self.recover_in // self.resolution
+            rv += ' recover in %02d:%02d' % (recover_in / 60, recover_in % 60)
+        return rv + '>'
+
+
+class UseResult(tuple):
+    """The result of :meth:`Energy.try_use`. It is a tuple of `success`,
+    `current` and `recover_in` and it is true only when the energy has been
+    used.
+
+    .. versionadded:: 0.2
+    """
+
+    __slots__ = ()
+
+    def __new__(cls, success, current, recover_in):
+        return tuple.__new__(cls, (success, current, recover_in))
+
+    #: Whether the energy has been used.
+    success = property(itemgetter(0))
+
+    #: The current energy after the try. See :meth:`Energy.current`.
+    current = property(itemgetter(1))
+
+    #: Seconds to the next energy recovery. See :meth:`Energy.recover_in`.
+    recover_in = property(itemgetter(2))
+
+    def __nonzero__(self):
+        return self[0]
+
+    __bool__ = __nonzero__
+
+    def __repr__(self):
+        return '%s(success=%r, current=%r, recover_in=%r)' % \
+               ((type(self).__name__,) + self)
+
+
+class Energy(object):
+    """A consumable and recoverable stuff in social gamers. Think over
+    reasonable energy parameters for your own game. Energy may decide return
+    period of your players.
+
+    An energy object holds only the state of a player. The parameters are held
+    by an interned :class:`EnergyPolicy`, so a lot of energies with the same
+    parameters take only a little memory.
+
+    :param max: maximum energy
+    :param recovery_interval: an interval in seconds to recover energy
+    :type recovery_interval: number or ``timedelta``
+    :param recovery_quantity: a quantity of once energy recovery. Defaults to
+                              ``1``.
+    :param future_tolerance: near seconds to ignore exception when used at the
+                             future
+    :param used: set this when retrieve an energy, otherwise don't touch
+    :param used_at: set this when retrieve an energy, otherwise don't touch
+    :type used_at: timestamp number or ``datetime``
+    :param clock: the :class:`Clock` for the present time. Defaults to
+                  :func:`timestamp`.
+    :param resolution: the number of ticks in a second. Defaults to ``1``. See
+                       :class:`EnergyPolicy`.
+    :param schedule: the :class:`RecoverySchedule` which changes the recovery
+                     over time.
+
+    :raise TypeError: some argument isn't valid type
+
+    .. attribute:: policy
+
+       The :class:`EnergyPolicy` which holds the parameters.
+
+       .. versionadded:: 0.2
+
+    .. attribute:: used
+
+       Quantity of used energy.
+
+    .. attribute:: used_at
+
+       A time when using the energy first.
+
+    .. attribute:: clock
+
+       The :class:`Clock` for the present time. If it is ``None``,
+       :func:`timestamp` is used.
+
+       .. versionadded:: 0.2
+    """
+
+    __slots__ = ('policy', 'used', 'used_at', 'clock')
+
+    def __init__(self, max, recovery_interval, recovery_quantity=1,
+                 future_tolerance=None, used=0, used_at=None, clock=None,
+                 resolution=1, schedule=None):
+        self.policy = EnergyPolicy(max, recovery_interval, recovery_quantity,
+                                   future_tolerance, resolution, schedule)
+        self._init_state(used, used_at, clock)
+
+    @classmethod
+    def from_policy(cls, policy, used=0, used_at=None, clock=None):
+        """Makes an energy which follows the given :class:`EnergyPolicy`.
+
+        :param policy: the energy policy
+        :param used: set this when retrieve an energy, otherwise don't touch
+        :param used_at: set this when retrieve an energy, otherwise don't touch
+        :param clock: the :class:`Clock` for the present time
+
+        .. versionadded:: 0.2
+        """
+        energy = cls.__new__(cls)
+        energy.policy = policy
+        energy._init_state(used, used_at, clock)
+        return energy
+
+    @classmethod
+    def _restore(cls, policy, used, used_at):
+        """Makes an energy from the saved state as it is."""
+        energy = cls.__new__(cls)
+        energy.policy = policy
+        energy.used = used
+        energy.used_at = used_at
+        energy.clock = None
+        return energy
+
+    def _init_state(self, used, used_at, clock):
         self.used = used
         if 0 < used and used_at is not None:
-            self.used_at = timestamp(used_at)
+            self.used_at = timestamp(used_at,
+                                     resolution=self.policy.resolution)
+        else:
+            self.used_at = None
+        self.clock = clock
+
+    def _timestamp(self, time=None):
+        """Makes a timestamp in the resolution by the clock of the energy."""
+        if type(time) is int:
+            return time
+        resolution = self.policy.resolution
+        if time is None and self.clock is not None:
+            return self.clock() * resolution
+        return timestamp(time, resolution=resolution)
 
     @property
     def max(self):
         """The maximum energy."""
-        return self._max
+        return self.policy.max
 
     @max.setter
     def max(self, max):
         """Configurates the maximum energy."""
         self.config(max=max)
 
+    @property
+    def recovery_interval(self):
+        """The interval in seconds to recover energy."""
+        return self.policy.recovery_interval
+
+    @recovery_interval.setter
+    def recovery_interval(self, recovery_interval):
+        self.policy = self.policy.replace(recovery_interval=recovery_interval)
+
+    @property
+    def recovery_quantity(self):
+        """The quantity of once energy recovery."""
+        return self.policy.recovery_quantity
+
+    @recovery_quantity.setter
+    def recovery_quantity(self, recovery_quantity):
+        self.policy = self.policy.replace(recovery_quantity=recovery_quantity)
+
+    @property
+    def future_tolerance(self):
+        """The near seconds to ignore exception when used at the future.
+
+        .. versionadded:: 0.1.3
+        """
+        return self.policy.future_tolerance
+
+    @future_tolerance.setter
+    def future_tolerance(self, future_tolerance):
+        self.policy = self.policy.replace(future_tolerance=future_tolerance)
+
+    @property
+    def resolution(self):
+        """The number of ticks in a second. See :class:`EnergyPolicy`.
+
+        .. versionadded:: 0.2
+        """
+        return self.policy.resolution
+
     def _current(self, time=None):
         """Calculates the current internal energy.
 
@@ -132,9 +922,10 @@ class Energy(object):
         :param time: the time when checking the energy. Defaults to the present
                      time in UTC.
         """
-        if not self.used:
-            return self.max
-        current = self.max - self.used + self.recovered(time)
+        used = self.used
+        if not used:
+            return self.policy.max
+        current = self.policy.max - used + self.recovered(time)
         return current
 
     def current(self, time=None):
@@ -181,15 +972,99 @@ class Energy(object):
         :param force: force to use energy even if there is not enough energy.
         :raise ValueError: not enough energy
         """
-        time = timestamp(time)
-        current = self._current(time)
-        if current < quantity and not force:
+        time = self._timestamp(time)
+        if not self._use(quantity, time, force, self._current(time)):
             raise ValueError('Not enough energy')
-        if current - quantity < self.max <= current or force:
-            self.used = quantity - current + self.max
+
+    def _use(self, quantity, time, force, current):
+        """Consumes the energy of which the current internal energy has been
+        calculated already. It returns ``False`` instead of raising an
+        exception when there is not enough energy.
+        """
+        if current < quantity and not force:
+            if _sinks:
+                _emit('use_rejected')
+            return False
+        max_ = self.policy.max
+        if current - quantity < max_ <= current or force:
+            self.used = quantity - current + max_
             self.used_at = time
         else:
-            self.used = self.max - current + self.recovered(time) + quantity
+            # the current energy is max - used + recovered, so the used
+            # energy just adds up without evaluating the recovery again
+            self.used += quantity
+        if _sinks:
+            _emit('use')
+            if current < quantity:
+                _emit('use_debt')
+        return True
+
+    def try_use(self, quantity=1, time=None, force=False):
+        """Consumes the energy like :meth:`use` but it doesn't raise an
+        exception when there is not enough energy.
+
+        >>> energy = Energy(10, 300)
+        >>> energy.try_use(3, time=0)
+        UseResult(success=True, current=7, recover_in=300)
+        >>> success, current, recover_in = energy.try_use(8, time=0)
+        >>> success
+        False
+
+        :param quantity: quantity of energy to be used. Defaults to ``1``.
+        :param time: the time when using the energy. Defaults to the present
+                     time in UTC.
+        :param force: force to use energy even if there is not enough energy.
+        :returns: a :class:`UseResult`.
+
+        .. versionadded:: 0.2
+        """
+        time = self._timestamp(time)
+        policy = self.policy
+        if policy.schedule is not None:
+            current = self._current(time)
+            success = self._use(quantity, time, force, current)
+            if success:
+                current = self._current(time)
+            return UseResult(success, max(0, current), self.recover_in(time))
+        # the passed time is evaluated once for both of the current energy and
+        # the next recovery
+        used_at = self.used_at
+        if used_at is None:
+            passed = None
+        else:
+            passed = time - used_at
+            if passed < 0:
+                # within the future tolerance or used at the future
+                passed = self.passed(time)
+        max_, interval = policy.max, policy.recovery_interval
+        current = _linear_current(self.used, passed, max_, interval,
+                                  policy.recovery_quantity)
+        if current < quantity and not force:
+            if _sinks:
+                _emit('use_rejected')
+            recover_in = _recover_in(current, passed, self.used, interval)
+            return tuple.__new__(UseResult, (False, max(0, current),
+                                             recover_in))
+        self._use(quantity, time, force, current)
+        # using energy over the maximum doesn't just subtract the quantity
+        if self.used_at == time:
+            passed = 0
+        current = _linear_current(self.used, passed, max_, interval,
+                                  policy.recovery_quantity)
+        recover_in = _recover_in(current, passed, self.used, interval)
+        return tuple.__new__(UseResult, (True, max(0, current), recover_in))
+
+    def can_use(self, quantity=1, time=None):
+        """Checks whether there is enough energy to use without changing the
+        energy.
+
+        :param quantity: quantity of energy to be used. Defaults to ``1``.
+        :param time: the time when using the energy. Defaults to the present
+                     time in UTC.
+
+        .. versionadded:: 0.2
+        """
+        return self._current(self._timestamp(time)) >= quantity
 
     def recover_in(self, time=None):
         """Calculates seconds to the next energy recovery. If the energy is
@@ -198,14 +1073,15 @@ class Energy(object):
         :param time: the time when checking the energy. Defaults to the present
                      time in UTC.
         """
+        time = self._timestamp(time)
         passed = self.passed(time)
-        if passed is None or passed / self.recovery_interval >= self.used:
+        if passed is not None and self.policy.schedule is not None:
+            return _scheduled(self.policy, self.used, self.used_at, passed)[1]
+        if passed is None or \
+           _recoveries(passed, self.recovery_interval) >= self.used:
             return
-        diff = self.recovery_interval - (passed % self.recovery_interval)
-        current = self._current(time)
-        if current < 0:
-            return diff - current * self.recovery_interval
-        return diff
+        return _recover_in(self._current(time), passed, self.used,
+                           self.recovery_interval)
 
     def recover_fully_in(self, time=None):
         """Calculates seconds to be recovered fully. If the energy is full or
@@ -216,41 +1092,131 @@ class Energy(object):
 
         .. versionadded:: 0.1.5
         """
+        time = self._timestamp(time)
+        if self.policy.schedule is not None:
+            passed = self.passed(time)
+            if passed is not None:
+                return _scheduled(self.policy, self.used, self.used_at,
+                                  passed)[2]
         recover_in = self.recover_in(time)
         if recover_in is None:
             return
-        to_recover = self.max - self.current()
+        to_recover = self.max - self.current(time)
         return recover_in + self.recovery_interval * (to_recover - 1)
 
-    def recovered(self, time=None):
-        """Calculates the recovered energy from the player used energy first.
+    def status(self, time=None):
+        """Calculates every derived value at once. It is consistent and
+        cheaper than calling each method.
+
+        >>> energy = Energy(10, 300)
+        >>> energy.use(3, time=0)
+        >>> energy.status(60)
+        <EnergyStatus 7/10 recover in 04:00>
+        >>> energy.status(60).recover_fully_in
+        840
 
         :param time: the time when checking the energy. Defaults to the present
                      time in UTC.
+        :returns: an :class:`EnergyStatus`.
+
+        .. versionadded:: 0.2
         """
+        time = self._timestamp(time)
+        policy = self.policy
+        used, max_ = self.used, policy.max
         passed = self.passed(time)
-        if passed is None:
-            return 0
-        recovered = (int(passed / self.recovery_interval) *
-                     self.recovery_quantity)
-        return min(recovered, self.used)
+        recover_in = recover_fully_in = None
+        if not used:
+            current = max_
+        elif passed is None:
+            current = max_ - used
+        elif policy.schedule is not None:
+            current, recover_in, recover_fully_in = \
+                _scheduled(policy, used, self.used_at, passed)
+        else:
+            recovered = (_recoveries(passed, policy.recovery_interval) *
+                         policy.recovery_quantity)
+            current = max_ - used + min(recovered, used)
+        if passed is not None and policy.schedule is None:
+            interval = policy.recovery_interval
+            recover_in = _recover_in(current, passed, used, interval)
+            if recover_in is not None:
+                to_recover = max_ - max(0, current)
+                recover_fully_in = recover_in + interval * (to_recover - 1)
+        return EnergyStatus(time, max(0, current),
+                            -current if current < 0 else None, max_,
+                            recover_in, recover_fully_in, policy.resolution)
 
-    def passed(self, time=None):
-        """Calculates the seconds passed from using the energy first.
+    def next_change_at(self, time=None):
+        """Calculates the time when :meth:`current` changes next. If the
+        energy doesn't change until it is used, this returns ``None``. The
+        results of the reading methods can be cached until that time.
+
+        >>> energy = Energy(10, 300)
+        >>> energy.use(time=0)
+        >>> energy.next_change_at(100)
+        300
 
         :param time: the time when checking the energy. Defaults to the present
                      time in UTC.
-        :raise ValueError: used at the future
-        """
-        if self.used_at is None:
-            return
-        seconds = timestamp(time) - self.used_at
-        if seconds < 0:
-            if self.future_tolerance is not None and \
-               abs(seconds) <= self.future_tolerance:
-                return 0
-            raise ValueError('Used at the future (+%.2f sec)' % -seconds)
-        return seconds
+
+        .. versionadded:: 0.2
+        """
+        time = self._timestamp(time)
+        recover_in = self.recover_in(time)
+        if recover_in is not None:
+            return self._anchor(time) + recover_in
+
+    def _anchor(self, time):
+        """The time since when the next recovery gets closer. Within the
+        future tolerance, the passed time is clamped to ``0`` so the next
+        recovery is anchored on :attr:`used_at`.
+        """
+        used_at = self.used_at
+        if used_at is not None and time < used_at:
+            return used_at
+        return time
+
+    def recovered(self, time=None):
+        """Calculates the recovered energy from the player used energy first.
+
+        :param time: the time when checking the energy. Defaults to the present
+                     time in UTC.
+        """
+        passed = self.passed(time)
+        if passed is None:
+            return 0
+        policy = self.policy
+        if policy.schedule is not None:
+            recovered = policy.schedule.recovered(
+                self.used_at, self.used_at + passed,
+                policy.recovery_interval, policy.recovery_quantity)
+        else:
+            recovered = (_recoveries(passed, policy.recovery_interval) *
+                         policy.recovery_quantity)
+        return min(recovered, self.used)
+
+    def passed(self, time=None):
+        """Calculates the seconds passed from using the energy first.
+
+        :param time: the time when checking the energy. Defaults to the present
+                     time in UTC.
+        :raise ValueError: used at the future
+        """
+        if self.used_at is None:
+            return
+        seconds = self._timestamp(time) - self.used_at
+        if seconds < 0:
+            future_tolerance = self.policy.future_tolerance
+            if future_tolerance is not None and \
+               abs(seconds) <= future_tolerance:
+                if _sinks:
+                    _emit('future_tolerated', -seconds)
+                return 0
+            if _sinks:
+                _emit('future_rejected', -seconds)
+            raise ValueError('Used at the future (+%.2f sec)' % -seconds)
+        return seconds
 
     def set(self, quantity, time=None):
         """Sets the energy to the fixed quantity.
@@ -276,7 +1242,10 @@ class Energy(object):
             self.used = self.max - quantity
             self.used_at = None
         else:
-            self.use(self.current(time) - quantity)
+            time = self._timestamp(time)
+            self.use(self.current(time) - quantity, time)
+        if _sinks:
+            _emit('set')
 
     def reset(self, time=None):
         """Makes the energy to be full. Most social games reset energy when the
@@ -294,12 +1263,17 @@ class Energy(object):
         :param time: the time when setting the energy. Defaults to the present
                      time in UTC.
         """
+        params = {}
         if max is not None:
             if self.recover_in(time):
-                self.used += max - self._max
-            self._max = max
+                self.used += max - self.max
+            params['max'] = max
         if recovery_interval is not None:
-            self.recovery_interval = recovery_interval
+            params['recovery_interval'] = recovery_interval
+        if params:
+            self.policy = self.policy.replace(**params)
+        if _sinks:
+            _emit('config')
 
     def __int__(self, time=None):
         """Type-casting to ``int``."""
@@ -322,7 +1296,7 @@ class Energy(object):
         :param other: the operand
         :type other: :class:`Energy` or number
         """
-        if isinstance(other, type(self)):
+        if isinstance(other, Energy):
             return self.__getstate__() == other.__getstate__()
         elif isinstance(other, (int, float)):
             return float(self.current(time)) == other
@@ -373,6 +1347,7 @@ class Energy(object):
 
         .. versionadded:: 0.1.1
         """
+        time = self._timestamp(time)
         self.set(self.current(time) + other, time)
         return self
 
@@ -383,34 +1358,2998 @@ class Energy(object):
         """
         return self.__iadd__(-other, time)
 
+    def to_bytes(self):
+        """Serializes the energy into a fixed-size binary record. It is much
+        smaller than a pickle because it doesn't contain any key.
+
+        >>> len(Energy(10, 300).to_bytes())
+        42
+
+        .. versionadded:: 0.2
+        """
+        return _pack_energy(self)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Deserializes an energy from the result of :meth:`to_bytes`. It also
+        accepts a pickled energy or a pickled state of an energy in every
+        legacy form.
+
+        .. warning::
+
+           A pickle is loaded by :mod:`pickle`. Never deserialize untrusted
+           data.
+
+        :param data: the serialized energy
+        :raise ValueError: unknown version of the binary record
+
+        .. versionadded:: 0.2
+        """
+        version = _peek_version(data)
+        if version is None:
+            return _load_pickled(cls, data)
+        return _unpack_energy(cls, data, 0)
+
     def __getstate__(self):
-        return {'used': self.used,
-                'used_at': self.used_at,
-                'max': self.max,
-                'recovery_interval': self.recovery_interval,
-                'recovery_quantity': self.recovery_quantity,
-                'future_tolerance': self.future_tolerance}
+        state = {'used': self.used,
+                 'used_at': self.used_at,
+                 'max': self.max,
+                 'recovery_interval': self.recovery_interval,
+                 'recovery_quantity': self.recovery_quantity,
+                 'future_tolerance': self.future_tolerance,
+                 'resolution': self.resolution}
+        if self.policy.schedule is not None:
+            state['schedule'] = self.policy.schedule
+        return state
 
     def __setstate__(self, state):
         if isinstance(state, tuple):
             # saved under 0.1.2
-            self._max = state[0]
-            self.recovery_interval = state[1]
-            self.recovery_quantity = state[2]
+            self.policy = EnergyPolicy(*state[:3])
             self.used = state[3]
             self.used_at = state[4]
+            self.clock = None
             return
+        self.policy = EnergyPolicy(state['max'], state['recovery_interval'],
+                                   state['recovery_quantity'],
+                                   state['future_tolerance'],
+                                   state.get('resolution', 1),
+                                   state.get('schedule'))
         self.used = state['used']
         self.used_at = state['used_at']
-        self._max = state['max']
-        self.recovery_interval = state['recovery_interval']
-        self.recovery_quantity = state['recovery_quantity']
-        self.future_tolerance = state['future_tolerance']
+        self.clock = None
 
     def __repr__(self, time=None):
-        current = self.current(time)
-        rv = '<%s %d/%d' % (type(self).__name__, current, self.max)
-        if current < self.max:
-            recover_in = self.recover_in(time)
+        status = self.status(time)
+        rv = '<%s %d/%d' % (type(self).__name__, status.current, status.max)
+        if status.current < status.max:
+            recover_in = status.recover_in // status.resolution
             rv += ' recover in %02d:%02d' % (recover_in / 60, recover_in % 60)
         return rv + '>'
+
+
+class MemoizedEnergy(Energy):
+    """An energy which memoizes the derived values until
+    :meth:`next_change_at`. Repeated reads such as polling return the cached
+    values. Any change of the energy, by :meth:`use`, :meth:`set`,
+    :meth:`config` or even by the attributes, invalidates the memo. The debt
+    changes at every recovery, so the memo in debt is kept only for the same
+    time.
+
+    It takes the same parameters as :class:`Energy`.
+
+    .. versionadded:: 0.2
+    """
+
+    __slots__ = ('_memo',)
+
+    def _memoized(self, time):
+        """Gets the memo which is valid at the time. The memo is a tuple of
+        the state, the valid period and the derived values in absolute time.
+        """
+        memo = getattr(self, '_memo', None)
+        if memo is not None:
+            policy, used, used_at, since, expires = memo[:5]
+            if policy is self.policy and used == self.used and \
+               used_at == self.used_at and since <= time and \
+               (expires is None or time < expires):
+                return memo
+        status = Energy.status(self, time)
+        until = full_at = None
+        if status.recover_in is not None:
+            anchor = self._anchor(time)
+            until = anchor + status.recover_in
+            full_at = anchor + status.recover_fully_in
+        expires = until if status.debt is None else time + 1
+        memo = self._memo = (self.policy, self.used, self.used_at, time,
+                             expires, until, status.current, status.debt,
+                             full_at)
+        return memo
+
+    def current(self, time=None):
+        return self._memoized(self._timestamp(time))[6]
+
+    def debt(self, time=None):
+        return self._memoized(self._timestamp(time))[7]
+
+    def recover_in(self, time=None):
+        time = self._timestamp(time)
+        until = self._memoized(time)[5]
+        if until is not None:
+            return until - self._anchor(time)
+
+    def recover_fully_in(self, time=None):
+        time = self._timestamp(time)
+        full_at = self._memoized(time)[8]
+        if full_at is not None:
+            return full_at - self._anchor(time)
+
+    def next_change_at(self, time=None):
+        return self._memoized(self._timestamp(time))[5]
+
+    def status(self, time=None):
+        time = self._timestamp(time)
+        memo = self._memoized(time)
+        until, current, debt, full_at = memo[5:]
+        if until is None:
+            recover_in = recover_fully_in = None
+        else:
+            anchor = self._anchor(time)
+            recover_in, recover_fully_in = until - anchor, full_at - anchor
+        policy = self.policy
+        return EnergyStatus(time, current, debt, policy.max, recover_in,
+                            recover_fully_in, policy.resolution)
+
+
+class EnergyArray(object):
+    """A column-oriented collection of energies. It evaluates all energies at
+    a single timestamp in one call, which is much cheaper than calling the
+    methods of many :class:`Energy` objects one by one.
+
+    Each column is a list which has a value for each energy. The results of the
+    batched methods are exactly the same as the corresponding :class:`Energy`
+    methods.
+
+    >>> energies = EnergyArray.from_energies([
+    ...     Energy(10, 300), Energy(5, 60, used=3, used_at=0)])
+    >>> energies.current(120)
+    [10, 4]
+
+    :param used: the column of :attr:`Energy.used`
+    :param used_at: the column of :attr:`Energy.used_at`
+    :param max: the column of :attr:`Energy.max`
+    :param recovery_interval: the column of :attr:`Energy.recovery_interval`
+    :param recovery_quantity: the column of :attr:`Energy.recovery_quantity`
+    :param future_tolerance: the column of :attr:`Energy.future_tolerance`
+    :param resolution: the column of :attr:`Energy.resolution`. Defaults to
+                       ``1`` for every energy.
+
+    :raise ValueError: the columns have different lengths
+
+    .. versionadded:: 0.2
+    """
+
+    def __init__(self, used, used_at, max, recovery_interval,
+                 recovery_quantity, future_tolerance, resolution=None):
+        if resolution is None:
+            resolution = [1] * len(used)
+        columns = (used, used_at, max, recovery_interval, recovery_quantity,
+                   future_tolerance, resolution)
+        if len(set(map(len, columns))) > 1:
+            raise ValueError('Columns should have the same length')
+        self.used, self.used_at, self.max, self.recovery_interval, \
+            self.recovery_quantity, self.future_tolerance, \
+            self.resolution = map(list, columns)
+
+    @classmethod
+    def from_energies(cls, energies):
+        """Makes an energy array from :class:`Energy` objects."""
+        energies = list(energies)
+        for energy in energies:
+            _check_unscheduled(energy.policy)
+        return cls([e.used for e in energies],
+                   [e.used_at for e in energies],
+                   [e.max for e in energies],
+                   [e.recovery_interval for e in energies],
+                   [e.recovery_quantity for e in energies],
+                   [e.future_tolerance for e in energies],
+                   [e.resolution for e in energies])
+
+    def to_energies(self):
+        """Makes a list of :class:`Energy` objects from the energy array."""
+        return [self[x] for x in range(len(self))]
+
+    def append(self, energy):
+        """Appends an :class:`Energy` to the end of the energy array."""
+        _check_unscheduled(energy.policy)
+        self.used.append(energy.used)
+        self.used_at.append(energy.used_at)
+        self.max.append(energy.max)
+        self.recovery_interval.append(energy.recovery_interval)
+        self.recovery_quantity.append(energy.recovery_quantity)
+        self.future_tolerance.append(energy.future_tolerance)
+        self.resolution.append(energy.resolution)
+
+    def _columns(self):
+        return zip(self.used, self.used_at, self.max, self.recovery_interval,
+                   self.recovery_quantity, self.future_tolerance)
+
+    def _timestamps(self, time):
+        """Makes the timestamp of each energy in its resolution."""
+        resolutions = set(self.resolution)
+        if len(resolutions) <= 1:
+            resolution = resolutions.pop() if resolutions else 1
+            return [timestamp(time, resolution=resolution)] * len(self)
+        if isinstance(time, (int, float)):
+            # a number is regarded as ticks already
+            return [int(time)] * len(self)
+        elif time is None:
+            # one present time for every resolution
+            now = timestamp(resolution=1000000)
+            stamps = dict((resolution, now * resolution // 1000000)
+                          for resolution in resolutions)
+        else:
+            stamps = dict((resolution, timestamp(time, resolution=resolution))
+                          for resolution in resolutions)
+        return [stamps[resolution] for resolution in self.resolution]
+
+    def _currents(self, times, always_passed=False):
+        """Calculates the current internal energies and the passed seconds
+        from using the energies first. Like :meth:`Energy._current`, the
+        passed seconds of an energy which hasn't been used are not calculated
+        unless `always_passed` is ``True``.
+        """
+        for (used, used_at, max, interval, quantity, tolerance), time in \
+                zip(self._columns(), times):
+            if not used:
+                if always_passed:
+                    yield max, _passed(used_at, tolerance, time)
+                else:
+                    yield max, None
+                continue
+            passed = _passed(used_at, tolerance, time)
+            recovered = 0
+            if passed is not None:
+                recovered = min(_recoveries(passed, interval) * quantity, used)
+            yield max - used + recovered, passed
+
+    def _fast_currents(self, times):
+        """Calculates the current internal energies, the passed seconds and
+        the numbers of recoveries as lists by comprehensions without a
+        function call for each energy. It returns ``None`` unless every
+        energy is evaluated at the same time and no energy was used at the
+        future. Then :meth:`_currents` should be used.
+        """
+        if not times or len(set(self.resolution)) > 1:
+            return
+        time = times[0]
+        used_ats = [used_at for used_at in self.used_at if used_at is not None]
+        if used_ats and max(used_ats) > time:
+            return
+        intervals = self.recovery_interval
+        passed = [None if used_at is None else time - used_at
+                  for used_at in self.used_at]
+        if isinstance(time, int) and set(map(type, intervals)) == _int_type \
+           and set(map(type, used_ats)) <= _int_type:
+            counts = [None if p is None else p // interval
+                      for p, interval in zip(passed, intervals)]
+        else:
+            # the same as _recoveries()
+            counts = [None if p is None else int(p / interval)
+                      for p, interval in zip(passed, intervals)]
+        currents = [max_ if not used else max_ - used if count is None else
+                    max_ - used + (count * quantity if count * quantity < used
+                                   else used)
+                    for used, max_, count, quantity in
+                    zip(self.used, self.max, counts, self.recovery_quantity)]
+        return currents, passed, counts
+
+    def _fast_recover_ins(self, currents, passed, counts):
+        """Calculates :meth:`recover_in` from :meth:`_fast_currents`."""
+        return [None if count is None or count >= used else
+                interval - p % interval -
+                (current * interval if current < 0 else 0)
+                for current, p, count, used, interval in
+                zip(currents, passed, counts, self.used,
+                    self.recovery_interval)]
+
+    def current(self, time=None):
+        """Calculates the current presentative energies. See
+        :meth:`Energy.current`.
+
+        :param time: the time when checking the energies. Defaults to the
+                     present time in UTC.
+        """
+        times = self._timestamps(time)
+        fast = self._fast_currents(times)
+        if fast is not None:
+            return [current if current > 0 else 0 for current in fast[0]]
+        return [max(0, current) for current, passed in self._currents(times)]
+
+    def debt(self, time=None):
+        """Calculates the current energy debts. See :meth:`Energy.debt`.
+
+        :param time: the time when checking the energies. Defaults to the
+                     present time in UTC.
+        """
+        times = self._timestamps(time)
+        fast = self._fast_currents(times)
+        if fast is not None:
+            return [-current if current < 0 else None for current in fast[0]]
+        return [-current if current < 0 else None
+                for current, passed in self._currents(times)]
+
+    def recover_in(self, time=None):
+        """Calculates seconds to the next energy recovery of each energy. See
+        :meth:`Energy.recover_in`.
+
+        :param time: the time when checking the energies. Defaults to the
+                     present time in UTC.
+        """
+        times = self._timestamps(time)
+        fast = self._fast_currents(times)
+        if fast is not None:
+            return self._fast_recover_ins(*fast)
+        return [_recover_in(current, passed, used, interval)
+                for (current, passed), used, interval in
+                zip(self._currents(times, True), self.used,
+                    self.recovery_interval)]
+
+    def recover_fully_in(self, time=None):
+        """Calculates seconds to be recovered fully of each energy. See
+        :meth:`Energy.recover_fully_in`.
+
+        :param time: the time when checking the energies. Defaults to the
+                     present time in UTC.
+        """
+        times = self._timestamps(time)
+        fast = self._fast_currents(times)
+        if fast is not None:
+            return [None if recover_in is None else
+                    recover_in + interval *
+                    (max_ - (current if current > 0 else 0) - 1)
+                    for recover_in, current, max_, interval in
+                    zip(self._fast_recover_ins(*fast), fast[0], self.max,
+                        self.recovery_interval)]
+        rv = []
+        for (current, passed), used, max_, interval in \
+                zip(self._currents(times, True), self.used, self.max,
+                    self.recovery_interval):
+            recover_in = _recover_in(current, passed, used, interval)
+            if recover_in is None:
+                rv.append(None)
+                continue
+            to_recover = max_ - max(0, current)
+            rv.append(recover_in + interval * (to_recover - 1))
+        return rv
+
+    def use(self, quantity=1, time=None, force=False):
+        """Consumes the energies. Unlike :meth:`Energy.use`, it doesn't raise
+        an exception when some energy is not enough. It just leaves that energy
+        and reports the failure.
+
+        :param quantity: quantity of energy to be used. Defaults to ``1``. A
+                         sequence of quantities for each energy is also
+                         available.
+        :param time: the time when using the energies. Defaults to the present
+                     time in UTC.
+        :param force: force to use energy even if there is not enough energy.
+        :returns: a list of booleans which tell whether each energy was used.
+        """
+        times = self._timestamps(time)
+        if isinstance(quantity, (int, float)):
+            quantities = [quantity] * len(self)
+        else:
+            quantities = list(quantity)
+            if len(quantities) != len(self):
+                raise ValueError('Quantities should have the same length')
+        # calculate everything first not to leave half-used energies when the
+        # energies were used at the future.
+        currents = list(self._currents(times))
+        used_column, used_at_column = self.used, self.used_at
+        rv = []
+        for x, (current, passed) in enumerate(currents):
+            quantity = quantities[x]
+            if current < quantity and not force:
+                rv.append(False)
+                continue
+            max_ = self.max[x]
+            if current - quantity < max_ <= current or force:
+                used_column[x] = quantity - current + max_
+                used_at_column[x] = times[x]
+            else:
+                used = used_column[x]
+                recovered = 0
+                if passed is not None and used:
+                    interval = self.recovery_interval[x]
+                    quantity_per = self.recovery_quantity[x]
+                    recovered = min(_recoveries(passed, interval) *
+                                    quantity_per, used)
+                used_column[x] = max_ - current + recovered + quantity
+            rv.append(True)
+        return rv
+
+    def config(self, max=None, recovery_interval=None, time=None):
+        """Updates :attr:`Energy.max` or :attr:`Energy.recovery_interval` of
+        every energy. See :meth:`Energy.config`.
+
+        :param max: quantity of maximum energy to be set
+        :param recovery_interval: the recovery interval to be set
+        :param time: the time when setting the energies. Defaults to the
+                     present time in UTC.
+        """
+        if max is not None and not isinstance(max, int):
+            raise TypeError('max should be int')
+        if recovery_interval is not None:
+            # validate and convert the interval for each resolution first
+            intervals = dict((resolution, EnergyPolicy(
+                0, recovery_interval, resolution=resolution).recovery_interval)
+                for resolution in set(self.resolution))
+        if max is not None:
+            used_column, max_column = self.used, self.max
+            for x, recover_in in enumerate(self.recover_in(time)):
+                if recover_in:
+                    used_column[x] += max - max_column[x]
+            max_column[:] = [max] * len(self)
+        if recovery_interval is not None:
+            self.recovery_interval[:] = [intervals[resolution]
+                                         for resolution in self.resolution]
+        if _sinks:
+            # counted per energy like Energy.config
+            for x in range(len(self)):
+                _emit('config')
+
+    def _slice(self, start, stop):
+        """Makes an energy array of the energies between `start` and `stop`.
+        """
+        return EnergyArray(*[getattr(self, name)[start:stop]
+                             for name in self._names])
+
+    def _assign(self, start, array):
+        """Overwrites the energies from `start` by the energy array."""
+        stop = start + len(array)
+        for name in self._names:
+            getattr(self, name)[start:stop] = getattr(array, name)
+
+    _names = ('used', 'used_at', 'max', 'recovery_interval',
+              'recovery_quantity', 'future_tolerance', 'resolution')
+
+    def __len__(self):
+        return len(self.used)
+
+    def __getitem__(self, x):
+        policy = EnergyPolicy(self.max[x], self.recovery_interval[x],
+                              self.recovery_quantity[x],
+                              self.future_tolerance[x], self.resolution[x])
+        return Energy._restore(policy, self.used[x], self.used_at[x])
+
+
+#: The version of the binary record of :meth:`Energy.to_bytes`.
+BINARY_VERSION = 2
+
+# version, flags, used, used_at, max, recovery_quantity, recovery_interval,
+# future_tolerance
+_record = struct.Struct('!BBqqiidd')
+
+# flags of the binary record
+_HAS_USED_AT = 1 << 0
+_HAS_FUTURE_TOLERANCE = 1 << 1
+_INT_RECOVERY_INTERVAL = 1 << 2
+_INT_FUTURE_TOLERANCE = 1 << 3
+# the index of the resolution in RESOLUTIONS since version 2
+_RESOLUTION_SHIFT = 4
+_RESOLUTION_MASK = 3 << _RESOLUTION_SHIFT
+
+
+def _pack_energy(energy, buf=None, offset=0):
+    """Packs an energy into a binary record. If `buf` is given, the record is
+    written into the buffer at the offset.
+    """
+    args = (BINARY_VERSION,) + _energy_fields(energy)
+    if buf is None:
+        return _record.pack(*args)
+    _record.pack_into(buf, offset, *args)
+
+
+def _energy_fields(energy):
+    """Makes the fields of the binary record except the version: flags, used,
+    used_at, max, recovery_quantity, recovery_interval and future_tolerance.
+    """
+    policy = energy.policy
+    _check_unscheduled(policy)
+    flags = 0
+    used_at = energy.used_at
+    if used_at is None:
+        used_at = 0
+    else:
+        flags |= _HAS_USED_AT
+    recovery_interval = policy.recovery_interval
+    if isinstance(recovery_interval, int):
+        flags |= _INT_RECOVERY_INTERVAL
+    future_tolerance = policy.future_tolerance
+    if future_tolerance is None:
+        future_tolerance = 0
+    else:
+        flags |= _HAS_FUTURE_TOLERANCE
+        if isinstance(future_tolerance, int):
+            flags |= _INT_FUTURE_TOLERANCE
+    flags |= RESOLUTIONS.index(policy.resolution) << _RESOLUTION_SHIFT
+    return (flags, energy.used, used_at, policy.max, policy.recovery_quantity,
+            recovery_interval, future_tolerance)
+
+
+def _unpack_energy(cls, data, offset):
+    """Unpacks an energy from the binary record at the offset."""
+    version, flags, used, used_at, max, recovery_quantity, \
+        recovery_interval, future_tolerance = _record.unpack_from(data, offset)
+    if version not in (1, BINARY_VERSION):
+        raise ValueError('Unknown binary version: %d' % version)
+    policy = _unpack_policy(flags, max, recovery_quantity, recovery_interval,
+                            future_tolerance)
+    return cls._restore(policy, used,
+                        used_at if flags & _HAS_USED_AT else None)
+
+
+def _unpack_policy(flags, max, recovery_quantity, recovery_interval,
+                   future_tolerance):
+    """Makes the energy policy from the fields of a binary record."""
+    if flags & _INT_RECOVERY_INTERVAL:
+        recovery_interval = int(recovery_interval)
+    if not flags & _HAS_FUTURE_TOLERANCE:
+        future_tolerance = None
+    elif flags & _INT_FUTURE_TOLERANCE:
+        future_tolerance = int(future_tolerance)
+    # version 1 doesn't have the resolution bits
+    resolution = RESOLUTIONS[(flags & _RESOLUTION_MASK) >> _RESOLUTION_SHIFT]
+    return EnergyPolicy(max, recovery_interval, recovery_quantity,
+                        future_tolerance, resolution)
+
+
+def _peek_version(data):
+    """Gets the version of the binary record. If the data is not a binary
+    record but a pickle, it returns ``None``.
+    """
+    version = struct.unpack_from('!B', data)[0]
+    # the first byte of a pickle is an opcode which is never lower than 32.
+    return version if version < 32 else None
+
+
+def _load_pickled(cls, data):
+    """Loads a pickled energy or a pickled state of an energy."""
+    loaded = pickle.loads(bytes(data))
+    if isinstance(loaded, Energy):
+        return loaded
+    # a state which is saved from :meth:`Energy.__getstate__`
+    energy = cls.__new__(cls)
+    energy.__setstate__(loaded)
+    return energy
+
+
+class EnergyView(Energy):
+    """A read-only energy over a binary record of :meth:`Energy.to_bytes` or
+    :func:`pack_many`. It doesn't copy the buffer. The fields are decoded
+    from the buffer whenever they are accessed, so reading methods such as
+    :meth:`current`, :meth:`debt`, :meth:`recover_in` and :meth:`status` work
+    without making an :class:`Energy`.
+
+    >>> view = EnergyView(Energy(10, 300, used=3, used_at=0).to_bytes())
+    >>> view.current(600)
+    9
+
+    Changing methods raise :exc:`TypeError`. Call :meth:`to_energy` to get a
+    changeable copy.
+
+    A reading method decodes the record once per call. The decoded policy is
+    kept by the view until the parameters in the record change.
+
+    :param data: the buffer which contains the binary record
+    :param offset: the offset of the record in the buffer. Defaults to ``0``.
+    :raise ValueError: unknown version of the binary record
+
+    .. versionadded:: 0.2
+    """
+
+    __slots__ = ('_data', '_offset', '_policy')
+
+    # flags, used, used_at
+    _state = struct.Struct('!xBqq')
+
+    clock = None
+
+    def __init__(self, data, offset=0):
+        data = memoryview(data)
+        version = _peek_version(data[offset:offset + 1])
+        if version not in (1, BINARY_VERSION):
+            raise ValueError('Unknown binary version: %r' % version)
+        if len(data) < offset + _record.size:
+            raise ValueError('Broken buffer')
+        self._data = data
+        self._offset = offset
+        self._policy = None
+
+    @classmethod
+    def many(cls, data):
+        """Makes the views of every record in the result of
+        :func:`pack_many`.
+        """
+        size = _record.size
+        if len(data) % size:
+            raise ValueError('Broken buffer')
+        data = memoryview(data)
+        return [cls(data, offset) for offset in range(0, len(data), size)]
+
+    @property
+    def used(self):
+        return self._state.unpack_from(self._data, self._offset)[1]
+
+    @property
+    def used_at(self):
+        flags, used, used_at = self._state.unpack_from(self._data,
+                                                       self._offset)
+        return used_at if flags & _HAS_USED_AT else None
+
+    @property
+    def policy(self):
+        return self._decode()[0]
+
+    def _decode(self):
+        """Decodes the policy, used and used_at from the record at once."""
+        version, flags, used, used_at, max, recovery_quantity, \
+            recovery_interval, future_tolerance = \
+            _record.unpack_from(self._data, self._offset)
+        params = (flags & ~_HAS_USED_AT, max, recovery_quantity,
+                  recovery_interval, future_tolerance)
+        cached = self._policy
+        if cached is None or cached[0] != params:
+            cached = self._policy = \
+                (params, _unpack_policy(flags, max, recovery_quantity,
+                                        recovery_interval, future_tolerance))
+        return cached[1], used, used_at if flags & _HAS_USED_AT else None
+
+    def _energy(self):
+        return Energy._restore(*self._decode())
+
+    def current(self, time=None):
+        return self._energy().current(time)
+
+    def debt(self, time=None):
+        return self._energy().debt(time)
+
+    def recover_in(self, time=None):
+        return self._energy().recover_in(time)
+
+    def recover_fully_in(self, time=None):
+        return self._energy().recover_fully_in(time)
+
+    def recovered(self, time=None):
+        return self._energy().recovered(time)
+
+    def passed(self, time=None):
+        return self._energy().passed(time)
+
+    def next_change_at(self, time=None):
+        return self._energy().next_change_at(time)
+
+    def status(self, time=None):
+        return self._energy().status(time)
+
+    def to_energy(self):
+        """Makes a changeable :class:`Energy` from the record."""
+        return self._energy()
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('%s is read-only' % type(self).__name__)
+
+    use = try_use = set = reset = config = __iadd__ = __isub__ = _read_only
+    __setstate__ = _read_only
+
+    def __reduce__(self):
+        return (_unpack_energy, (Energy, self.to_bytes(), 0))
+
+    def to_bytes(self):
+        """Copies the binary record."""
+        offset = self._offset
+        return self._data[offset:offset + _record.size].tobytes()
+
+
+def pack_many(energies):
+    """Serializes energies into one contiguous buffer of the binary records of
+    :meth:`Energy.to_bytes`.
+
+    .. versionadded:: 0.2
+    """
+    energies = list(energies)
+    size = _record.size
+    buf = bytearray(size * len(energies))
+    for x, energy in enumerate(energies):
+        _pack_energy(energy, buf, x * size)
+    return bytes(buf)
+
+
+def unpack_many(data, cls=Energy):
+    """Deserializes energies from the result of :func:`pack_many`.
+
+    :param data: the buffer of the binary records
+    :param cls: the energy class to make. Defaults to :class:`Energy`.
+    :raise ValueError: the buffer is broken or has an unknown version
+
+    .. versionadded:: 0.2
+    """
+    size = _record.size
+    if len(data) % size:
+        raise ValueError('Broken buffer')
+    return [_unpack_energy(cls, data, offset)
+            for offset in range(0, len(data), size)]
+
+
+def _int64_typecode():
+    """Finds the :mod:`array` typecode of 64-bit integers. Python 2 has no
+    ``'q'`` but ``'l'`` is 64-bit on most 64-bit platforms. ``None`` if there
+    is no such typecode.
+    """
+    for typecode in ('q', 'l'):
+        try:
+            if array(typecode).itemsize == 8:
+                return typecode
+        except ValueError:
+            pass
+
+
+_INT64 = _int64_typecode()
+
+
+def _local_typecode(typecode):
+    """Maps the typecode of a column to the typecode of this Python. ``None``
+    means the column should be packed by :mod:`struct`.
+    """
+    return _INT64 if typecode == 'q' else typecode
+
+
+class EnergySnapshot(object):
+    """A columnar snapshot file of many energies. Each field is one contiguous
+    little-endian column, so the file is opened by :mod:`mmap` at once and a
+    column can be read without the other fields. Other tools such as
+    :func:`numpy.memmap` can read a column at :attr:`offsets` too.
+
+    ::
+
+       EnergySnapshot.write('energy.snapshot', energies)
+       with EnergySnapshot('energy.snapshot') as snapshot:
+           for keys, array in snapshot.chunks():
+               print sum(array.current())
+
+    The rows are sorted by the keys which are 64-bit integers. The columns
+    are:
+
+    ``key`` (int64), ``used`` (int64), ``used_at`` (int64), ``max``
+    (int64), ``recovery_interval`` (float64), ``recovery_quantity``
+    (int64), ``future_tolerance`` (float64) and ``flags`` (uint8)
+
+    ``flags`` are the same as the flags of the binary record of
+    :meth:`Energy.to_bytes`. They tell whether `used_at` and
+    `future_tolerance` are ``None``, whether the numbers are ``int`` and the
+    resolution.
+
+    :param path: the path of the snapshot file
+    :raise ValueError: not a snapshot file
+
+    .. versionadded:: 0.2
+    """
+
+    # magic, version, number of rows, number of columns
+    _header = struct.Struct('<4sBxxxQH6x')
+    # name, typecode, offset
+    _column = struct.Struct('<32sc7xQ')
+
+    _magic = b'ESNP'
+    _version = 1
+
+    #: The names and the :mod:`array` typecodes of the columns.
+    columns = (('key', 'q'), ('used', 'q'), ('used_at', 'q'), ('max', 'q'),
+               ('recovery_interval', 'd'), ('recovery_quantity', 'q'),
+               ('future_tolerance', 'd'), ('flags', 'B'))
+
+    def __init__(self, path):
+        import mmap
+        self.path = path
+        self._views = []
+        self._cache = {}
+        self._file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+            magic, version, self.count, size = \
+                self._header.unpack_from(self._map)
+        except (ValueError, struct.error):
+            self._file.close()
+            raise ValueError('Not an energy snapshot: %r' % path)
+        if magic != self._magic or version != self._version:
+            self.close()
+            raise ValueError('Not an energy snapshot: %r' % path)
+        #: The offsets of the columns in the file.
+        self.offsets = {}
+        self._typecodes = {}
+        for x in range(size):
+            offset = self._header.size + x * self._column.size
+            name, typecode, offset = self._column.unpack_from(self._map,
+                                                              offset)
+            name = name.rstrip(b'\0').decode('ascii')
+            self.offsets[name] = offset
+            self._typecodes[name] = typecode.decode('ascii')
+
+    @classmethod
+    def write(cls, path, energies):
+        """Writes energies into a snapshot file.
+
+        :param path: the path of the snapshot file
+        :param energies: a dict or pairs of integer keys and energies
+        """
+        items = sorted(_items(energies), key=itemgetter(0))
+        count = len(items)
+        fields = [(key,) + _energy_fields(energy) for key, energy in items]
+        # the order of the fields in the binary record
+        order = dict((name, x) for x, name in enumerate([
+            'key', 'flags', 'used', 'used_at', 'max', 'recovery_quantity',
+            'recovery_interval', 'future_tolerance']))
+        offset = cls._header.size + cls._column.size * len(cls.columns)
+        header = [cls._header.pack(cls._magic, cls._version, count,
+                                   len(cls.columns))]
+        columns = []
+        for name, typecode in cls.columns:
+            offset += -offset % 8
+            header.append(cls._column.pack(name.encode('ascii'),
+                                           typecode.encode('ascii'), offset))
+            values = map(itemgetter(order[name]), fields)
+            local_typecode = _local_typecode(typecode)
+            if local_typecode is None:
+                column = struct.pack('<%d%s' % (count, typecode), *values)
+            else:
+                column = array(local_typecode, values)
+                if sys.byteorder != 'little':
+                    column.byteswap()
+            columns.append((offset, column))
+            offset += struct.calcsize('<' + typecode) * count
+        with open(path, 'wb') as f:
+            f.write(b''.join(header))
+            for offset, column in columns:
+                f.write(b'\0' * (offset - f.tell()))
+                if isinstance(column, bytes):
+                    f.write(column)
+                else:
+                    column.tofile(f)
+
+    def column(self, name):
+        """Gets a column as a sequence. It is a :class:`memoryview` over the
+        file without copying on a little-endian Python 3. Otherwise it is an
+        :class:`array.array` which is read from the file.
+        """
+        try:
+            return self._cache[name]
+        except KeyError:
+            pass
+        typecode = self._typecodes[name]
+        local_typecode = _local_typecode(typecode)
+        offset = self.offsets[name]
+        size = struct.calcsize('<' + typecode) * self.count
+        if local_typecode is None:
+            column = list(struct.unpack_from('<%d%s' % (self.count, typecode),
+                                             self._map, offset))
+        elif sys.byteorder == 'little' and hasattr(memoryview, 'cast'):
+            view = memoryview(self._map)[offset:offset + size]
+            self._views.append(view)
+            column = view.cast(local_typecode)
+            self._views.append(column)
+        else:
+            # a memory map of Python 2 has no buffer interface for memoryview
+            column = array(local_typecode)
+            getattr(column, 'frombytes', column.fromstring)(
+                self._map[offset:offset + size])
+            if sys.byteorder != 'little':
+                column.byteswap()
+        return self._cache.setdefault(name, column)
+
+    def _energies(self, start, stop):
+        """Makes the energies of the rows in the range."""
+        columns = [self.column(name)[start:stop] for name in [
+            'flags', 'used', 'used_at', 'max', 'recovery_quantity',
+            'recovery_interval', 'future_tolerance']]
+        for flags, used, used_at, max, recovery_quantity, \
+                recovery_interval, future_tolerance in zip(*columns):
+            policy = _unpack_policy(flags, max, recovery_quantity,
+                                    recovery_interval, future_tolerance)
+            yield Energy._restore(policy, used,
+                                  used_at if flags & _HAS_USED_AT else None)
+
+    def get(self, key):
+        """Finds the energy of the key by binary search. If there is no such
+        energy, it returns ``None``.
+        """
+        keys = self.column('key')
+        x = bisect_left(keys, key)
+        if x < len(keys) and keys[x] == key:
+            return self[x]
+
+    def items(self):
+        """Iterates the keys and the energies. The energies are made one by
+        one.
+        """
+        keys = self.column('key')
+        for start in range(0, self.count, 4096):
+            stop = start + 4096
+            for item in zip(keys[start:stop], self._energies(start, stop)):
+                yield item
+
+    def chunks(self, size=65536):
+        """Iterates the rows in chunks. Each chunk is a list of the keys and an
+        :class:`EnergyArray`.
+        """
+        keys = self.column('key')
+        for start in range(0, self.count, size):
+            stop = start + size
+            yield list(keys[start:stop]), self._array(start, stop)
+
+    def _array(self, start, stop):
+        """Makes an energy array of the rows in the range from the columns
+        without making the energies.
+        """
+        sliced = lambda name: self.column(name)[start:stop]
+        flags = sliced('flags')
+        used_at = [used_at if f & _HAS_USED_AT else None
+                   for f, used_at in zip(flags, sliced('used_at'))]
+        recovery_interval = [
+            int(interval) if f & _INT_RECOVERY_INTERVAL else interval
+            for f, interval in zip(flags, sliced('recovery_interval'))]
+        future_tolerance = [
+            None if not f & _HAS_FUTURE_TOLERANCE else
+            int(tolerance) if f & _INT_FUTURE_TOLERANCE else tolerance
+            for f, tolerance in zip(flags, sliced('future_tolerance'))]
+        resolution = [RESOLUTIONS[(f & _RESOLUTION_MASK) >> _RESOLUTION_SHIFT]
+                      for f in flags]
+        return EnergyArray(sliced('used'), used_at, sliced('max'),
+                           recovery_interval, sliced('recovery_quantity'),
+                           future_tolerance, resolution)
+
+    def close(self):
+        """Closes the snapshot. Don't use the columns after that. The slices
+        of the columns should be released before.
+        """
+        for view in reversed(self._views):
+            view.release()
+        self._views = []
+        self._cache = {}
+        self._map.close()
+        self._file.close()
+
+    def __getitem__(self, x):
+        if not -self.count <= x < self.count:
+            raise IndexError(x)
+        x %= self.count
+        return next(self._energies(x, x + 1))
+
+    def __len__(self):
+        return self.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class EnergyWallet(object):
+    """A set of named energies of a player. It is saved as one compact binary
+    record, and it uses several energies at once atomically.
+
+    >>> wallet = EnergyWallet({'stamina': Energy(100, 60),
+    ...                        'ticket': Energy(5, 3600)})
+    >>> wallet.use_many({'stamina': 10, 'ticket': 1}, time=0)
+    >>> wallet.status(0)['ticket']
+    <EnergyStatus 4/5 recover in 60:00>
+
+    :param energies: a dict or pairs of names and energies
+
+    Names should be ``str`` and shorter than 256 bytes in UTF-8.
+
+    .. versionadded:: 0.2
+    """
+
+    # version, the number of the energies
+    _header = struct.Struct('!BH')
+    _version = 1
+
+    def __init__(self, energies=()):
+        self.energies = dict(_items(energies))
+
+    def use_many(self, quantities, time=None, force=False):
+        """Consumes several energies at once. Either every energy is used or
+        none of them.
+
+        :param quantities: a dict or pairs of names and quantities. The
+                           quantities of the same name are summed.
+        :param time: the time when using the energies. Defaults to the present
+                     time in UTC.
+        :param force: force to use energy even if there is not enough energy.
+        :raise KeyError: unknown name
+        :raise ValueError: some energy is not enough
+        """
+        names, totals = [], {}
+        for name, quantity in _items(quantities):
+            if name in totals:
+                totals[name] += quantity
+            else:
+                names.append(name)
+                totals[name] = quantity
+        with frozen_now():
+            # check every energy first not to leave half-used energies.
+            uses = []
+            for name in names:
+                quantity = totals[name]
+                energy = self.energies[name]
+                energy_time = energy._timestamp(time)
+                current = energy._current(energy_time)
+                if current < quantity and not force:
+                    raise ValueError('Not enough energy: %s' % name)
+                uses.append((energy, quantity, energy_time, current))
+            for energy, quantity, energy_time, current in uses:
+                energy._use(quantity, energy_time, force, current)
+
+    def status(self, time=None):
+        """Calculates the statuses of every energy at the same time.
+
+        :returns: a dict of :class:`EnergyStatus` by the names.
+        """
+        with frozen_now():
+            return dict((name, energy.status(time))
+                        for name, energy in self.energies.items())
+
+    def to_bytes(self):
+        """Serializes every energy into one binary record."""
+        chunks = [self._header.pack(self._version, len(self.energies))]
+        for name, energy in sorted(self.energies.items()):
+            name = name.encode('utf-8')
+            chunks.append(struct.pack('!B', len(name)) + name)
+            chunks.append(_pack_energy(energy))
+        return b''.join(chunks)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Deserializes a wallet from the result of :meth:`to_bytes`.
+
+        :raise ValueError: unknown version of the binary record
+        """
+        version, count = cls._header.unpack_from(data)
+        if version != cls._version:
+            raise ValueError('Unknown wallet version: %d' % version)
+        offset = cls._header.size
+        energies = {}
+        for x in range(count):
+            size = struct.unpack_from('!B', data, offset)[0]
+            offset += 1
+            name = bytes(data[offset:offset + size]).decode('utf-8')
+            offset += size
+            energies[name] = _unpack_energy(Energy, data, offset)
+            offset += _record.size
+        return cls(energies)
+
+    def __getstate__(self):
+        return self.to_bytes()
+
+    def __setstate__(self, state):
+        self.energies = self.from_bytes(state).energies
+
+    def __getitem__(self, name):
+        return self.energies[name]
+
+    def __setitem__(self, name, energy):
+        self.energies[name] = energy
+
+    def __delitem__(self, name):
+        del self.energies[name]
+
+    def __contains__(self, name):
+        return name in self.energies
+
+    def __iter__(self):
+        return iter(self.energies)
+
+    def __len__(self):
+        return len(self.energies)
+
+    def __eq__(self, other):
+        if isinstance(other, EnergyWallet):
+            return self.energies == other.energies
+        return False
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '<%s %s>' % (type(self).__name__, ', '.join(
+            '%s=%r' % item for item in sorted(self.energies.items())))
+
+
+def use_many(energies, quantities=1, time=None, force=False):
+    """Consumes many energies at a single timestamp. It is the same as calling
+    :meth:`Energy.use` of each energy, but it doesn't raise an exception. It
+    just leaves the energy which is not enough or used at the future and
+    reports the failure.
+
+    >>> energies = [Energy(10, 300), Energy(10, 300, used=8, used_at=0)]
+    >>> use_many(energies, 5, time=0)
+    [True, False]
+
+    :param energies: the :class:`Energy` objects
+    :param quantities: a sequence of quantities for each energy, or a
+                       quantity for every energy. Defaults to ``1``.
+    :param time: the time when using the energies. Defaults to the present
+                 time in UTC.
+    :param force: force to use energy even if there is not enough energy.
+    :returns: a list of booleans which tell whether each energy was used.
+    :raise ValueError: the quantities have a different length
+
+    .. versionadded:: 0.2
+    """
+    energies = list(energies)
+    if isinstance(quantities, (int, float)):
+        quantities = [quantities] * len(energies)
+    else:
+        quantities = list(quantities)
+        if len(quantities) != len(energies):
+            raise ValueError('Quantities should have the same length')
+    rv = []
+    with frozen_now():
+        for energy, quantity in zip(energies, quantities):
+            energy_time = energy._timestamp(time)
+            try:
+                current = energy._current(energy_time)
+            except ValueError:
+                # used at the future
+                rv.append(False)
+                continue
+            rv.append(energy._use(quantity, energy_time, force, current))
+    return rv
+
+
+def config_many(energies, max=None, recovery_interval=None, time=None,
+                chunk_size=10000, checkpoint=None, progress=None):
+    """Updates :attr:`Energy.max` or :attr:`Energy.recovery_interval` of many
+    energies. It is the same as calling :meth:`Energy.config` of each energy
+    at a single timestamp, but an :class:`EnergyArray` or an
+    :class:`EnergyStore` is updated chunk by chunk: the energies of a chunk are
+    loaded, configured as an :class:`EnergyArray` and saved at once.
+
+    ::
+
+       def report(checkpoint, done, total, rate):
+           save_checkpoint(checkpoint)
+           print '%d/%d (%.0f energies/sec)' % (done, total, rate)
+
+       config_many(store, max=20, time=migrated_at,
+                   checkpoint=load_checkpoint(), progress=report)
+
+    Configuring with the same values again doesn't change an energy. So an
+    interrupted migration can be resumed from the last reported checkpoint
+    with the same arguments, even if the next chunk was partially saved.
+    The chunks of a store are not locked while they are configured. So the
+    energies should not be used during the migration.
+
+    :param energies: a list of :class:`Energy` objects, an
+                     :class:`EnergyArray` or an :class:`EnergyStore`
+    :param max: quantity of maximum energy to be set
+    :param recovery_interval: the recovery interval to be set
+    :param time: the time when setting the energies. Defaults to the present
+                 time in UTC. Give a fixed time to resume a migration.
+    :param chunk_size: the number of energies in a chunk. Defaults to
+                       ``10000``.
+    :param checkpoint: the checkpoint reported by `progress` to resume from.
+                       The energies up to the checkpoint are skipped.
+    :param progress: a function called after each chunk with the checkpoint,
+                     the number of configured energies and the number of
+                     energies to configure in this call, and the throughput
+                     in energies per second.
+    :returns: the number of configured energies in this call.
+
+    .. versionadded:: 0.2
+    """
+    is_store = isinstance(energies, EnergyStore)
+    if is_store:
+        # a store is resumed after the last key because keys may be added or
+        # removed in the meantime
+        keys = energies.keys()
+        start = 0 if checkpoint is None else bisect_right(keys, checkpoint)
+        stop = len(keys)
+    else:
+        if not isinstance(energies, EnergyArray):
+            energies = list(energies)
+        start = 0 if checkpoint is None else checkpoint
+        stop = len(energies)
+    total = stop - start if start < stop else 0
+    done = 0
+    started_at = default_timer()
+    with frozen_now():
+        for x in range(start, stop, chunk_size):
+            end = x + chunk_size if x + chunk_size < stop else stop
+            if is_store:
+                chunk_keys = keys[x:end]
+                found = energies.get_many(chunk_keys)
+                chunk_keys = [key for key in chunk_keys if key in found]
+                array = EnergyArray.from_energies(
+                    [found[key] for key in chunk_keys])
+                array.config(max, recovery_interval, time)
+                energies.put_many(zip(chunk_keys, array.to_energies()))
+                checkpoint = keys[end - 1]
+            elif isinstance(energies, EnergyArray):
+                array = energies._slice(x, end)
+                array.config(max, recovery_interval, time)
+                energies._assign(x, array)
+                checkpoint = end
+            else:
+                for energy in energies[x:end]:
+                    energy.config(max, recovery_interval, time)
+                checkpoint = end
+            done += end - x
+            if progress is not None:
+                elapsed = default_timer() - started_at
+                rate = done / elapsed if elapsed else float('inf')
+                progress(checkpoint, done, total, rate)
+    return done
+
+
+def _scheduled(policy, used, used_at, passed):
+    """Calculates the current internal energy, the time to the next energy
+    recovery and the time to be recovered fully by the schedule of the policy.
+    """
+    schedule = policy.schedule
+    base = (policy.recovery_interval, policy.recovery_quantity)
+    time = used_at + passed
+    recovered = schedule.recovered(used_at, time, *base)
+    max_ = policy.max
+    current = max_ - used + min(recovered, used)
+    if recovered >= used:
+        return current, None, None
+    if current < 0:
+        # the presentative energy increases when the debt is paid
+        quantity = used - max_ + 1
+    else:
+        quantity = recovered + 1
+    recover_in = schedule.recovered_at(used_at, quantity, *base) - time
+    recover_fully_in = schedule.recovered_at(used_at, used, *base) - time
+    return current, recover_in, recover_fully_in
+
+
+def _check_unscheduled(policy):
+    if policy.schedule is not None:
+        # a schedule is not a value but an object shared by energies
+        raise ValueError('An energy with a recovery schedule is not '
+                         'supported')
+
+
+def _passed(used_at, future_tolerance, time):
+    """Calculates the seconds passed from `used_at` like :meth:`Energy.passed`.
+    """
+    if used_at is None:
+        return
+    seconds = time - used_at
+    if seconds < 0:
+        if future_tolerance is not None and -seconds <= future_tolerance:
+            return 0
+        raise ValueError('Used at the future (+%.2f sec)' % -seconds)
+    return seconds
+
+
+_int_type = set([int])
+
+
+def _recoveries(passed, recovery_interval):
+    """Counts the recoveries in the passed time. Ticks are divided exactly in
+    integers. Otherwise the true division is kept for the recovery of a float
+    interval such as ``0.1`` which isn't exact in binary.
+    """
+    if isinstance(passed, int) and isinstance(recovery_interval, int):
+        return passed // recovery_interval
+    return int(passed / recovery_interval)
+
+
+def _linear_current(used, passed, max, recovery_interval,
+                    recovery_quantity):
+    """Calculates the current internal energy from the passed time like
+    :meth:`Energy._current` without a schedule.
+    """
+    if not used or passed is None:
+        return max - used
+    recovered = _recoveries(passed, recovery_interval) * recovery_quantity
+    return max - used + min(recovered, used)
+
+
+def _recover_in(current, passed, used, recovery_interval):
+    """Calculates seconds to the next energy recovery like
+    :meth:`Energy.recover_in`.
+    """
+    if passed is None or _recoveries(passed, recovery_interval) >= used:
+        return
+    diff = recovery_interval - (passed % recovery_interval)
+    if current < 0:
+        return diff - current * recovery_interval
+    return diff
+
+
+class EnergyStore(object):
+    """A storage of energies keyed by player id. Subclasses implement
+    :meth:`get_many`, :meth:`put_many` and :meth:`use`. Bulk operations should
+    cost about one round-trip regardless of the number of keys.
+
+    :param default: a function which makes an energy for an unknown key. If it
+                    is not given, :meth:`use` raises :exc:`KeyError` for an
+                    unknown key.
+
+    .. versionadded:: 0.2
+    """
+
+    def __init__(self, default=None):
+        self.default = default
+
+    def get(self, key):
+        """Gets the energy of the key. If there is no such energy, it returns
+        ``None``.
+        """
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        """Gets the energies of the keys at once.
+
+        :returns: a dict of the found energies by their keys.
+        """
+        raise NotImplementedError
+
+    def put(self, key, energy):
+        """Saves the energy of the key."""
+        self.put_many({key: energy})
+
+    def put_many(self, energies):
+        """Saves many energies at once.
+
+        :param energies: a dict or pairs of keys and energies
+        """
+        raise NotImplementedError
+
+    def keys(self):
+        """Lists the keys of every energy in ascending order."""
+        raise NotImplementedError
+
+    def use(self, key, quantity=1, time=None, force=False):
+        """Consumes the energy of the key atomically. It loads the energy,
+        calls :meth:`Energy.use` and saves the energy as a single
+        read-modify-write.
+
+        :param key: the key of the energy
+        :param quantity: quantity of energy to be used. Defaults to ``1``.
+        :param time: the time when using the energy. Defaults to the present
+                     time in UTC.
+        :param force: force to use energy even if there is not enough energy.
+        :returns: the used energy.
+        :raise ValueError: not enough energy
+        :raise KeyError: there is no energy of the key
+        """
+        raise NotImplementedError
+
+    def _make_default(self, key):
+        if self.default is None:
+            raise KeyError(key)
+        return self.default()
+
+
+def _items(energies):
+    """Iterates pairs of keys and energies from a dict or pairs."""
+    if hasattr(energies, 'items'):
+        return energies.items()
+    return energies
+
+
+class MemoryEnergyStore(EnergyStore):
+    """An in-process :class:`EnergyStore`. Energies are kept as their binary
+    records so that an energy got from the store doesn't share its state with
+    the store.
+
+    .. versionadded:: 0.2
+    """
+
+    def __init__(self, default=None):
+        super(MemoryEnergyStore, self).__init__(default)
+        self._records = {}
+        self._lock = threading.Lock()
+
+    def get_many(self, keys):
+        records = self._records
+        rv = {}
+        with _timing('store_get_many'):
+            for key in keys:
+                try:
+                    rv[key] = _unpack_energy(Energy, records[key], 0)
+                except KeyError:
+                    pass
+        return rv
+
+    def put_many(self, energies):
+        with _timing('store_put_many'):
+            records = dict((key, _pack_energy(energy))
+                           for key, energy in _items(energies))
+            with self._lock:
+                self._records.update(records)
+
+    def use(self, key, quantity=1, time=None, force=False):
+        with _timing('store_use'):
+            with self._lock:
+                try:
+                    energy = _unpack_energy(Energy, self._records[key], 0)
+                except KeyError:
+                    energy = self._make_default(key)
+                energy.use(quantity, time, force)
+                self._records[key] = _pack_energy(energy)
+        return energy
+
+    def keys(self):
+        with self._lock:
+            return sorted(self._records)
+
+    def __len__(self):
+        return len(self._records)
+
+
+class SQLiteEnergyStore(EnergyStore):
+    """An :class:`EnergyStore` backed by SQLite. Each energy is a row which
+    has a column for each field. A bulk operation runs in one transaction.
+
+    :param database: a path of the database file or a
+                     :class:`sqlite3.Connection`
+    :param table: the name of the table. Defaults to ``'energy'``. The table is
+                  created if it doesn't exist.
+    :param default: a function which makes an energy for an unknown key.
+
+    The store manages the transactions by itself, so it sets
+    :attr:`~sqlite3.Connection.isolation_level` of the connection to ``None``
+    (autocommit) even if the connection is given. Don't share a given
+    connection with code which depends on the implicit transactions of
+    :mod:`sqlite3`.
+
+    The table also has an indexed ``full_at`` column which is the time in
+    seconds when the energy will be recovered fully. It is ``NULL`` if the
+    energy is full or over the maximum. The SQL functions of
+    :func:`register_sqlite_functions` are available on the connection.
+
+    .. versionadded:: 0.2
+    """
+
+    #: SQLite limits the number of host parameters in a query.
+    max_variables = 500
+
+    def __init__(self, database, table='energy', default=None):
+        super(SQLiteEnergyStore, self).__init__(default)
+        import sqlite3
+        if isinstance(database, sqlite3.Connection):
+            self.connection = database
+        else:
+            self.connection = sqlite3.connect(database,
+                                              check_same_thread=False)
+        # transactions are managed by the store.
+        self.connection.isolation_level = None
+        self.table = table
+        self._lock = threading.RLock()
+        # recovery_interval and future_tolerance have no type affinity to keep
+        # either int or float.
+        self._execute('CREATE TABLE IF NOT EXISTS %s ('
+                      'key PRIMARY KEY, used INTEGER NOT NULL, '
+                      'used_at INTEGER, max INTEGER NOT NULL, '
+                      'recovery_interval NOT NULL, '
+                      'recovery_quantity INTEGER NOT NULL, '
+                      'future_tolerance, '
+                      'resolution INTEGER NOT NULL DEFAULT 1, full_at)' %
+                      table)
+        self._execute('CREATE INDEX IF NOT EXISTS %s_full_at ON %s (full_at)' %
+                      (table, table))
+        register_sqlite_functions(self.connection)
+
+    _columns = ('used, used_at, max, recovery_interval, recovery_quantity, '
+                'future_tolerance, resolution')
+
+    def _execute(self, query, params=()):
+        return self.connection.execute(query, params)
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._execute('BEGIN IMMEDIATE')
+            try:
+                yield
+            except BaseException:
+                self._execute('ROLLBACK')
+                raise
+            self._execute('COMMIT')
+
+    def _put_rows(self, energies):
+        query = 'INSERT OR REPLACE INTO %s (key, %s, full_at) ' \
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)' % (self.table,
+                                                         self._columns)
+        self.connection.executemany(query, (
+            _energy_to_row(key, energy) for key, energy in energies))
+
+    def get_many(self, keys):
+        keys = list(keys)
+        rv = {}
+        with _timing('store_get_many'):
+            self._select_many(keys, rv)
+        return rv
+
+    def _select_many(self, keys, rv):
+        with self._lock:
+            for x in range(0, len(keys), self.max_variables):
+                chunk = keys[x:x + self.max_variables]
+                marks = ', '.join('?' * len(chunk))
+                query = 'SELECT key, %s FROM %s WHERE key IN (%s)' % \
+                        (self._columns, self.table, marks)
+                for row in self._execute(query, chunk):
+                    rv[row[0]] = _energy_from_row(row[1:])
+
+    def put_many(self, energies):
+        with _timing('store_put_many'):
+            with self._transaction():
+                self._put_rows(_items(energies))
+
+    def use(self, key, quantity=1, time=None, force=False):
+        query = 'SELECT %s FROM %s WHERE key = ?' % (self._columns, self.table)
+        with _timing('store_use'):
+            with self._transaction():
+                row = self._execute(query, (key,)).fetchone()
+                if row is None:
+                    energy = self._make_default(key)
+                else:
+                    energy = _energy_from_row(row)
+                energy.use(quantity, time, force)
+                self._put_rows([(key, energy)])
+        return energy
+
+    def keys(self):
+        query = 'SELECT key FROM %s ORDER BY key' % self.table
+        with self._lock:
+            return [row[0] for row in self._execute(query)]
+
+    def full_keys(self, start, end=None):
+        """Finds the keys of the energies which will be recovered fully between
+        `start` and `end`. If `end` is not given, it finds the energies which
+        will be recovered fully since `start`. The energies which are already
+        full at `start` are not included. It is an indexed range query.
+
+        :param start: the start time (exclusive)
+        :param end: the end time (inclusive)
+        """
+        start = timestamp(start)
+        query = 'SELECT key FROM %s WHERE full_at > ?' % self.table
+        params = [start]
+        if end is not None:
+            query += ' AND full_at <= ?'
+            params.append(timestamp(end))
+        query += ' ORDER BY full_at'
+        with self._lock:
+            return [row[0] for row in self._execute(query, params)]
+
+    def count_full(self, time=None):
+        """Counts the energies which are full or over the maximum at the
+        time.
+
+        :param time: the time when checking the energies. Defaults to the
+                     present time in UTC.
+        """
+        query = 'SELECT COUNT(*) FROM %s WHERE used <= 0 OR full_at <= ?' % \
+                self.table
+        with self._lock:
+            return self._execute(query, (timestamp(time),)).fetchone()[0]
+
+    def debt_keys(self, time=None):
+        """Finds the keys of the energies in debt at the time.
+
+        :param time: the time when checking the energies. Defaults to the
+                     present time in UTC.
+        """
+        # the time is in seconds but the energies count in their resolutions
+        query = 'SELECT key FROM %s WHERE full_at > ? AND ' \
+                'energy_debt(used, used_at, max, recovery_interval, ' \
+                'recovery_quantity, future_tolerance, ? * resolution) ' \
+                'IS NOT NULL' % self.table
+        time = timestamp(time)
+        with self._lock:
+            return [row[0] for row in self._execute(query, (time, time))]
+
+    def __len__(self):
+        query = 'SELECT COUNT(*) FROM %s' % self.table
+        return self._execute(query).fetchone()[0]
+
+    def close(self):
+        """Closes the connection."""
+        self.connection.close()
+
+
+class AsyncEnergyStore(object):
+    """An :mod:`asyncio` interface of :class:`EnergyStore`. Each method
+    returns an awaitable without blocking the event loop. The stores are
+    called in worker threads and are used as a bounded pool of connections.
+
+    ::
+
+       store = AsyncEnergyStore(partial(SQLiteEnergyStore, 'energy.db'))
+       energy = await store.use(player_id, timeout=0.5)
+
+    The calls in an iteration of the event loop are pipelined. They are sent
+    to a connection at once in order, and consecutive gets or puts are merged
+    into one :meth:`EnergyStore.get_many` or :meth:`EnergyStore.put_many`.
+
+    :param connect: a function which makes an :class:`EnergyStore` as a
+                    connection. The connections are made on demand and each
+                    is used by one thread at a time.
+    :param size: the maximum number of connections. Defaults to ``4``.
+    :param timeout: the default seconds to wait for each call. When a call
+                    times out, :exc:`asyncio.TimeoutError` is raised but the
+                    operation may still be done by the store.
+    :param loop: the event loop. Defaults to the running event loop of each
+                 call, so the store can be used across :func:`asyncio.run`.
+
+    .. versionadded:: 0.2
+    """
+
+    def __init__(self, connect, size=4, timeout=None, loop=None):
+        from concurrent.futures import ThreadPoolExecutor
+        self.connect = connect
+        self.size = size
+        self.timeout = timeout
+        self._loop = loop
+        self._executor = ThreadPoolExecutor(size)
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._made = []
+        # the calls to be sent in the current iteration of each event loop
+        self._calls = {}
+
+    def get(self, key, timeout=None):
+        """Gets the energy of the key. If there is no such energy, the result
+        is ``None``.
+        """
+        return self._call('get', [key], timeout)
+
+    def get_many(self, keys, timeout=None):
+        """Gets the energies of the keys at once. The result is a dict of the
+        found energies by their keys.
+        """
+        return self._call('get_many', list(keys), timeout)
+
+    def put(self, key, energy, timeout=None):
+        """Saves the energy of the key."""
+        return self.put_many({key: energy}, timeout)
+
+    def put_many(self, energies, timeout=None):
+        """Saves many energies at once.
+
+        :param energies: a dict or pairs of keys and energies
+        """
+        # copy the energies not to save the changes after the call
+        energies = [(key, Energy._restore(e.policy, e.used, e.used_at))
+                    for key, e in _items(energies)]
+        return self._call('put', energies, timeout)
+
+    def use(self, key, quantity=1, time=None, force=False, timeout=None):
+        """Consumes the energy of the key atomically. See
+        :meth:`EnergyStore.use`. The result is the used energy.
+        """
+        return self._call('use', (key, quantity, time, force), timeout)
+
+    def close(self):
+        """Waits for the sent calls and closes the connections. It blocks
+        until the calls are done. In the event loop, use :meth:`aclose`
+        instead.
+        """
+        self._executor.shutdown(wait=True)
+        for connection in self._made:
+            close = getattr(connection, 'close', None)
+            if close is not None:
+                close()
+        del self._made[:], self._connections[:]
+
+    def aclose(self):
+        """Sends the pending calls and closes the connections in a worker
+        thread without blocking the event loop. It returns an awaitable.
+        """
+        loop = self._get_loop()
+        self._flush(loop)
+        return loop.run_in_executor(None, self.close)
+
+    def _get_loop(self):
+        if self._loop is not None:
+            return self._loop
+        import asyncio
+        try:
+            return asyncio.get_running_loop()
+        except AttributeError:
+            # Python 3.6 and older
+            return asyncio.get_event_loop()
+
+    def _call(self, op, args, timeout):
+        import asyncio
+        loop = self._get_loop()
+        future = loop.create_future()
+        try:
+            calls = self._calls[loop]
+        except KeyError:
+            calls = self._calls[loop] = []
+            loop.call_soon(self._flush, loop)
+        calls.append((op, args, future))
+        if timeout is None:
+            timeout = self.timeout
+        if timeout is None:
+            return future
+        return asyncio.wait_for(future, timeout)
+
+    def _flush(self, loop):
+        calls = self._calls.pop(loop, None)
+        if not calls:
+            return
+        done = loop.run_in_executor(self._executor, self._send, calls)
+        done.add_done_callback(partial(self._resolve, calls))
+
+    def _resolve(self, calls, done):
+        exc = done.exception()
+        if exc is None:
+            results = done.result()
+        else:
+            results = [(None, exc)] * len(calls)
+        for (op, args, future), (result, exc) in zip(calls, results):
+            # the future may have been cancelled by the timeout
+            if future.done():
+                continue
+            if exc is None:
+                future.set_result(result)
+            else:
+                future.set_exception(exc)
+
+    #: consecutive calls of the same batch operation are merged.
+    _batch_ops = {'get': 'get', 'get_many': 'get', 'put': 'put', 'use': 'use'}
+
+    def _send(self, calls):
+        """Sends the calls to a connection in order. It runs in a worker
+        thread and returns a pair of the result and the exception for each
+        call.
+        """
+        with self._connections_lock:
+            try:
+                connection = self._connections.pop()
+            except IndexError:
+                connection = None
+        if connection is None:
+            connection = self.connect()
+            with self._connections_lock:
+                self._made.append(connection)
+        try:
+            rv = []
+            batches = itertools.groupby(
+                calls, lambda call: self._batch_ops[call[0]])
+            for op, batch in batches:
+                batch = list(batch)
+                if op == 'use':
+                    for op, args, future in batch:
+                        try:
+                            rv.append((connection.use(*args), None))
+                        except Exception:
+                            rv.append((None, sys.exc_info()[1]))
+                    continue
+                try:
+                    if op == 'put':
+                        connection.put_many(itertools.chain.from_iterable(
+                            args for op, args, future in batch))
+                        rv.extend([(None, None)] * len(batch))
+                    else:
+                        rv.extend(self._get_batch(connection, batch))
+                except Exception:
+                    rv.extend([(None, sys.exc_info()[1])] * len(batch))
+            return rv
+        finally:
+            with self._connections_lock:
+                self._connections.append(connection)
+
+    def _get_batch(self, connection, batch):
+        found = connection.get_many(set(itertools.chain.from_iterable(
+            args for op, args, future in batch)))
+        taken = set()
+        rv = []
+        for op, keys, future in batch:
+            energies = {}
+            for key in keys:
+                try:
+                    energy = found[key]
+                except KeyError:
+                    continue
+                if key in taken:
+                    # an energy should not be shared by the calls
+                    energy = Energy._restore(energy.policy, energy.used,
+                                             energy.used_at)
+                taken.add(key)
+                energies[key] = energy
+            if op == 'get':
+                rv.append((energies.get(keys[0]), None))
+            else:
+                rv.append((energies, None))
+        return rv
+
+
+def register_sqlite_functions(connection):
+    """Registers the SQL functions of energy on a SQLite connection. The
+    arguments are the fields of an energy in the order of
+    :meth:`Energy.__init__`. The time is a timestamp in the resolution of the
+    energy.
+
+    ``energy_current(used, used_at, max, recovery_interval, recovery_quantity,
+    future_tolerance, time)``
+       The same as :meth:`Energy.current`. ``NULL`` means the energy was used
+       at the future beyond the tolerance.
+
+    ``energy_debt(used, used_at, max, recovery_interval, recovery_quantity,
+    future_tolerance, time)``
+       The same as :meth:`Energy.debt`. ``NULL`` means no debt or the energy
+       was used at the future beyond the tolerance.
+
+    ``energy_full_at(used, used_at, recovery_interval, recovery_quantity)``
+       The time when the energy will be recovered fully. ``NULL`` means the
+       energy is full or over the maximum, or it never recovers.
+
+    >>> import sqlite3
+    >>> conn = sqlite3.connect(':memory:')
+    >>> register_sqlite_functions(conn)
+    >>> query = 'SELECT energy_current(3, 0, 10, 300, 1, NULL, 600)'
+    >>> conn.execute(query).fetchone()
+    (9,)
+
+    .. versionadded:: 0.2
+    """
+    for name, nargs, func in [
+            ('energy_current', 7, _sql_energy_current),
+            ('energy_debt', 7, _sql_energy_debt),
+            ('energy_full_at', 4, _full_at)]:
+        try:
+            connection.create_function(name, nargs, func, deterministic=True)
+        except (TypeError, NotImplementedError):
+            # deterministic is not supported
+            connection.create_function(name, nargs, func)
+
+
+def _internal_current(used, used_at, max, recovery_interval,
+                      recovery_quantity, future_tolerance, time):
+    """Calculates the current internal energy like :meth:`Energy._current`.
+    """
+    if not used:
+        return max
+    return _linear_current(used, _passed(used_at, future_tolerance, time),
+                           max, recovery_interval, recovery_quantity)
+
+
+def _sql_internal_current(*args):
+    """Calculates the current internal energy for the SQL functions. An energy
+    used at the future is ``None`` instead of an error which would abort the
+    whole query.
+    """
+    try:
+        return _internal_current(*args)
+    except ValueError:
+        return
+
+
+def _sql_energy_current(*args):
+    current = _sql_internal_current(*args)
+    if current is not None:
+        return max(0, current)
+
+
+def _sql_energy_debt(*args):
+    current = _sql_internal_current(*args)
+    if current is not None and current < 0:
+        return -current
+
+
+def _full_at(used, used_at, recovery_interval, recovery_quantity):
+    """Calculates the time when the energy will be recovered fully. That is
+    when :meth:`Energy.current` reaches the maximum.
+    """
+    if used <= 0 or used_at is None:
+        return
+    ticks = -(-used // recovery_quantity)
+    return used_at + ticks * recovery_interval
+
+
+def _energy_full_at(energy):
+    """Calculates the time in seconds when the energy will be recovered fully.
+    It is rounded up to an integer to be compared with other energies.
+    """
+    policy = energy.policy
+    used, used_at = energy.used, energy.used_at
+    if used <= 0 or used_at is None:
+        return
+    if policy.schedule is not None:
+        full_at = policy.schedule.recovered_at(used_at, used,
+                                               policy.recovery_interval,
+                                               policy.recovery_quantity)
+    else:
+        full_at = _full_at(used, used_at, policy.recovery_interval,
+                           policy.recovery_quantity)
+    # -(-x // y) is the ceiling of x / y
+    return int(-(-full_at // policy.resolution))
+
+
+def _energy_to_row(key, energy):
+    policy = energy.policy
+    _check_unscheduled(policy)
+    full_at = _energy_full_at(energy)
+    return (key, energy.used, energy.used_at, policy.max,
+            policy.recovery_interval, policy.recovery_quantity,
+            policy.future_tolerance, policy.resolution, full_at)
+
+
+def _energy_from_row(row):
+    used, used_at, max, recovery_interval, recovery_quantity, \
+        future_tolerance, resolution = row
+    policy = EnergyPolicy(max, recovery_interval, recovery_quantity,
+                          future_tolerance, resolution)
+    return Energy._restore(policy, used, used_at)
+
+
+class RecoveryScheduler(object):
+    """Calls back when energies recover, for push notifications. The next event
+    of each energy is calculated by :meth:`Energy.recover_in` or
+    :meth:`Energy.recover_fully_in` and kept in a heap, so no energy is
+    polled.
+
+    :param on_full: a function to be called with the key and the energy when
+                    the energy is recovered fully.
+    :param on_recover: a function to be called with the key and the energy
+                       whenever the energy recovers. If it is not given, only
+                       the full recovery is scheduled.
+
+    Events are fired by :meth:`run_pending` or by an :mod:`asyncio` event loop
+    after :meth:`start`.
+
+    .. versionadded:: 0.2
+    """
+
+    def __init__(self, on_full=None, on_recover=None):
+        self.on_full = on_full
+        self.on_recover = on_recover
+        self._heap = []
+        self._entries = {}
+        self._counter = itertools.count()
+        self._loop = None
+        self._handle = None
+
+    def schedule(self, key, energy, time=None):
+        """Schedules the next event of the energy. Call it again whenever the
+        energy is changed outside of the scheduler. The previous event of the
+        key is cancelled.
+
+        :param key: the key of the energy
+        :param energy: the energy to be watched
+        :param time: the time when the energy was changed. Defaults to the
+                     present time in UTC.
+        """
+        self.cancel(key)
+        resolution = energy.policy.resolution
+        time = timestamp(time, resolution=resolution)
+        if self.on_recover is None:
+            ticks = energy.recover_fully_in(time)
+        else:
+            ticks = energy.recover_in(time)
+        if ticks is None:
+            return
+        when = time + ticks
+        if resolution != 1:
+            # the events are scheduled in seconds
+            when = -(-when // resolution)
+        entry = [when, next(self._counter), key, energy]
+        self._entries[key] = entry
+        heapq.heappush(self._heap, entry)
+        if self._loop is not None and self._heap[0] is entry:
+            self._arm()
+
+    def cancel(self, key):
+        """Cancels the scheduled event of the key. The cancelled entry is
+        removed from the heap lazily.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        entry[2] = entry[3] = None
+        # rebuild the heap not to keep too many cancelled entries
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            self._heap[:] = [e for e in self._heap if e[3] is not None]
+            heapq.heapify(self._heap)
+
+    def use(self, key, energy, quantity=1, time=None, force=False):
+        """Uses the energy and reschedules it. See :meth:`Energy.use`."""
+        time = timestamp(time, resolution=energy.policy.resolution)
+        energy.use(quantity, time, force)
+        self.schedule(key, energy, time)
+
+    def set(self, key, energy, quantity, time=None):
+        """Sets the energy and reschedules it. See :meth:`Energy.set`."""
+        time = timestamp(time, resolution=energy.policy.resolution)
+        energy.set(quantity, time)
+        self.schedule(key, energy, time)
+
+    def config(self, key, energy, max=None, recovery_interval=None,
+               time=None):
+        """Configures the energy and reschedules it. See
+        :meth:`Energy.config`.
+        """
+        time = timestamp(time, resolution=energy.policy.resolution)
+        energy.config(max, recovery_interval, time)
+        self.schedule(key, energy, time)
+
+    def next_time(self):
+        """The time of the earliest event. ``None`` if there is no event."""
+        heap = self._heap
+        while heap and heap[0][3] is None:
+            heapq.heappop(heap)
+        if heap:
+            return heap[0][0]
+
+    def run_pending(self, time=None):
+        """Fires every event until the time.
+
+        :param time: the time until. Defaults to the present time in UTC.
+        :returns: the number of the fired events.
+        """
+        time = timestamp(time)
+        heap = self._heap
+        fired = 0
+        while heap and heap[0][0] <= time:
+            when, __, key, energy = heapq.heappop(heap)
+            if energy is None:
+                continue
+            del self._entries[key]
+            fired += 1
+            if self.on_recover is not None:
+                self.on_recover(key, energy)
+            when *= energy.policy.resolution
+            if energy.recover_in(when) is None:
+                if self.on_full is not None:
+                    self.on_full(key, energy)
+            elif key not in self._entries:
+                self.schedule(key, energy, when)
+        return fired
+
+    def start(self, loop=None):
+        """Starts to fire events on an :mod:`asyncio` event loop.
+
+        :param loop: the event loop. Defaults to the current event loop.
+        """
+        if loop is None:
+            import asyncio
+            loop = asyncio.get_event_loop()
+        self._loop = loop
+        self._arm()
+
+    def stop(self):
+        """Stops to fire events on the event loop."""
+        if self._handle is not None:
+            self._handle.cancel()
+        self._loop = self._handle = None
+
+    def _arm(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        when = self.next_time()
+        if when is None:
+            return
+        delay = max(0, when - timestamp())
+        self._handle = self._loop.call_later(delay, self._wake)
+
+    def _wake(self):
+        self._handle = None
+        self.run_pending()
+        if self._loop is not None:
+            self._arm()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+
+if _INT64 is None:
+    _int64_array = list
+else:
+    _int64_array = partial(array, _INT64)
+
+
+class RecoveryIndex(object):
+    """An in-memory index of energies by the time when they will be recovered
+    fully. It answers range queries and counts by bisection without scanning
+    every energy.
+
+    The times are kept in sorted buckets of 64-bit integer arrays, so an
+    update costs about O(log n) and an entry takes about 120 bytes including
+    the key and the dict entry. The sizes of the buckets are summed by a
+    Fenwick tree to count in O(log n) too.
+
+    >>> index = RecoveryIndex()
+    >>> index.use('alice', Energy(10, 60), 3, time=0)
+    >>> index.full_keys(0, 180)
+    ['alice']
+
+    The times are in seconds.
+
+    .. versionadded:: 0.2
+    """
+
+    #: The number of entries in a bucket. A bucket is split when it has twice
+    #: as many entries.
+    load = 1000
+
+    def __init__(self):
+        # the last time of each bucket
+        self._maxes = []
+        self._times = []
+        self._keys = []
+        # the Fenwick tree of the sizes of the buckets
+        self._sizes = []
+        self._index = {}
+        # the full energies and the energies which never recover
+        self._full = set()
+        self._never = set()
+
+    def update(self, key, energy):
+        """Indexes the energy of the key again. Call it whenever the energy is
+        changed outside of the index.
+        """
+        self.remove(key)
+        full_at = _energy_full_at(energy)
+        if full_at is not None:
+            self._index[key] = full_at
+            self._insert(full_at, key)
+        elif energy.used > 0:
+            self._never.add(key)
+        else:
+            self._full.add(key)
+
+    def remove(self, key):
+        """Removes the key from the index. It does nothing for an unknown
+        key.
+        """
+        try:
+            full_at = self._index.pop(key)
+        except KeyError:
+            self._full.discard(key)
+            self._never.discard(key)
+            return
+        self._delete(full_at, key)
+
+    def use(self, key, energy, quantity=1, time=None, force=False):
+        """Uses the energy and indexes it again. See :meth:`Energy.use`."""
+        energy.use(quantity, time, force)
+        self.update(key, energy)
+
+    def set(self, key, energy, quantity, time=None):
+        """Sets the energy and indexes it again. See :meth:`Energy.set`."""
+        energy.set(quantity, time)
+        self.update(key, energy)
+
+    def config(self, key, energy, max=None, recovery_interval=None,
+               time=None):
+        """Configures the energy and indexes it again. See
+        :meth:`Energy.config`.
+        """
+        energy.config(max, recovery_interval, time)
+        self.update(key, energy)
+
+    def full_at(self, key):
+        """The time when the energy of the key will be recovered fully.
+        ``None`` if the energy is full or never recovers.
+
+        :raise KeyError: unknown key
+        """
+        try:
+            return self._index[key]
+        except KeyError:
+            if key in self._full or key in self._never:
+                return
+            raise
+
+    def full_keys(self, start, end=None):
+        """Finds the keys of the energies which will be recovered fully between
+        `start` and `end` in order. If `end` is not given, it finds the
+        energies which will be recovered fully since `start`. The energies
+        which are already full at `start` are not included.
+
+        :param start: the start time (exclusive)
+        :param end: the end time (inclusive)
+        """
+        start = timestamp(start)
+        if end is not None:
+            end = timestamp(end)
+        rv = []
+        x = bisect_right(self._maxes, start)
+        for times, keys in zip(self._times[x:], self._keys[x:]):
+            lo = bisect_right(times, start)
+            if end is None:
+                rv.extend(keys[lo:])
+                continue
+            hi = bisect_right(times, end)
+            rv.extend(keys[lo:hi])
+            if hi < len(times):
+                break
+        return rv
+
+    def count(self, start, end):
+        """Counts the energies which will be recovered fully between `start`
+        (exclusive) and `end` (inclusive).
+        """
+        return self._rank(timestamp(end)) - self._rank(timestamp(start))
+
+    def count_full(self, time=None):
+        """Counts the energies which are full or over the maximum at the
+        time.
+
+        :param time: the time when checking the energies. Defaults to the
+                     present time in UTC.
+        """
+        return len(self._full) + self._rank(timestamp(time))
+
+    def _rank(self, time):
+        """Counts the indexed times until the time."""
+        x = bisect_right(self._maxes, time)
+        # the sum of the sizes of the buckets before x
+        rank = 0
+        sizes, y = self._sizes, x - 1
+        while y >= 0:
+            rank += sizes[y]
+            y = (y & (y + 1)) - 1
+        if x < len(self._times):
+            rank += bisect_right(self._times[x], time)
+        return rank
+
+    def _resize(self, x, delta):
+        """Adds the delta to the size of the bucket."""
+        sizes = self._sizes
+        while x < len(sizes):
+            sizes[x] += delta
+            x |= x + 1
+
+    def _rebuild(self):
+        """Builds the Fenwick tree again after the buckets are changed."""
+        sizes = [len(times) for times in self._times]
+        for x in range(len(sizes)):
+            parent = x | (x + 1)
+            if parent < len(sizes):
+                sizes[parent] += sizes[x]
+        self._sizes = sizes
+
+    def _insert(self, full_at, key):
+        maxes = self._maxes
+        if not maxes:
+            self._times.append(_int64_array([full_at]))
+            self._keys.append([key])
+            maxes.append(full_at)
+            self._rebuild()
+            return
+        x = min(bisect_left(maxes, full_at), len(maxes) - 1)
+        times, keys = self._times[x], self._keys[x]
+        y = bisect_right(times, full_at)
+        times.insert(y, full_at)
+        keys.insert(y, key)
+        maxes[x] = times[-1]
+        if len(times) > 2 * self.load:
+            half = len(times) // 2
+            self._times[x:x + 1] = [times[:half], times[half:]]
+            self._keys[x:x + 1] = [keys[:half], keys[half:]]
+            maxes[x:x + 1] = [times[half - 1], times[-1]]
+            self._rebuild()
+        else:
+            self._resize(x, 1)
+
+    def _delete(self, full_at, key):
+        maxes = self._maxes
+        # the same time may continue over buckets
+        x = bisect_left(maxes, full_at)
+        while x < len(maxes):
+            times, keys = self._times[x], self._keys[x]
+            lo = bisect_left(times, full_at)
+            hi = bisect_right(times, full_at)
+            try:
+                y = keys.index(key, lo, hi)
+            except ValueError:
+                if hi < len(times):
+                    return
+                x += 1
+                continue
+            del times[y]
+            del keys[y]
+            if times:
+                maxes[x] = times[-1]
+                self._resize(x, -1)
+            else:
+                del self._times[x], self._keys[x], maxes[x]
+                self._rebuild()
+            return
+
+    def __len__(self):
+        return len(self._index) + len(self._full) + len(self._never)
+
+    def __contains__(self, key):
+        return key in self._index or key in self._full or key in self._never
+
+
+class EnergyJournal(object):
+    """An append-only journal of energy operations in a memory-mapped file. It
+    keeps the energies in memory and appends a compact record for each
+    :meth:`put`, :meth:`use`, :meth:`set`, :meth:`reset` and :meth:`config`.
+    Opening the journal again rebuilds the energies by replaying the records
+    with the :class:`Energy` methods. An energy which is not made by `default`
+    should be added by :meth:`put`.
+
+    :meth:`snapshot` saves every energy into a snapshot file and truncates the
+    journal, so recovery replays only the records after the snapshot.
+
+    Records are written into the memory map and flushed to the disk by
+    :meth:`commit` at once. It commits automatically every `group_size`
+    operations.
+
+    :param path: the path of the journal file. The snapshot is saved at
+                 ``path + '.snapshot'``.
+    :param default: a function which makes an energy for an unknown key.
+    :param group_size: the number of operations to commit at once. Defaults
+                       to ``1000``. ``None`` means manual commit only.
+    :param segment_size: the initial size of the journal file in bytes.
+
+    Keys should be ``str`` or ``int``.
+
+    .. versionadded:: 0.2
+    """
+
+    _header = struct.Struct('!4sBxxxQ')
+    # op, flags, length of key, time, quantity or max, recovery_interval or
+    # float quantity. The key follows and the binary record of an energy
+    # follows the key of put.
+    _entry = struct.Struct('!BBHqqd')
+
+    _magic = b'EJNL'
+    _version = 1
+
+    # operations
+    _USE, _SET, _RESET, _CONFIG, _PUT = 1, 2, 3, 4, 5
+
+    # flags
+    _FORCE = 1 << 0
+    _INT_KEY = 1 << 1
+    _HAS_MAX = 1 << 2
+    _HAS_RECOVERY_INTERVAL = 1 << 3
+    _INT_RECOVERY_INTERVAL = 1 << 4
+    _FLOAT_QUANTITY = 1 << 5
+
+    def __init__(self, path, default=None, group_size=1000,
+                 segment_size=1 << 20):
+        self.path = path
+        self.snapshot_path = path + '.snapshot'
+        self.default = default
+        self.group_size = group_size
+        self.energies = {}
+        self._pending = 0
+        self._lock = threading.RLock()
+        epoch = self._load_snapshot()
+        self._open(max(segment_size, self._header.size + 1))
+        journal_epoch = self._header.unpack_from(self._map)[2]
+        if journal_epoch < epoch:
+            # the journal is older than the snapshot
+            self._truncate(epoch)
+        else:
+            self._replay()
+
+    def _open(self, segment_size):
+        import mmap
+        import os
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 420)  # 0644
+        self._file = os.fdopen(fd, 'r+b')
+        size = os.fstat(fd).st_size
+        new = size < self._header.size
+        if size < segment_size:
+            self._file.truncate(segment_size)
+            size = segment_size
+        self._map = mmap.mmap(fd, size)
+        if new:
+            self._header.pack_into(self._map, 0, self._magic, self._version,
+                                   0)
+        magic, version, __ = self._header.unpack_from(self._map)
+        if magic != self._magic or version != self._version:
+            raise ValueError('Not an energy journal: %r' % self.path)
+        self._offset = self._header.size
+
+    def _grow(self, size):
+        new_size = len(self._map)
+        while new_size < size:
+            new_size *= 2
+        self._map.flush()
+        self._file.truncate(new_size)
+        self._map.resize(new_size)
+
+    def _replay(self):
+        entry = self._entry
+        offset = self._header.size
+        data = self._map
+        while offset + entry.size <= len(data):
+            op, flags, keylen, time, a, b = entry.unpack_from(data, offset)
+            key_end = offset + entry.size + keylen
+            end = key_end + (_record.size if op == self._PUT else 0)
+            if not op or end > len(data):
+                break
+            key = data[offset + entry.size:key_end].decode('utf-8')
+            if flags & self._INT_KEY:
+                key = int(key)
+            if op == self._PUT:
+                self.energies[key] = _unpack_energy(Energy, data, key_end)
+            else:
+                self._apply(op, flags, key, time, a, b)
+            offset = end
+        self._offset = offset
+
+    def _apply(self, op, flags, key, time, a, b):
+        energy = self._energy(key)
+        quantity = b if flags & self._FLOAT_QUANTITY else a
+        if op == self._USE:
+            energy.use(quantity, time, bool(flags & self._FORCE))
+        elif op == self._SET:
+            energy.set(quantity, time)
+        elif op == self._RESET:
+            energy.reset(time)
+        elif op == self._CONFIG:
+            max = a if flags & self._HAS_MAX else None
+            recovery_interval = None
+            if flags & self._HAS_RECOVERY_INTERVAL:
+                recovery_interval = b
+                if flags & self._INT_RECOVERY_INTERVAL:
+                    recovery_interval = int(b)
+            energy.config(max, recovery_interval, time)
+        else:
+            raise ValueError('Unknown operation: %d' % op)
+        return energy
+
+    def _energy(self, key):
+        try:
+            return self.energies[key]
+        except KeyError:
+            if self.default is None:
+                raise KeyError(key)
+            energy = self.energies[key] = self.default()
+            return energy
+
+    def _write(self, op, flags, key, time, a=0, b=0.0, record=b''):
+        """Writes a record at the end without appending it yet. It returns
+        the size of the record. Until :meth:`_advance`, the record is not
+        replayed because the end mark is not moved.
+        """
+        if isinstance(key, int):
+            flags |= self._INT_KEY
+            key = str(key)
+        key = key.encode('utf-8')
+        # pack first to fail before touching the memory map
+        data = self._entry.pack(op, flags, len(key), time, a, b) + \
+            key + record
+        size = len(data)
+        # keep a zero-filled entry after the record as the end mark
+        if self._offset + size + self._entry.size > len(self._map):
+            self._grow(self._offset + size + self._entry.size)
+        self._map[self._offset:self._offset + size] = data
+        return size
+
+    def _discard(self, size):
+        """Erases a written record which is not appended."""
+        self._map[self._offset:self._offset + size] = b'\0' * size
+
+    def _advance(self, size):
+        """Appends the written record."""
+        self._offset += size
+        self._pending += 1
+        if self.group_size is not None and self._pending >= self.group_size:
+            self.commit()
+
+    def _operate(self, op, flags, key, time, a=0, b=0.0):
+        with self._lock:
+            # record the time in the resolution of the energy
+            time = self._energy(key)._timestamp(time)
+            # the energy changes only if the record has been written, and the
+            # record is appended only if the energy has changed
+            size = self._write(op, flags, key, time, a, b)
+            try:
+                energy = self._apply(op, flags, key, time, a, b)
+            except BaseException:
+                self._discard(size)
+                raise
+            self._advance(size)
+        return energy
+
+    def _quantity(self, flags, quantity):
+        """Makes the fields of a quantity. A float quantity is kept in the
+        float field.
+        """
+        if isinstance(quantity, float):
+            return flags | self._FLOAT_QUANTITY, 0, quantity
+        return flags, quantity, 0.0
+
+    def get(self, key):
+        """Gets the energy of the key. Don't change the energy directly."""
+        return self.energies.get(key)
+
+    def put(self, key, energy):
+        """Adds or replaces the energy of the key and appends the binary
+        record of the energy. The energy is kept by the journal, so don't
+        change it directly after.
+        """
+        record = _pack_energy(energy)
+        with self._lock:
+            self._advance(self._write(self._PUT, 0, key, 0, record=record))
+            self.energies[key] = energy
+
+    def use(self, key, quantity=1, time=None, force=False):
+        """Uses the energy of the key and appends the operation. See
+        :meth:`Energy.use`.
+        """
+        flags, a, b = self._quantity(self._FORCE if force else 0, quantity)
+        return self._operate(self._USE, flags, key, time, a, b)
+
+    def set(self, key, quantity, time=None):
+        """Sets the energy of the key and appends the operation. See
+        :meth:`Energy.set`.
+        """
+        flags, a, b = self._quantity(0, quantity)
+        return self._operate(self._SET, flags, key, time, a, b)
+
+    def reset(self, key, time=None):
+        """Resets the energy of the key and appends the operation. See
+        :meth:`Energy.reset`.
+        """
+        return self._operate(self._RESET, 0, key, time)
+
+    def config(self, key, max=None, recovery_interval=None, time=None):
+        """Configures the energy of the key and appends the operation. See
+        :meth:`Energy.config`.
+        """
+        params = {}
+        if max is not None:
+            params['max'] = max
+        if recovery_interval is not None:
+            params['recovery_interval'] = recovery_interval
+        # validate and convert the parameters like Energy such as a timedelta
+        # in the resolution of the energy
+        with self._lock:
+            policy = self._energy(key).policy.replace(**params)
+        flags = 0
+        a, b = 0, 0.0
+        if max is not None:
+            flags |= self._HAS_MAX
+            a = max
+        if recovery_interval is not None:
+            recovery_interval = policy.recovery_interval
+            flags |= self._HAS_RECOVERY_INTERVAL
+            if isinstance(recovery_interval, int):
+                flags |= self._INT_RECOVERY_INTERVAL
+            b = recovery_interval
+        return self._operate(self._CONFIG, flags, key, time, a, b)
+
+    def commit(self):
+        """Flushes the appended records to the disk at once."""
+        with self._lock:
+            if self._pending:
+                self._map.flush()
+                self._pending = 0
+
+    def snapshot(self):
+        """Saves every energy into the snapshot file and truncates the
+        journal.
+        """
+        import os
+        with self._lock:
+            self.commit()
+            epoch = self._header.unpack_from(self._map)[2] + 1
+            tmp_path = self.snapshot_path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(self._header.pack(self._magic, self._version, epoch))
+                f.write(struct.pack('!Q', len(self.energies)))
+                for key, energy in self.energies.items():
+                    flags = 0
+                    if isinstance(key, int):
+                        flags |= self._INT_KEY
+                        key = str(key)
+                    key = key.encode('utf-8')
+                    f.write(struct.pack('!BH', flags, len(key)))
+                    f.write(key)
+                    f.write(_pack_energy(energy))
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_path, self.snapshot_path)
+            self._truncate(epoch)
+
+    def _load_snapshot(self):
+        try:
+            f = open(self.snapshot_path, 'rb')
+        except IOError:
+            return 0
+        with f:
+            data = f.read()
+        magic, version, epoch = self._header.unpack_from(data)
+        if magic != self._magic or version != self._version:
+            raise ValueError('Not an energy snapshot: %r' %
+                             self.snapshot_path)
+        offset = self._header.size
+        count = struct.unpack_from('!Q', data, offset)[0]
+        offset += 8
+        for x in range(count):
+            flags, keylen = struct.unpack_from('!BH', data, offset)
+            offset += 3
+            key = data[offset:offset + keylen].decode('utf-8')
+            if flags & self._INT_KEY:
+                key = int(key)
+            offset += keylen
+            self.energies[key] = _unpack_energy(Energy, data, offset)
+            offset += _record.size
+        return epoch
+
+    def _truncate(self, epoch):
+        self._map[:] = b'\0' * len(self._map)
+        self._header.pack_into(self._map, 0, self._magic, self._version,
+                               epoch)
+        self._map.flush()
+        self._offset = self._header.size
+        self._pending = 0
+
+    def close(self):
+        """Commits and closes the journal."""
+        with self._lock:
+            self.commit()
+            self._map.close()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class SharedEnergyTable(object):
+    """A fixed-size table of energies in a memory-mapped file. Pre-forked
+    worker processes which open the same file share the energies. Every
+    process sees a change at once and the memory doesn't grow with the
+    workers.
+
+    Each slot holds the key, :attr:`Energy.used`, :attr:`Energy.used_at` and
+    the index of the policy. The slots are indexed by open addressing with
+    linear probing. A slot is locked by :func:`fcntl.lockf` while it is
+    changed, so operations on the same key are atomic across processes.
+
+    :param path: the path of the table file
+    :param capacity: the number of the slots. It is used only when the file
+                     is created.
+    :param policies: the list of :class:`EnergyPolicy` objects. Every process
+                     should pass the same list.
+
+    Keys should be non-zero 64-bit integers such as player ids. Entries can't
+    be removed.
+
+    .. versionadded:: 0.2
+    """
+
+    _header = struct.Struct('!4sBxxxQ')
+    # key, used, used_at, policy index + 1 (0 means an empty slot)
+    _slot = struct.Struct('!qqqi')
+
+    _magic = b'ESHT'
+    _version = 1
+    _none = -1 << 63
+
+    def __init__(self, path, capacity=1 << 16, policies=()):
+        import mmap
+        import os
+        self.path = path
+        self.policies = list(policies)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 420)  # 0644
+        self._file = os.fdopen(fd, 'r+b')
+        self._lock_file(0, self._header.size)
+        try:
+            size = os.fstat(fd).st_size
+            if size == 0:
+                size = self._header.size + self._slot.size * capacity
+                self._file.truncate(size)
+                self._file.seek(0)
+                self._file.write(self._header.pack(self._magic, self._version,
+                                                   capacity))
+                self._file.flush()
+        finally:
+            self._unlock_file(0, self._header.size)
+        self._map = mmap.mmap(fd, size)
+        magic, version, self.capacity = self._header.unpack_from(self._map)
+        if magic != self._magic or version != self._version:
+            raise ValueError('Not an energy table: %r' % path)
+        self._thread_locks = [threading.Lock() for x in range(64)]
+
+    def _lock_file(self, offset, size):
+        if fcntl is not None:
+            fcntl.lockf(self._file.fileno(), fcntl.LOCK_EX, size, offset)
+
+    def _unlock_file(self, offset, size):
+        if fcntl is not None:
+            fcntl.lockf(self._file.fileno(), fcntl.LOCK_UN, size, offset)
+
+    @contextmanager
+    def _locking(self, index):
+        offset = self._header.size + index * self._slot.size
+        # POSIX record locks don't exclude the threads of a process.
+        with self._thread_locks[index % len(self._thread_locks)]:
+            self._lock_file(offset, self._slot.size)
+            try:
+                yield offset
+            finally:
+                self._unlock_file(offset, self._slot.size)
+
+    def _probe(self, key):
+        """Yields the slot indices to find the key."""
+        capacity = self.capacity
+        start = ((key * 0x9e3779b97f4a7c15) & 0xffffffffffffffff) % capacity
+        for x in range(capacity):
+            yield (start + x) % capacity
+
+    def _find(self, key, policy=None):
+        """Finds the slot index of the key. If `policy` is given and the key
+        is unknown, an empty slot is claimed for a full energy of the policy.
+        """
+        if not key:
+            raise ValueError('Key should be a non-zero integer')
+        slot = self._slot
+        data = self._map
+        for index in self._probe(key):
+            offset = self._header.size + index * slot.size
+            found_key, __, __, policy_index = slot.unpack_from(data, offset)
+            if policy_index:
+                if found_key == key:
+                    return index
+                continue
+            if policy is None:
+                return
+            with self._locking(index):
+                found_key, __, __, policy_index = slot.unpack_from(data,
+                                                                   offset)
+                if not policy_index:
+                    slot.pack_into(data, offset, key, 0, self._none,
+                                   self.policies.index(policy) + 1)
+                    return index
+                elif found_key == key:
+                    return index
+        if policy is not None:
+            raise ValueError('The table is full')
+
+    def _read(self, offset):
+        key, used, used_at, policy_index = self._slot.unpack_from(self._map,
+                                                                  offset)
+        if not policy_index:
+            return
+        if used_at == self._none:
+            used_at = None
+        return Energy._restore(self.policies[policy_index - 1], used, used_at)
+
+    def _write(self, offset, key, energy):
+        used_at = energy.used_at
+        if used_at is None:
+            used_at = self._none
+        policy_index = self.policies.index(energy.policy) + 1
+        self._slot.pack_into(self._map, offset, key, energy.used, used_at,
+                             policy_index)
+
+    def get(self, key):
+        """Gets a copy of the energy of the key. If there is no such energy,
+        it returns ``None``.
+        """
+        index = self._find(key)
+        if index is None:
+            return
+        with self._locking(index) as offset:
+            return self._read(offset)
+
+    def put(self, key, energy):
+        """Saves the energy of the key. The policy of the energy should be
+        one of :attr:`policies`.
+        """
+        index = self._find(key, energy.policy)
+        with self._locking(index) as offset:
+            self._write(offset, key, energy)
+
+    def _update(self, key, policy, method, *args):
+        index = self._find(key, policy)
+        if index is None:
+            raise KeyError(key)
+        with self._locking(index) as offset:
+            energy = self._read(offset)
+            getattr(energy, method)(*args)
+            self._write(offset, key, energy)
+        return energy
+
+    def use(self, key, quantity=1, time=None, force=False, policy=None):
+        """Uses the energy of the key atomically. See :meth:`Energy.use`.
+
+        :param policy: the policy to make a new energy if the key is unknown.
+                       If it is not given, an unknown key raises
+                       :exc:`KeyError`.
+        :returns: a copy of the used energy.
+        """
+        return self._update(key, policy, 'use', quantity, time, force)
+
+    def set(self, key, quantity, time=None, policy=None):
+        """Sets the energy of the key atomically. See :meth:`Energy.set`."""
+        return self._update(key, policy, 'set', quantity, time)
+
+    def current(self, key, time=None):
+        """Calculates the current energy of the key. See
+        :meth:`Energy.current`.
+        """
+        energy = self.get(key)
+        if energy is None:
+            raise KeyError(key)
+        return energy.current(time)
+
+    def status(self, key, time=None):
+        """Calculates the status of the energy of the key. See
+        :meth:`Energy.status`.
+        """
+        energy = self.get(key)
+        if energy is None:
+            raise KeyError(key)
+        return energy.status(time)
+
+    def close(self):
+        """Closes the table."""
+        self._map.close()
+        self._file.close()
+
+
+class EnergyPool(object):
+    """A thread-safe pool of energies keyed by player id. The keys are spread
+    over lock-striped shards, so threads operating on different keys rarely
+    wait for each other. An operation on a key is atomic.
+
+    :param shards: the number of the shards. Defaults to ``64``.
+    :param default: a function which makes an energy for an unknown key. If it
+                    is not given, an unknown key raises :exc:`KeyError`.
+
+    .. versionadded:: 0.2
+    """
+
+    def __init__(self, shards=64, default=None):
+        self.default = default
+        self._shards = [({}, threading.Lock()) for x in range(shards)]
+
+    def _shard(self, key):
+        return self._shards[hash(key) % len(self._shards)]
+
+    def _group(self, keys):
+        """Groups the keys by their shards."""
+        groups = {}
+        size = len(self._shards)
+        for key in keys:
+            groups.setdefault(hash(key) % size, []).append(key)
+        return [(self._shards[x], keys) for x, keys in groups.items()]
+
+    def _energy(self, energies, key):
+        try:
+            return energies[key]
+        except KeyError:
+            if self.default is None:
+                raise KeyError(key)
+            energy = energies[key] = self.default()
+            return energy
+
+    def _call(self, key, method, *args):
+        energies, lock = self._shard(key)
+        with lock:
+            energy = self._energy(energies, key)
+            return getattr(energy, method)(*args)
+
+    def get(self, key):
+        """Gets a copy of the energy of the key. If there is no such energy,
+        it returns ``None``.
+        """
+        energies, lock = self._shard(key)
+        with lock:
+            energy = energies.get(key)
+            if energy is not None:
+                return Energy._restore(energy.policy, energy.used,
+                                       energy.used_at)
+
+    def put(self, key, energy):
+        """Puts the energy of the key. The pool owns the energy after that."""
+        energies, lock = self._shard(key)
+        with lock:
+            energies[key] = energy
+
+    def use(self, key, quantity=1, time=None, force=False):
+        """Uses the energy of the key atomically. See :meth:`Energy.use`."""
+        self._call(key, 'use', quantity, time, force)
+
+    def try_use(self, key, quantity=1, time=None, force=False):
+        """Tries to use the energy of the key atomically. See
+        :meth:`Energy.try_use`.
+        """
+        return self._call(key, 'try_use', quantity, time, force)
+
+    def set(self, key, quantity, time=None):
+        """Sets the energy of the key atomically. See :meth:`Energy.set`."""
+        self._call(key, 'set', quantity, time)
+
+    def reset(self, key, time=None):
+        """Resets the energy of the key atomically. See
+        :meth:`Energy.reset`.
+        """
+        self._call(key, 'reset', time)
+
+    def config(self, key, max=None, recovery_interval=None, time=None):
+        """Configures the energy of the key atomically. See
+        :meth:`Energy.config`.
+        """
+        self._call(key, 'config', max, recovery_interval, time)
+
+    def status(self, key, time=None):
+        """Calculates the status of the energy of the key. See
+        :meth:`Energy.status`.
+        """
+        return self._call(key, 'status', time)
+
+    def put_many(self, energies):
+        """Puts many energies. Each shard is locked once.
+
+        :param energies: a dict or pairs of keys and energies
+        """
+        energies = dict(_items(energies))
+        for (shard, lock), keys in self._group(energies):
+            with lock:
+                for key in keys:
+                    shard[key] = energies[key]
+
+    def try_use_many(self, quantities, time=None, force=False):
+        """Tries to use many energies at a time. Each shard is locked once.
+
+        :param quantities: a dict or pairs of keys and quantities
+        :returns: a dict of :class:`UseResult` by the keys.
+        """
+        quantities = dict(_items(quantities))
+        rv = {}
+        with frozen_now():
+            for (shard, lock), keys in self._group(quantities):
+                with lock:
+                    for key in keys:
+                        energy = self._energy(shard, key)
+                        rv[key] = energy.try_use(quantities[key], time, force)
+        return rv
+
+    def status_many(self, keys, time=None):
+        """Calculates the statuses of many energies at a time. Each shard is
+        locked once. Unknown keys are omitted.
+
+        :returns: a dict of :class:`EnergyStatus` by the keys.
+        """
+        rv = {}
+        with frozen_now():
+            for (shard, lock), keys in self._group(keys):
+                with lock:
+                    for key in keys:
+                        try:
+                            energy = shard[key]
+                        except KeyError:
+                            continue
+                        rv[key] = energy.status(time)
+        return rv
+
+    def __len__(self):
+        return sum(len(energies) for energies, lock in self._shards)
+
+    def __contains__(self, key):
+        return key in self._shard(key)[0]
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""
+    energybench
+    ~~~~~~~~~~~
+
+    Benchmarks the hot paths of :class:`energy.Energy`.
+
+    ::
+
+       $ python energybench.py -o results.json
+       $ python energybench.py --baseline results.json
+
+    Each benchmark runs over the realistic states of energy: full, partially
+    used, in debt and over the maximum. The ``array_*`` benchmarks compare
+    :class:`energy.EnergyArray` with a loop over the energies per energy. The
+    results are written as JSON so that they can be compared against a stored
+    baseline.
+
+    :copyright: (c) 2012-2013 by Heungsub Lee
+    :license: BSD, see LICENSE for more details.
+"""
+from __future__ import with_statement
+import json
+from optparse import OptionParser
+import platform
+import sys
+from timeit import default_timer
+
+import energy
+from energy import Energy, EnergyArray
+
+
+#: The time when the energies are evaluated.
+TIME = 1000000
+
+
+def make_states():
+    """Makes energies in the realistic states."""
+    full = Energy(10, 300)
+    partial = Energy(10, 300)
+    partial.use(3, TIME - 400)
+    debt = Energy(10, 300)
+    debt.use(15, TIME - 100, force=True)
+    bonus = Energy(10, 300)
+    bonus.set(15, TIME - 100)
+    return {'full': full, 'partial': partial, 'debt': debt, 'bonus': bonus}
+
+
+def _measure(func, number, repeat):
+    """Runs `func` with `number` and returns the best seconds per call. `func`
+    should call the target `number` times by itself.
+    """
+    best = None
+    for x in range(repeat):
+        started_at = default_timer()
+        func(number)
+        elapsed = default_timer() - started_at
+        if best is None or elapsed < best:
+            best = elapsed
+    return best / number
+
+
+def _reading(method, *args):
+    """Benchmarks a method which doesn't change the energy."""
+    def bench(energy, number, repeat):
+        func = getattr(energy, method)
+        def loop(number):
+            for x in range(number):
+                func(*args)
+        return _measure(loop, number, repeat)
+    return bench
+
+
+def _writing(method, *args, **kwargs):
+    """Benchmarks a method which changes the energy. Every call runs on a
+    fresh copy of the energy.
+    """
+    def bench(energy, number, repeat):
+        data = energy.to_bytes()
+        copies = [None]
+        def loop(number):
+            for func in copies[0]:
+                func(*args, **kwargs)
+        def run(number):
+            copies[0] = [getattr(Energy.from_bytes(data), method)
+                         for x in range(number)]
+            return _measure(loop, number, 1)
+        return min(run(number) for x in range(repeat))
+    return bench
+
+
+def _pickling(energy, number, repeat):
+    def loop(number):
+        for x in range(number):
+            Energy.__new__(Energy).__setstate__(energy.__getstate__())
+    return _measure(loop, number, repeat)
+
+
+def _binary(energy, number, repeat):
+    def loop(number):
+        for x in range(number):
+            Energy.from_bytes(energy.to_bytes())
+    return _measure(loop, number, repeat)
+
+
+def _construction(energy, number, repeat):
+    args = (energy.max, energy.recovery_interval, energy.recovery_quantity,
+            energy.future_tolerance, energy.used, energy.used_at)
+    def loop(number):
+        for x in range(number):
+            Energy(*args)
+    return _measure(loop, number, repeat)
+
+
+#: The benchmarks by their names.
+BENCHMARKS = [
+    ('use', _writing('use', 1, TIME, force=True)),
+    ('try_use', _writing('try_use', 1, TIME)),
+    ('try_use_rejected', _writing('try_use', 20, TIME)),
+    ('current', _reading('current', TIME)),
+    ('recover_in', _reading('recover_in', TIME)),
+    ('recover_fully_in', _reading('recover_fully_in', TIME)),
+    ('status', _reading('status', TIME)),
+    ('config', _writing('config', 12, time=TIME)),
+    ('set', _writing('set', 5, TIME)),
+    ('pickle', _pickling),
+    ('binary', _binary),
+    ('init', _construction),
+]
+
+
+#: The methods which are benchmarked on :class:`energy.EnergyArray` against a
+#: loop over the energies.
+ARRAY_METHODS = ['current', 'debt', 'recover_in', 'recover_fully_in']
+
+
+def _array_benchmarks(count, repeat, names=None):
+    """Benchmarks :class:`energy.EnergyArray` against a loop over the
+    energies. It yields the name and the seconds per energy.
+    """
+    states = sorted(make_states().items())
+    energies = [states[x % len(states)][1] for x in range(count)]
+    array = EnergyArray.from_energies(energies)
+    for method in ARRAY_METHODS:
+        name = 'array_' + method
+        if names and name not in names:
+            continue
+        def loop(number, method=method):
+            for x in range(number):
+                [getattr(energy, method)(TIME) for energy in energies]
+        yield '%s/loop' % name, _measure(loop, 1, repeat) / count
+        func = getattr(array, method)
+        def vector(number):
+            for x in range(number):
+                func(TIME)
+        yield '%s/array' % name, _measure(vector, 1, repeat) / count
+
+
+def measure_memory(count=10000):
+    """Measures the memory in bytes per energy by :mod:`tracemalloc`. It
+    returns ``None`` if :mod:`tracemalloc` is not available.
+    """
+    try:
+        import tracemalloc
+    except ImportError:
+        return
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        energies = [Energy(10, 300, used=3, used_at=TIME + x)
+                    for x in range(count)]
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del energies
+    return (after - before) / float(count)
+
+
+def run(number=10000, repeat=5, names=None):
+    """Runs the benchmarks and returns the results as a dict."""
+    results = {}
+    states = make_states()
+    for name, bench in BENCHMARKS:
+        if names and name not in names:
+            continue
+        for state, state_energy in sorted(states.items()):
+            seconds = bench(state_energy, number, repeat)
+            results['%s/%s' % (name, state)] = {
+                'ns_per_call': seconds * 1e9,
+                'calls_per_sec': 1 / seconds,
+            }
+    for name, seconds in _array_benchmarks(number, repeat, names):
+        results[name] = {'ns_per_call': seconds * 1e9,
+                         'calls_per_sec': 1 / seconds}
+    return {'python': platform.python_implementation(),
+            'python_version': platform.python_version(),
+            'energy_version': energy.__version__,
+            'number': number,
+            'repeat': repeat,
+            'results': results,
+            'bytes_per_energy': measure_memory()}
+
+
+def compare(results, baseline, tolerance=0.1):
+    """Compares the results against the baseline. It yields the name, the
+    baseline and current nanoseconds per call and whether it regressed over
+    the tolerance.
+    """
+    for name, result in sorted(results['results'].items()):
+        try:
+            base = baseline['results'][name]['ns_per_call']
+        except KeyError:
+            continue
+        current = result['ns_per_call']
+        yield name, base, current, current > base * (1 + tolerance)
+
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options] [benchmark...]')
+    parser.add_option('-n', '--number', type='int', default=10000,
+                      help='calls per measurement [default: %default]')
+    parser.add_option('-r', '--repeat', type='int', default=5,
+                      help='measurements per benchmark [default: %default]')
+    parser.add_option('-o', '--output', metavar='FILE',
+                      help='write the results as JSON')
+    parser.add_option('-b', '--baseline', metavar='FILE',
+                      help='compare the results against the baseline JSON')
+    parser.add_option('-t', '--tolerance', type='float', default=0.1,
+                      help='allowed slowdown ratio [default: %default]')
+    options, names = parser.parse_args(argv)
+    results = run(options.number, options.repeat, names)
+    for name, result in sorted(results['results'].items()):
+        print('%-28s %10.1f ns %12.0f calls/s' %
+              (name, result['ns_per_call'], result['calls_per_sec']))
+    if results['bytes_per_energy'] is not None:
+        print('%-28s %10.1f bytes' % ('memory', results['bytes_per_energy']))
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if not options.baseline:
+        return 0
+    with open(options.baseline) as f:
+        baseline = json.load(f)
+    regressed = False
+    print('')
+    for name, base, current, slower in compare(results, baseline,
+                                               options.tolerance):
+        mark = ' REGRESSED' if slower else ''
+        print('%-28s %10.1f -> %10.1f ns (%+.1f%%)%s' %
+              (name, base, current, (current / base - 1) * 100, mark))
+        regressed = regressed or slower
+    return 1 if regressed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+"""
+    energysim
+    ~~~~~~~~~
+
+    Simulates players who use energy on a virtual clock for capacity planning.
+
+    ::
+
+       $ python energysim.py -p 1000000 -m 10 -i 300 -o series.json
+
+    Players arrive by an arrival curve, use energy until it is not enough and
+    some of them come back when they are notified that the energy is full. The
+    energies of the players are evaluated in batch by
+    :class:`energy.EnergyArray` so that a simulated day takes much less than a
+    day. The results are time series of the throughput, the rejection rate and
+    the energy distribution.
+
+    A simulation is reproducible by its seed. :meth:`Simulation.operations`
+    generates the same energy operations for the benchmarks of energy stores
+    and services.
+
+    :copyright: (c) 2012-2013 by Heungsub Lee
+    :license: BSD, see LICENSE for more details.
+"""
+from __future__ import with_statement
+import json
+import math
+from optparse import OptionParser
+import random
+import sys
+from timeit import default_timer
+
+from energy import EnergyArray
+
+
+#: The seconds in a day.
+DAY = 86400
+
+# the states of a player
+IDLE, RETURNING, ACTIVE = range(3)
+
+
+def diurnal(time):
+    """The default arrival curve. It peaks at 20:00 and bottoms out at 08:00
+    UTC. An arrival curve returns the relative arrival rate at the time
+    between 0 and 1.
+    """
+    return 0.6 + 0.4 * math.cos(2 * math.pi * (time - 20 * 3600) / DAY)
+
+
+class Simulation(object):
+    """A simulation of players who use energy. Every player has an energy of
+    the same parameters which is full at the start.
+
+    An idle player starts a session by the arrival curve. In a session, the
+    player uses energy every `action_interval` seconds until it is not enough.
+    Then the player either comes back when the energy is full by a
+    notification or becomes idle again.
+
+    :param players: the number of players
+    :param max: :attr:`energy.Energy.max` of the players
+    :param recovery_interval: :attr:`energy.Energy.recovery_interval` of the
+                              players
+    :param recovery_quantity: :attr:`energy.Energy.recovery_quantity` of the
+                              players
+    :param seed: the seed of the random numbers. Defaults to ``0``.
+    :param step: the seconds of a step of the virtual clock. Every event in a
+                 step happens at the start of the step. Defaults to ``10``.
+    :param arrival: the arrival curve. Defaults to :func:`diurnal`.
+    :param sessions_per_day: the average number of sessions which an idle
+                             player starts in a day. Defaults to ``4``.
+    :param action_interval: the seconds between actions in a session.
+                            Defaults to ``10``.
+    :param spend: quantity of energy which an action uses. Defaults to ``1``.
+    :param force_ratio: the ratio of actions which use energy by force such as
+                        paid actions. Defaults to ``0``.
+    :param notified_return: the ratio of players who come back when the energy
+                            is full. Defaults to ``0.5``.
+    :param reaction: the range of seconds to come back after the energy is
+                     full. Defaults to ``(60, 1800)``.
+    :param start: the time when the simulation starts. Defaults to ``0``.
+    """
+
+    def __init__(self, players, max, recovery_interval, recovery_quantity=1,
+                 seed=0, step=10, arrival=diurnal, sessions_per_day=4,
+                 action_interval=10, spend=1, force_ratio=0,
+                 notified_return=0.5, reaction=(60, 1800), start=0):
+        self.max = max
+        self.recovery_interval = recovery_interval
+        self.recovery_quantity = recovery_quantity
+        self.energies = EnergyArray([0] * players, [None] * players,
+                                    [max] * players,
+                                    [recovery_interval] * players,
+                                    [recovery_quantity] * players,
+                                    [None] * players)
+        self.random = random.Random(seed)
+        self.step = step
+        self.arrival = arrival
+        self.action_interval = action_interval
+        self.spend = spend
+        self.force_ratio = force_ratio
+        self.notified_return = notified_return
+        self.reaction = reaction
+        self.start = self.time = start
+        #: the number of started sessions.
+        self.sessions = 0
+        # arrivals are thinned from the peak rate by the arrival curve
+        minutes = DAY // 60
+        mean = sum(arrival(start + x * 60)
+                   for x in range(minutes)) / float(minutes)
+        self._peak_rate = sessions_per_day / float(DAY) / mean
+        self._states = [IDLE] * players
+        # the players by the steps when their next events happen
+        self._wheel = {}
+        self._slot = 0
+        for player in range(players):
+            self._arrive_later(player, start)
+
+    def _schedule(self, player, time):
+        slot = int(math.ceil((time - self.start) / float(self.step)))
+        if slot <= self._slot:
+            slot = self._slot + 1
+        try:
+            self._wheel[slot].append(player)
+        except KeyError:
+            self._wheel[slot] = [player]
+
+    def _arrive_later(self, player, time):
+        self._states[player] = IDLE
+        self._schedule(player, time + self.random.expovariate(self._peak_rate))
+
+    def _use(self, players, time, force):
+        """Uses the energies of the players in batch."""
+        used, used_at = self.energies.used, self.energies.used_at
+        count = len(players)
+        batch = EnergyArray([used[p] for p in players],
+                            [used_at[p] for p in players],
+                            [self.max] * count,
+                            [self.recovery_interval] * count,
+                            [self.recovery_quantity] * count, [None] * count)
+        results = batch.use(self.spend, time, force)
+        for player, batch_used, batch_used_at in \
+                zip(players, batch.used, batch.used_at):
+            used[player] = batch_used
+            used_at[player] = batch_used_at
+        if self.notified_return and not all(results):
+            recover_fully_ins = batch.recover_fully_in(time)
+        rand = self.random
+        for x, player in enumerate(players):
+            if results[x]:
+                self._schedule(player, time + self.action_interval)
+                continue
+            # the session is over
+            if rand.random() < self.notified_return:
+                recover_fully_in = recover_fully_ins[x]
+                if recover_fully_in is not None:
+                    self._states[player] = RETURNING
+                    self._schedule(player, time + recover_fully_in +
+                                   rand.uniform(*self.reaction))
+                    continue
+            self._arrive_later(player, time)
+        return results
+
+    def steps(self, duration):
+        """Advances the virtual clock by `duration` seconds step by step. It
+        yields the time, the players who tried to use energy, whether each
+        player used energy by force and whether each use succeeded for each
+        step.
+        """
+        end = self.time + duration
+        rand = self.random
+        states = self._states
+        while self.time < end:
+            time = self.time
+            players, forced = [], []
+            for player in self._wheel.pop(self._slot, ()):
+                state = states[player]
+                if state == IDLE:
+                    if rand.random() >= self.arrival(time):
+                        self._arrive_later(player, time)
+                        continue
+                if state != ACTIVE:
+                    states[player] = ACTIVE
+                    self.sessions += 1
+                if self.force_ratio and rand.random() < self.force_ratio:
+                    forced.append(player)
+                else:
+                    players.append(player)
+            forces = [False] * len(players) + [True] * len(forced)
+            results = []
+            if players:
+                results.extend(self._use(players, time, False))
+            if forced:
+                results.extend(self._use(forced, time, True))
+            self._slot += 1
+            self.time = time + self.step
+            yield time, players + forced, forces, results
+
+    def operations(self, duration):
+        """Runs the simulation and generates the energy operations in order. It
+        yields the time, the player, the quantity and whether to use by force
+        for each :meth:`energy.Energy.use` call.
+        """
+        spend = self.spend
+        for time, players, forces, results in self.steps(duration):
+            for player, force in zip(players, forces):
+                yield time, player, spend, force
+
+    def run(self, duration, sample_interval=3600):
+        """Runs the simulation and returns the time series sampled every
+        `sample_interval` seconds. Each sample is a dict of:
+
+        ``time``
+           the time at the end of the interval.
+        ``calls``, ``calls_per_sec``
+           the number of use calls and the throughput in the interval.
+        ``rejections``, ``rejection_rate``
+           the number of use calls rejected by not enough energy and their
+           ratio to the calls.
+        ``sessions``
+           the number of sessions started in the interval.
+        ``distribution``
+           the number of players by the current energy from ``0`` to
+           :attr:`max`. The energies over the maximum are counted as full.
+        ``in_debt``, ``debt``
+           the number of players in debt and the total debt.
+        """
+        series = []
+        end = self.time + duration
+        while self.time < end:
+            interval = min(sample_interval, end - self.time)
+            sessions = self.sessions
+            calls = rejections = 0
+            for time, players, forces, results in self.steps(interval):
+                calls += len(results)
+                rejections += results.count(False)
+            series.append(self._sample(interval, calls, rejections,
+                                       self.sessions - sessions))
+        return series
+
+    def _sample(self, interval, calls, rejections, sessions):
+        time = self.time
+        distribution = [0] * (self.max + 1)
+        for current in self.energies.current(time):
+            distribution[min(current, self.max)] += 1
+        debts = [debt for debt in self.energies.debt(time) if debt is not None]
+        return {'time': time,
+                'calls': calls,
+                'calls_per_sec': calls / float(interval),
+                'rejections': rejections,
+                'rejection_rate': rejections / float(calls) if calls else 0.,
+                'sessions': sessions,
+                'distribution': distribution,
+                'in_debt': len(debts),
+                'debt': sum(debts)}
+
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-p', '--players', type='int', default=10000,
+                      help='simulated players [default: %default]')
+    parser.add_option('-m', '--max', type='int', default=10,
+                      help='max energy [default: %default]')
+    parser.add_option('-i', '--recovery-interval', type='float', default=300,
+                      help='recovery interval [default: %default]')
+    parser.add_option('-q', '--recovery-quantity', type='int', default=1,
+                      help='recovery quantity [default: %default]')
+    parser.add_option('-d', '--duration', type='int', default=DAY,
+                      help='simulated seconds [default: %default]')
+    parser.add_option('-s', '--sample-interval', type='int', default=3600,
+                      help='seconds between samples [default: %default]')
+    parser.add_option('--seed', type='int', default=0,
+                      help='random seed [default: %default]')
+    parser.add_option('--step', type='int', default=10,
+                      help='seconds of a step [default: %default]')
+    parser.add_option('--sessions-per-day', type='float', default=4,
+                      help='sessions of an idle player [default: %default]')
+    parser.add_option('--spend', type='int', default=1,
+                      help='energy used by an action [default: %default]')
+    parser.add_option('--force-ratio', type='float', default=0,
+                      help='ratio of forced actions [default: %default]')
+    parser.add_option('--notified-return', type='float', default=0.5,
+                      help='ratio of notified returns [default: %default]')
+    parser.add_option('-o', '--output', metavar='FILE',
+                      help='write the time series as JSON')
+    options, args = parser.parse_args(argv)
+    interval = options.recovery_interval
+    if interval == int(interval):
+        interval = int(interval)
+    started_at = default_timer()
+    simulation = Simulation(options.players, options.max, interval,
+                            options.recovery_quantity, seed=options.seed,
+                            step=options.step,
+                            sessions_per_day=options.sessions_per_day,
+                            spend=options.spend,
+                            force_ratio=options.force_ratio,
+                            notified_return=options.notified_return)
+    series = simulation.run(options.duration, options.sample_interval)
+    elapsed = default_timer() - started_at
+    print('%10s %12s %10s %10s %10s %10s' %
+          ('time', 'calls/s', 'rejected', 'sessions', 'mean', 'in debt'))
+    for sample in series:
+        mean = sum(energy * count for energy, count in
+                   enumerate(sample['distribution'])) / float(options.players)
+        print('%10d %12.1f %9.1f%% %10d %10.2f %10d' %
+              (sample['time'], sample['calls_per_sec'],
+               sample['rejection_rate'] * 100, sample['sessions'], mean,
+               sample['in_debt']))
+    print('')
+    print('simulated %d seconds in %.1f seconds (x%.0f)' %
+          (options.duration, elapsed, options.duration / elapsed))
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump({'parameters': options.__dict__, 'series': series}, f,
+                      indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,9 +6,11 @@ from datetime import datetime, timedelta
 from functools import partial
 from time import gmtime
 
-from pytest import raises
+from pytest import fixture, raises
 
-from energy import Energy, timestamp
+from energy import (
+    Energy, EnergyArray, EnergyPolicy, MemoryEnergyStore, SQLiteEnergyStore,
+    pack_many, timestamp, unpack_many)
 
 
 @contextmanager
@@ -22,8 +24,10 @@ def time_traveler():
             changed_time[0] = time
     original_timestamp = energy.timestamp
     energy.timestamp = partial(energy.timestamp, default_time_getter=T)
-    yield T
-    energy.timestamp = original_timestamp
+    try:
+        yield T
+    finally:
+        energy.timestamp = original_timestamp
 
 
 def test_timestamp():
@@ -429,3 +433,1298 @@ def test_recovery_quantity():
         assert energy == 9
         T(6)
         assert energy == 10
+
+
+def make_various_energies():
+    energies = []
+    for max_, interval, quantity in [(10, 5, 1), (10, 3, 2), (7, 0.5, 1)]:
+        full = Energy(max_, interval, quantity)
+        partial = Energy(max_, interval, quantity)
+        partial.use(3, 0)
+        debt = Energy(max_, interval, quantity)
+        debt.use(max_ + 4, 1, force=True)
+        bonus = Energy(max_, interval, quantity)
+        bonus.set(max_ + 5, 2)
+        energies.extend([full, partial, debt, bonus])
+    return energies
+
+
+def test_energy_array():
+    energies = make_various_energies()
+    array = EnergyArray.from_energies(energies)
+    assert len(array) == len(energies)
+    for time in [2, 3, 7, 10, 14, 30, 100]:
+        assert array.current(time) == [e.current(time) for e in energies]
+        assert array.debt(time) == [e.debt(time) for e in energies]
+        assert array.recover_in(time) == [e.recover_in(time) for e in energies]
+        with time_traveler() as T:
+            T(time)
+            assert array.recover_fully_in(time) == \
+                [e.recover_fully_in() for e in energies]
+    assert array.to_energies() == energies
+    # against the energies in random states
+    import random
+    rand = random.Random(7)
+    energies = []
+    for x in range(300):
+        # some energies are used at the future within the tolerance
+        tolerance = rand.choice([None, 5])
+        used_at = rand.randint(0, 95 if tolerance is None else 100)
+        energy = Energy(rand.randint(1, 20), rand.choice([1, 7, 0.1, 2.5]),
+                        rand.randint(1, 3), tolerance,
+                        used=rand.randint(-5, 30),
+                        used_at=rand.choice([None, used_at]))
+        energies.append(energy)
+    int_energies = [e for e in energies
+                    if isinstance(e.recovery_interval, int)]
+    for energies in [energies, int_energies]:
+        array = EnergyArray.from_energies(energies)
+        for time in [95, 100, 150, 1000]:
+            assert array.current(time) == [e.current(time) for e in energies]
+            assert array.debt(time) == [e.debt(time) for e in energies]
+            assert array.recover_in(time) == \
+                [e.recover_in(time) for e in energies]
+            assert array.recover_fully_in(time) == \
+                [e.recover_fully_in(time) for e in energies]
+
+
+def test_use_energy_array():
+    energies = make_various_energies()
+    array = EnergyArray.from_energies(energies)
+    for time, quantity, force in [(3, 1, False), (4, 6, False),
+                                  (8, 12, True), (20, 3, False)]:
+        expected = []
+        for energy in energies:
+            try:
+                energy.use(quantity, time, force)
+            except ValueError:
+                expected.append(False)
+            else:
+                expected.append(True)
+        assert array.use(quantity, time, force) == expected
+        assert array.to_energies() == energies
+    quantities = [x % 5 for x in range(len(array))]
+    for energy, quantity in zip(energies, quantities):
+        energy.use(quantity, 1000)
+    assert array.use(quantities, 1000) == [True] * len(array)
+    assert array.to_energies() == energies
+    with raises(ValueError):
+        array.use([1, 2], 100)
+
+
+def test_energy_array_used_at_the_future():
+    array = EnergyArray.from_energies([Energy(10, 5, used=1, used_at=10)])
+    assert array.current(10) == [9]
+    with raises(ValueError):
+        array.current(5)
+    with raises(ValueError):
+        array.use(1, 5)
+    assert array.used == [1]
+
+
+def test_energy_policy():
+    assert EnergyPolicy(10, 300) is EnergyPolicy(10, 300)
+    assert EnergyPolicy(10, 300.0) is \
+        EnergyPolicy(10, timedelta(seconds=300))
+    assert EnergyPolicy(10, 300) is not EnergyPolicy(10, 300.0)
+    assert EnergyPolicy(10, 300) is not EnergyPolicy(10, 300, 2)
+    assert isinstance(EnergyPolicy(10, 300.0).recovery_interval, float)
+    assert EnergyPolicy(10, 300).replace(max=20) is EnergyPolicy(20, 300)
+    with raises(AttributeError):
+        EnergyPolicy(10, 300).max = 20
+    with raises(TypeError):
+        EnergyPolicy(10.0, 300)
+    # the recent policies skip the validation but not the types
+    with raises(TypeError):
+        EnergyPolicy(10, 300, 1.0)
+    with raises(TypeError):
+        EnergyPolicy(10, 300, resolution=1.0)
+    policy = EnergyPolicy(10, 300, future_tolerance=1.0)
+    assert isinstance(policy.future_tolerance, float)
+    with raises(TypeError):
+        EnergyPolicy(10, [300])
+    policy = EnergyPolicy(10, 300)
+    EnergyPolicy._recent.clear()
+    assert EnergyPolicy(10, 300) is policy
+
+
+def test_energy_shares_policy():
+    e1, e2 = Energy(10, 300), Energy(10, 300)
+    assert e1.policy is e2.policy
+    assert not hasattr(e1, '__dict__')
+    e1.config(max=20)
+    assert e1.policy is EnergyPolicy(20, 300)
+    assert e2.policy is EnergyPolicy(10, 300)
+    e2.recovery_interval = 10
+    assert e2.policy is EnergyPolicy(10, 10)
+    e3 = Energy.from_policy(EnergyPolicy(10, 10), used=1, used_at=0)
+    assert e3.policy is e2.policy
+    assert e3.current(0) == 9
+
+
+def test_pickle_energy_with_protocols():
+    try:
+        import cPickle as pickle
+    except ImportError:
+        import pickle
+    energy = Energy(10, 5, future_tolerance=3, used=2, used_at=100)
+    for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+        loaded_energy = pickle.loads(pickle.dumps(energy, protocol))
+        assert loaded_energy == energy
+        assert loaded_energy.policy is energy.policy
+
+
+def test_energy_to_bytes():
+    for energy in make_various_energies() + [
+            Energy(10, 5, future_tolerance=3, used=2, used_at=100),
+            Energy(10, 5, future_tolerance=0.5, used=2, used_at=100)]:
+        data = energy.to_bytes()
+        assert len(data) == 42
+        loaded_energy = Energy.from_bytes(data)
+        assert loaded_energy == energy
+        assert loaded_energy.policy is energy.policy
+    with raises(ValueError):
+        Energy.from_bytes(b'\x1f' + data[1:])
+
+
+def test_energy_from_legacy_bytes():
+    try:
+        import cPickle as pickle
+    except ImportError:
+        import pickle
+    energy = Energy(10, 5, used=2, used_at=100)
+    for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+        for dump in [pickle.dumps(energy, protocol),
+                     pickle.dumps(energy.__getstate__(), protocol)]:
+            assert Energy.from_bytes(dump) == energy
+    # saved under 0.1.2
+    dump = pickle.dumps((10, 5, 1, 2, 100))
+    assert Energy.from_bytes(dump) == energy
+
+
+def test_pack_many_energies():
+    energies = make_various_energies()
+    data = pack_many(energies)
+    assert len(data) == 42 * len(energies)
+    assert unpack_many(data) == energies
+    assert unpack_many(memoryview(data)) == energies
+    assert unpack_many(b'') == []
+    with raises(ValueError):
+        unpack_many(data[:-1])
+
+
+@fixture(params=['memory', 'sqlite'])
+def store(request):
+    default = partial(Energy, 10, 5)
+    if request.param == 'memory':
+        return MemoryEnergyStore(default=default)
+    return SQLiteEnergyStore(':memory:', default=default)
+
+
+def test_energy_store(store):
+    energies = dict(enumerate(make_various_energies()))
+    assert store.get(0) is None
+    assert store.get_many(energies) == {}
+    store.put_many(energies)
+    assert len(store) == len(energies)
+    assert store.get_many(energies) == energies
+    assert store.get_many([0, 1, 'unknown']) == \
+        {0: energies[0], 1: energies[1]}
+    store.put('a', Energy(10, 0.5, future_tolerance=3, used=1, used_at=100))
+    assert store.get('a') == Energy(10, 0.5, 1, 3, used=1, used_at=100)
+    assert isinstance(store.get('a').recovery_interval, float)
+    assert isinstance(store.get(0).recovery_interval, int)
+
+
+def test_use_energy_in_store(store):
+    store.put('a', Energy(10, 5))
+    energy = store.use('a', 3, 100)
+    assert energy.current(100) == 7
+    assert store.get('a') == energy
+    with raises(ValueError):
+        store.use('a', 8, 100)
+    assert store.get('a') == energy
+    store.use('a', 8, 100, force=True)
+    assert store.get('a').debt(100) == 1
+    # unknown keys
+    assert store.use('b', 1, 100).current(100) == 9
+    store.default = None
+    with raises(KeyError):
+        store.use('c', 1, 100)
+    assert store.get('c') is None
+
+
+def test_use_energy_in_store_concurrently(store):
+    import threading
+    store.put('a', Energy(1000, 5))
+    def use():
+        for x in range(100):
+            store.use('a', 1, 100)
+    threads = [threading.Thread(target=use) for x in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert store.get('a').current(100) == 600
+
+
+def test_sqlite_energy_store_bulk(tmpdir):
+    path = str(tmpdir.join('energy.db'))
+    store = SQLiteEnergyStore(path)
+    store.put_many((x, Energy(10, 5, used=x % 10, used_at=x))
+                   for x in range(1200))
+    store = SQLiteEnergyStore(path)
+    energies = store.get_many(range(1200))
+    assert len(energies) == 1200
+    assert energies[1199] == Energy(10, 5, used=9, used_at=1199)
+
+
+def test_sqlite_energy_functions():
+    import sqlite3
+    from energy import register_sqlite_functions
+    conn = sqlite3.connect(':memory:')
+    register_sqlite_functions(conn)
+    query = 'SELECT energy_current(?, ?, ?, ?, ?, ?, ?), ' \
+            'energy_debt(?, ?, ?, ?, ?, ?, ?), energy_full_at(?, ?, ?, ?)'
+    for energy in make_various_energies():
+        fields = (energy.used, energy.used_at, energy.max,
+                  energy.recovery_interval, energy.recovery_quantity,
+                  energy.future_tolerance)
+        full_at = conn.execute(query, fields + (10,) + fields + (10,) +
+                               fields[:2] + fields[3:5]).fetchone()[2]
+        for time in [2, 3, 7, 10, 14, 30, 100]:
+            row = conn.execute(query, fields + (time,) + fields + (time,) +
+                               fields[:2] + fields[3:5]).fetchone()
+            assert row[:2] == (energy.current(time), energy.debt(time))
+            assert row[2] == full_at
+            assert (full_at is None or full_at <= time) == \
+                (energy.current(time) >= energy.max)
+
+
+def test_sqlite_energy_store_queries():
+    store = SQLiteEnergyStore(':memory:')
+    store.put_many([('full', Energy(10, 5)),
+                    ('bonus', Energy(10, 5, used=-5)),
+                    ('partial', Energy(10, 5, used=3, used_at=100)),
+                    ('debt', Energy(10, 5, used=12, used_at=100)),
+                    ('fast', Energy(10, 5, 2, used=3, used_at=100))])
+    assert store.full_keys(100, 110) == ['fast']
+    assert store.full_keys(100, 115) == ['fast', 'partial']
+    assert store.full_keys(110) == ['partial', 'debt']
+    assert store.count_full(100) == 2
+    assert store.count_full(110) == 3
+    assert store.count_full(200) == 5
+    assert store.debt_keys(100) == ['debt']
+    assert store.debt_keys(110) == []
+    # energies used at the future don't abort the queries
+    store.put('future', Energy(10, 5, used=12, used_at=200))
+    assert store.debt_keys(100) == ['debt']
+    query = 'SELECT energy_current(used, used_at, max, recovery_interval, ' \
+            'recovery_quantity, future_tolerance, 100) FROM energy ' \
+            'WHERE key = ?'
+    assert store.connection.execute(query, ('future',)).fetchone() == (None,)
+    plan = store.connection.execute('EXPLAIN QUERY PLAN SELECT key FROM '
+                                    'energy WHERE full_at > 0').fetchall()
+    assert 'energy_full_at' in str(plan)
+
+
+def test_recovery_scheduler():
+    from energy import RecoveryScheduler
+    fulls, recovers = [], []
+    scheduler = RecoveryScheduler(on_full=lambda k, e: fulls.append(k))
+    e1, e2, e3 = Energy(10, 5), Energy(10, 5), Energy(10, 5)
+    scheduler.use('e1', e1, 2, 0)
+    scheduler.use('e2', e2, 1, 0)
+    scheduler.schedule('e3', e3, 0)
+    assert len(scheduler) == 2
+    assert 'e3' not in scheduler
+    assert scheduler.next_time() == 5
+    assert scheduler.run_pending(4) == 0
+    assert scheduler.run_pending(5) == 1
+    assert fulls == ['e2']
+    # reschedule on use
+    scheduler.use('e1', e1, 1, 6)
+    assert scheduler.next_time() == 15
+    assert scheduler.run_pending(14) == 0
+    assert scheduler.run_pending(15) == 1
+    assert fulls == ['e2', 'e1']
+    # reschedule on set and config
+    scheduler.set('e3', e3, 5, 20)
+    assert scheduler.next_time() == 45
+    scheduler.config('e3', e3, recovery_interval=1, time=20)
+    assert scheduler.next_time() == 25
+    scheduler.set('e3', e3, 10, 21)
+    assert scheduler.next_time() is None
+    assert scheduler.run_pending(100) == 0
+    assert fulls == ['e2', 'e1']
+    # every recovery
+    scheduler = RecoveryScheduler(on_full=lambda k, e: fulls.append(k),
+                                  on_recover=lambda k, e: recovers.append(k))
+    scheduler.use('e1', e1, 3, 100)
+    assert scheduler.run_pending(110) == 2
+    assert recovers == ['e1', 'e1']
+    assert scheduler.run_pending(115) == 1
+    assert recovers == ['e1', 'e1', 'e1']
+    assert fulls == ['e2', 'e1', 'e1']
+
+
+def test_recovery_scheduler_cancel():
+    from energy import RecoveryScheduler
+    scheduler = RecoveryScheduler()
+    for x in range(1000):
+        scheduler.use(x, Energy(10, 5), 1, 0)
+    for x in range(1000):
+        scheduler.cancel(x)
+    assert len(scheduler) == 0
+    assert len(scheduler._heap) < 100
+    assert scheduler.next_time() is None
+
+
+def test_recovery_scheduler_on_asyncio():
+    import asyncio
+    from energy import RecoveryScheduler
+    loop = asyncio.new_event_loop()
+    fulls = []
+    scheduler = RecoveryScheduler(on_full=lambda k, e: fulls.append(k))
+    scheduler.start(loop)
+    energy = Energy(10, 5)
+    scheduler.use('e', energy, 1, timestamp() - 10)
+    loop.run_until_complete(asyncio.sleep(0.05))
+    assert fulls == ['e']
+    scheduler.use('e', energy, 1)
+    loop.run_until_complete(asyncio.sleep(0.05))
+    assert fulls == ['e']
+    assert scheduler._handle is not None
+    scheduler.stop()
+    loop.close()
+
+
+def test_set_energy_at_specific_time():
+    energy = Energy(10, 5)
+    energy.set(5, 100)
+    assert energy.used_at == 100
+    assert energy.current(100) == 5
+    assert energy.recover_fully_in(100) == 25
+
+
+def test_clocks():
+    from energy import FixedClock, MonotonicClock, OffsetClock, SystemClock
+    assert abs(SystemClock()() - timegm(gmtime())) <= 1
+    assert abs(MonotonicClock()() - timegm(gmtime())) <= 1
+    clock = FixedClock(100)
+    assert clock() == 100
+    clock.advance(5)
+    assert clock() == 105
+    clock.set(datetime.utcfromtimestamp(200))
+    assert clock() == 200
+    assert OffsetClock(-10, clock)() == 190
+    assert abs(OffsetClock(3600)() - timegm(gmtime()) - 3600) <= 1
+
+
+def test_energy_with_clock():
+    from energy import FixedClock
+    clock = FixedClock(0)
+    energy = Energy(10, 5, clock=clock)
+    energy.use(3)
+    assert energy.used_at == 0
+    clock.advance(6)
+    assert energy == 8
+    assert energy.recover_in() == 4
+    assert repr(energy) == '<Energy 8/10 recover in 00:04>'
+    assert energy.current(0) == 7
+    energy = Energy.from_policy(energy.policy, clock=clock)
+    assert energy.clock is clock
+
+
+def test_energy_calls_clock_once():
+    from energy import Clock
+    class CountingClock(Clock):
+        calls = 0
+        def now(self):
+            self.calls += 1
+            return 100
+    clock = CountingClock()
+    energy = Energy(10, 5, clock=clock, used=3, used_at=90)
+    repr(energy)
+    assert clock.calls == 1
+    energy.recover_fully_in()
+    assert clock.calls == 2
+    energy.set(5)
+    assert clock.calls == 3
+
+
+def test_frozen_now():
+    from energy import FixedClock, frozen_now
+    with frozen_now(100) as now:
+        assert now == 100
+        assert timestamp() == 100
+        energy = Energy(10, 5)
+        energy.use()
+        assert energy.used_at == 100
+        with frozen_now(clock=FixedClock(200)):
+            assert timestamp() == 200
+        assert timestamp() == 100
+    assert timestamp() != 100
+    with frozen_now() as now:
+        assert abs(now - timegm(gmtime())) <= 1
+        assert timestamp() == now
+
+
+def test_timestamp_fast_path():
+    assert timestamp(123) == 123
+    assert timestamp(123.5) == 123
+    assert timestamp(gmtime(456)) == 456
+
+
+def test_energy_status():
+    for energy in make_various_energies():
+        for time in [2, 3, 7, 10, 14, 30, 100]:
+            status = energy.status(time)
+            assert status.time == time
+            assert status.current == energy.current(time)
+            assert status.debt == energy.debt(time)
+            assert status.max == energy.max
+            assert status.recover_in == energy.recover_in(time)
+            assert status.recover_fully_in == energy.recover_fully_in(time)
+            assert status == energy.current(time)
+            assert status == energy.status(time)
+    energy = Energy(10, 300)
+    energy.use(3, 0)
+    status = energy.status(60)
+    assert repr(status) == '<EnergyStatus 7/10 recover in 04:00>'
+    assert int(status) == 7
+    assert 6 < status <= 7
+    with raises(AttributeError):
+        status.current = 10
+
+
+def test_metrics_energy_array_config():
+    from energy import EnergyArray, Metrics, add_sink, remove_sink
+    metrics = Metrics()
+    add_sink(metrics)
+    try:
+        Energy(10, 5).config(max=12, time=0)
+        EnergyArray.from_energies([Energy(10, 5)] * 3).config(max=12, time=0)
+    finally:
+        remove_sink(metrics)
+    assert 'energy_config_total 4\n' in metrics.prometheus()
+
+
+def test_metrics():
+    from energy import Metrics, add_sink, remove_sink
+    events = []
+    sink = lambda event, value: events.append((event, value))
+    metrics = Metrics()
+    add_sink(sink)
+    add_sink(metrics)
+    try:
+        energy = Energy(10, 5, future_tolerance=2)
+        energy.use(3, 100)
+        with raises(ValueError):
+            energy.use(8, 100)
+        energy.use(8, 100, force=True)
+        assert energy.current(99) == 0
+        with raises(ValueError):
+            energy.current(90)
+        energy.config(max=12, time=100)
+        store = MemoryEnergyStore()
+        store.put(1, energy)
+        store.get(1)
+    finally:
+        remove_sink(sink)
+        remove_sink(metrics)
+    names = [event for event, value in events]
+    assert names[:6] == ['use', 'use_rejected', 'use', 'use_debt',
+                         'future_tolerated', 'future_rejected']
+    assert events[4:6] == [('future_tolerated', 1), ('future_rejected', 10)]
+    assert names[6:] == ['config', 'store_put_many', 'store_get_many']
+    energy.use(1, 200)
+    assert len(events) == 9
+    text = metrics.prometheus()
+    assert 'energy_use_total 2\n' in text
+    assert 'energy_use_rejected_total 1\n' in text
+    assert '# TYPE energy_future_rejected_seconds histogram\n' in text
+    assert 'energy_future_rejected_seconds_bucket{le="5"} 0\n' in text
+    assert 'energy_future_rejected_seconds_bucket{le="10"} 1\n' in text
+    assert 'energy_future_rejected_seconds_sum 10.0\n' in text
+    assert 'energy_store_get_many_seconds_count 1\n' in text
+
+
+def test_energy_journal(tmpdir):
+    from energy import EnergyJournal
+    path = str(tmpdir.join('journal'))
+    default = partial(Energy, 10, 5)
+    journal = EnergyJournal(path, default=default, segment_size=64)
+    journal.use('a', 3, 100)
+    journal.use(1, 12, 100, force=True)
+    with raises(ValueError):
+        journal.use('a', 8, 100)
+    journal.set('b', 4, 101)
+    journal.reset('a', 102)
+    journal.use('a', 2, 103)
+    journal.config('a', max=12, recovery_interval=3, time=104)
+    journal.config(1, recovery_interval=0.5, time=104)
+    expected = dict((key, Energy.from_bytes(energy.to_bytes()))
+                    for key, energy in journal.energies.items())
+    journal.close()
+    # replay
+    journal = EnergyJournal(path, default=default)
+    assert journal.energies == expected
+    assert isinstance(journal.get(1).recovery_interval, float)
+    assert journal.get('a').max == 12
+    # snapshot and the tail
+    journal.snapshot()
+    journal.use('b', 1, 110)
+    expected['b'].use(1, 110)
+    journal.close()
+    journal = EnergyJournal(path, default=default)
+    assert journal.energies == expected
+    journal.close()
+    # the energies which are not made by default
+    path = str(tmpdir.join('journal2'))
+    journal = EnergyJournal(path)
+    journal.put('x', Energy(10, 5))
+    journal.put(7, Energy(20, 250, used=3, used_at=1000, resolution=1000))
+    journal.use('x', 3, 100)
+    journal.use(7, 2, 2000)
+    journal.put('x', Energy(5, 1))
+    journal.use('x', 1, 200)
+    expected = dict((key, Energy.from_bytes(energy.to_bytes()))
+                    for key, energy in journal.energies.items())
+    journal.close()
+    journal = EnergyJournal(path)
+    assert journal.energies == expected
+    assert journal.get(7).resolution == 1000
+    assert journal.get('x').current(200) == 4
+    journal.close()
+
+
+def test_energy_journal_failed_append(tmpdir):
+    import struct
+    from energy import EnergyJournal
+    path = str(tmpdir.join('journal'))
+    journal = EnergyJournal(path, default=partial(Energy, 10, 5))
+    journal.use('a', 3, 100)
+    # converted like Energy
+    journal.config('a', recovery_interval=timedelta(seconds=3), time=101)
+    journal.use('a', 1.0, 101)
+    assert journal.get('a').recovery_interval == 3.0
+    assert journal.get('a').used == 4.0
+    # failures change neither the memory nor the journal
+    with raises(ValueError):
+        journal.use('a', 20, 102)
+    with raises(TypeError):
+        journal.config('a', max=12.5, time=102)
+    with raises(struct.error):
+        journal.use('a', 1, 2 ** 64)
+    journal.use('b', 2, 103)
+    expected = dict((key, energy.__getstate__())
+                    for key, energy in journal.energies.items())
+    journal.close()
+    journal = EnergyJournal(path, default=partial(Energy, 10, 5))
+    assert dict((key, energy.__getstate__())
+                for key, energy in journal.energies.items()) == expected
+    assert isinstance(journal.get('a').used, float)
+    journal.close()
+
+
+def test_energy_journal_group_commit(tmpdir):
+    from energy import EnergyJournal
+    path = str(tmpdir.join('journal'))
+    journal = EnergyJournal(path, default=partial(Energy, 10, 5),
+                            group_size=3)
+    for x in range(7):
+        journal.use(x, 1, 100)
+    assert journal._pending == 1
+    journal.commit()
+    assert journal._pending == 0
+    journal.close()
+
+
+def test_shared_energy_table(tmpdir):
+    from energy import SharedEnergyTable
+    path = str(tmpdir.join('table'))
+    policies = [EnergyPolicy(10, 5), EnergyPolicy(20, 5)]
+    table = SharedEnergyTable(path, 8, policies)
+    assert table.get(1) is None
+    with raises(KeyError):
+        table.use(1, 1, 100)
+    assert table.use(1, 3, 100, policy=policies[0]).current(100) == 7
+    table.put(2, Energy(20, 5, used=25, used_at=100))
+    assert table.current(1, 105) == 8
+    assert table.status(2, 100).debt == 5
+    assert table.set(1, 15, 106).current(106) == 15
+    other = SharedEnergyTable(path, policies=policies)
+    assert other.capacity == 8
+    assert other.get(1) == table.get(1)
+    assert other.get(2) == Energy(20, 5, used=25, used_at=100)
+    for key in range(3, 9):
+        table.put(key, Energy(10, 5))
+    with raises(ValueError):
+        table.put(9, Energy(10, 5))
+    table.close()
+    other.close()
+
+
+def test_shared_energy_table_across_processes(tmpdir):
+    import multiprocessing
+    from energy import SharedEnergyTable
+    path = str(tmpdir.join('table'))
+    policies = [EnergyPolicy(1000, 5)]
+    SharedEnergyTable(path, 64, policies).close()
+    def work():
+        table = SharedEnergyTable(path, policies=policies)
+        for x in range(100):
+            table.use(7, 1, 100, policy=policies[0])
+        table.close()
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=work) for x in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    table = SharedEnergyTable(path, policies=policies)
+    assert table.current(7, 100) == 600
+    table.close()
+
+
+def test_try_use_energy():
+    from energy import UseResult
+    for energy in make_various_energies():
+        for time, quantity, force in [(3, 1, False), (4, 6, False),
+                                      (8, 12, True), (20, 30, False)]:
+            other = Energy.from_bytes(energy.to_bytes())
+            can_use = energy.can_use(quantity, time)
+            result = energy.try_use(quantity, time, force)
+            assert isinstance(result, UseResult)
+            try:
+                other.use(quantity, time, force)
+            except ValueError:
+                assert not can_use and not force
+                assert not result
+                assert result.success is False
+            else:
+                assert can_use or force
+                assert result
+            assert energy == other
+            assert result.current == other.current(time)
+            assert result.recover_in == other.recover_in(time)
+            success, current, recover_in = result
+            assert success is result.success
+    # within the future tolerance
+    for quantity in [1, 9]:
+        energy = Energy(10, 5, future_tolerance=3, used=2, used_at=100)
+        other = Energy.from_bytes(energy.to_bytes())
+        result = energy.try_use(quantity, 98)
+        assert result.success is other.can_use(quantity, 98)
+        if result:
+            other.use(quantity, 98)
+        assert energy == other
+        assert result.current == other.current(98)
+        assert result.recover_in == other.recover_in(98)
+    # force on the energy over the maximum
+    energy = Energy(14, 10, used=-23)
+    result = energy.try_use(3, 219, force=True)
+    assert result.current == energy.current(219) == 14
+    assert result.recover_in == energy.recover_in(219)
+
+
+def test_energy_pool():
+    from energy import EnergyPool
+    pool = EnergyPool(shards=4, default=partial(Energy, 10, 5))
+    pool.use('a', 3, 100)
+    assert pool.status('a', 100).current == 7
+    with raises(ValueError):
+        pool.use('a', 8, 100)
+    assert not pool.try_use('a', 8, 100)
+    pool.set('a', 2, 100)
+    assert pool.get('a').current(100) == 2
+    pool.config('a', max=12, time=100)
+    assert pool.get('a').max == 12
+    pool.reset('a', 100)
+    assert pool.get('a').current(100) == 12
+    pool.put_many((x, Energy(10, 5)) for x in range(100))
+    assert len(pool) == 101
+    results = pool.try_use_many(dict((x, x % 20) for x in range(100)), 100)
+    assert [bool(results[x]) for x in range(20)] == [True] * 11 + [False] * 9
+    statuses = pool.status_many(list(range(100)) + ['unknown'], 100)
+    assert len(statuses) == 100
+    assert statuses[3].current == 7
+    assert 'unknown' not in pool
+    pool.default = None
+    with raises(KeyError):
+        pool.use('unknown', 1, 100)
+
+
+def test_energy_pool_concurrently():
+    import threading
+    from energy import EnergyPool
+    pool = EnergyPool(default=partial(Energy, 10000, 5))
+    def use():
+        for x in range(500):
+            pool.use(x % 8, 1, 100)
+    threads = [threading.Thread(target=use) for x in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sum(s.current for s in pool.status_many(range(8), 100).values()) \
+        == 8 * 10000 - 2000
+
+
+def test_resolution():
+    from energy import EnergyStatus, frozen_now
+    energy = Energy(10, 250, resolution=1000)
+    assert energy.resolution == 1000
+    energy.use(3, 1000)
+    assert energy.current(1249) == 7
+    assert energy.current(1250) == 8
+    assert energy.recover_in(1100) == 150
+    assert energy.recover_fully_in(1100) == 650
+    assert energy.status(1100) == EnergyStatus(1100, 7, None, 10, 150, 650,
+                                               1000)
+    assert energy.current(1750) == 10
+    # no drift with many recoveries
+    energy = Energy(1000000, 250, resolution=1000)
+    energy.use(1000000, 0)
+    assert energy.current(250 * 999999) == 999999
+    # timedelta and present time
+    energy = Energy(10, timedelta(milliseconds=250), resolution=1000)
+    assert energy.recovery_interval == 250
+    with frozen_now(100.5):
+        energy.use()
+        assert energy.used_at == 100500
+        assert energy.recover_in() == 250
+    assert Energy(10, 1, resolution=1000000).status(0).resolution == 1000000
+    with raises(TypeError):
+        Energy(10, 0.25, resolution=1000)
+    with raises(ValueError):
+        Energy(10, 250, resolution=100)
+    # a float interval in seconds recovers as before
+    energy = Energy(100, timedelta(milliseconds=100), used=50, used_at=0)
+    assert [energy.recovered(t) for t in range(1, 6)] == [10, 20, 30, 40, 50]
+    assert [energy.current(t) for t in range(1, 6)] == [60, 70, 80, 90, 100]
+    assert EnergyArray.from_energies([energy]).current(3) == [80]
+    assert energy.status(3).current == 80
+
+
+def test_resolution_serialization():
+    energy = Energy(10, 250, future_tolerance=100, resolution=1000)
+    energy.use(3, 1500)
+    data = energy.to_bytes()
+    assert len(data) == 42
+    loaded = Energy.from_bytes(data)
+    assert loaded.resolution == 1000
+    assert loaded == energy
+    import pickle
+    assert pickle.loads(pickle.dumps(energy)) == energy
+    # version 1 records are in seconds
+    old = Energy(10, 5)
+    old.use(3, 100)
+    data = b'\x01' + old.to_bytes()[1:]
+    assert Energy.from_bytes(data) == old
+    # stores and arrays keep the resolution
+    array = EnergyArray.from_energies([energy, old])
+    assert array[0] == energy
+    assert array.current(1750) == [8, 10]
+    store = SQLiteEnergyStore(':memory:')
+    store.put(1, energy)
+    assert store.get(1) == energy
+    assert store.full_keys(0) == [1]
+    assert store.full_keys(0, 2) == []
+    assert store.full_keys(0, 3) == [1]
+
+
+def test_energy_wallet():
+    import pickle
+    from energy import EnergyWallet
+    wallet = EnergyWallet({'stamina': Energy(100, 60),
+                           'ticket': Energy(5, 3600),
+                           'charge': Energy(3, 250, resolution=1000)})
+    wallet.use_many({'stamina': 10, 'ticket': 1}, 0)
+    assert wallet['stamina'].current(0) == 90
+    assert wallet['ticket'].current(0) == 4
+    # all or none
+    with raises(ValueError):
+        wallet.use_many({'stamina': 10, 'ticket': 5}, 0)
+    assert wallet['stamina'].current(0) == 90
+    with raises(KeyError):
+        wallet.use_many({'stamina': 10, 'unknown': 1}, 0)
+    assert wallet['stamina'].current(0) == 90
+    wallet.use_many({'stamina': 10, 'ticket': 5}, 0, force=True)
+    assert wallet['ticket'].debt(0) == 1
+    # the quantities of the same name are summed
+    stamina = EnergyWallet({'s': Energy(10, 60)})
+    with raises(ValueError):
+        stamina.use_many([('s', 6), ('s', 6)], 0)
+    assert stamina['s'].current(0) == 10
+    stamina.use_many([('s', 3), ('s', 4)], 0)
+    assert stamina['s'].current(0) == 3
+    statuses = wallet.status(60)
+    assert sorted(statuses) == ['charge', 'stamina', 'ticket']
+    assert statuses['stamina'] == 81
+    # one compact record
+    data = wallet.to_bytes()
+    assert len(data) < len(pickle.dumps(dict(
+        (name, wallet[name]) for name in wallet)))
+    assert EnergyWallet.from_bytes(data) == wallet
+    assert pickle.loads(pickle.dumps(wallet)) == wallet
+    assert len(wallet) == 3
+    del wallet['charge']
+    assert 'charge' not in wallet
+
+
+def test_recovery_schedule():
+    from fractions import Fraction
+    import random
+    from energy import EnergyStatus, RecoverySchedule
+    weekend = RecoverySchedule([(1000, 150, 1), (2000, None, None)])
+    energy = Energy(10, 300, schedule=weekend)
+    energy.use(10, 700)
+    assert energy.current(999) == 0
+    assert energy.current(1000) == 1
+    assert energy.current(1150) == 2
+    assert energy.current(2000) == 7
+    # the progress of recovery continues over the changes
+    assert energy.current(2099) == 7
+    assert energy.current(2100) == 8
+    assert energy.recover_in(1100) == 50
+    assert energy.recover_in(1950) == 150
+    assert energy.recover_fully_in(1100) == 2700 - 1100
+    assert energy.status(1100) == EnergyStatus(1100, 1, None, 10, 50, 1600)
+    # without changes, it is the same as the constant recovery
+    for state in make_various_energies():
+        if not isinstance(state.recovery_interval, int) or \
+           state.recovery_quantity != 1:
+            continue
+        scheduled = Energy(state.max, state.recovery_interval,
+                           schedule=RecoverySchedule())
+        scheduled.used, scheduled.used_at = state.used, state.used_at
+        for time in range(1000, 1030, 3):
+            assert scheduled.status(time) == state.status(time)
+            assert scheduled.recover_in(time) == state.recover_in(time)
+    # against a simulation tick by tick
+    rand = random.Random(42)
+    for x in range(20):
+        changes = [(rand.randint(0, 500), rand.choice([None, 7, 10, 15]),
+                    rand.choice([None, 1, 2, 3])) for y in range(3)]
+        schedule = RecoverySchedule(changes)
+        def period(time):
+            interval, quantity = 10, 1
+            for start, i, q in schedule.changes:
+                if start <= time:
+                    interval = 10 if i is None else i
+                    quantity = 1 if q is None else q
+            return interval, quantity
+        used_at = rand.randint(0, 300)
+        progress, recovered = Fraction(0), 0
+        for time in range(used_at + 1, used_at + 400):
+            progress += Fraction(1, period(time - 1)[0])
+            while progress >= 1:
+                progress -= 1
+                recovered += period(time)[1]
+            assert schedule.recovered(used_at, time, 10) == recovered
+            if not recovered:
+                continue
+            at = schedule.recovered_at(used_at, recovered, 10)
+            assert schedule.recovered(used_at, at, 10) >= recovered
+            assert schedule.recovered(used_at, at - 1, 10) < recovered
+    # recovered_at() against recovered() including the change boundaries
+    for x in range(200):
+        changes = [(rand.randint(0, 60), rand.choice([None, 1, 2, 5]),
+                    rand.choice([None, 1, 3])) for y in range(3)]
+        schedule = RecoverySchedule(changes)
+        used_at = rand.randint(0, 40)
+        time, recovered = used_at, 0
+        for quantity in range(1, 8):
+            while recovered < quantity:
+                time += 1
+                recovered = schedule.recovered(used_at, time, 10)
+            assert schedule.recovered_at(used_at, quantity, 10) == time
+    schedule = RecoverySchedule([(22, 1, 1), (23, None, 1), (25, 1, 3)])
+    energy = Energy(10, 10, used=1, used_at=13, schedule=schedule)
+    assert [energy.recover_in(t) for t in (13, 14, 20, 22)] == \
+        [10, 9, 3, 1]
+    import pickle
+    loaded = pickle.loads(pickle.dumps(energy))
+    assert loaded.status(1100) == energy.status(1100)
+    with raises(ValueError):
+        energy.to_bytes()
+
+
+def test_use_many():
+    from energy import use_many
+    energies = make_various_energies()
+    expected = make_various_energies()
+    quantities = [x % 4 * 3 for x in range(len(energies))]
+    for time, force in [(3, False), (4, True), (20, False)]:
+        results = use_many(energies, quantities, time, force)
+        for energy, quantity, result in zip(expected, quantities, results):
+            try:
+                energy.use(quantity, time, force)
+            except ValueError:
+                assert not result
+            else:
+                assert result
+        assert energies == expected
+        assert force or not all(results)
+    # used at the future
+    energy = Energy(10, 5, used=1, used_at=2000)
+    assert use_many([energy, Energy(10, 5)], time=1000) == [False, True]
+    assert energy.used == 1
+    with raises(ValueError):
+        use_many([energy], [1, 2])
+
+
+def configured_energies(max=None, recovery_interval=None, time=None):
+    energies = make_various_energies()
+    for energy in energies:
+        energy.config(max, recovery_interval, time)
+    return energies
+
+
+def test_config_many(store):
+    from energy import config_many
+    for args in [(12, None, 4), (5, None, 20), (None, 2, 4), (8, 4, 6)]:
+        expected = configured_energies(*args)
+        energies = make_various_energies()
+        assert config_many(energies, *args) == len(energies)
+        assert energies == expected
+        array = EnergyArray.from_energies(make_various_energies())
+        assert config_many(array, *args, chunk_size=5) == len(energies)
+        assert array.to_energies() == expected
+    with raises(TypeError):
+        EnergyArray.from_energies(energies).config(max=1.5)
+    array = EnergyArray.from_energies(energies)
+    array.config(recovery_interval=timedelta(seconds=2))
+    assert array.recovery_interval == [2] * len(energies)
+    # resume from the checkpoint
+    store.put_many(enumerate(make_various_energies()))
+    reports = []
+    def report(checkpoint, done, total, rate):
+        reports.append((checkpoint, done, total))
+        assert rate > 0
+        if checkpoint == 4:
+            raise KeyboardInterrupt
+    with raises(KeyboardInterrupt):
+        config_many(store, 12, time=4, chunk_size=5, progress=report)
+    assert reports == [(4, 5, 12)]
+    assert config_many(store, 12, time=4, chunk_size=5, progress=report,
+                       checkpoint=4) == 7
+    assert reports[1:] == [(9, 5, 7), (11, 7, 7)]
+    expected = configured_energies(12, None, 4)
+    assert store.get_many(range(12)) == dict(enumerate(expected))
+    # configuring again doesn't change the energies
+    assert config_many(store, 12, time=4) == 12
+    assert store.get_many(range(12)) == dict(enumerate(expected))
+    assert store.keys() == list(range(12))
+
+
+def test_energy_view():
+    import pickle
+    from energy import EnergyView
+    energies = make_various_energies()
+    data = pack_many(energies)
+    views = EnergyView.many(data)
+    assert len(views) == len(energies)
+    for view, energy in zip(views, energies):
+        assert view.policy is energy.policy
+        assert view.used == energy.used
+        assert view.used_at == energy.used_at
+        for time in [2, 3, 7, 30]:
+            assert view.current(time) == energy.current(time)
+            assert view.debt(time) == energy.debt(time)
+            assert view.recover_in(time) == energy.recover_in(time)
+            assert view.status(time) == energy.status(time)
+        assert energy == view
+        assert view.to_energy() == energy
+        assert view.to_bytes() == energy.to_bytes()
+        assert pickle.loads(pickle.dumps(view)) == energy
+    # no copy
+    buf = bytearray(data)
+    view = EnergyView(buf, len(buf) - 42)
+    assert view.current(0) == energies[-1].current(0)
+    buf[-40:-32] = Energy(7, 0.5, used=-3).to_bytes()[2:10]
+    assert view.used == -3
+    # the cached policy follows the record
+    assert view.max == 7
+    buf[-42:] = Energy(20, 3, used=5, used_at=0).to_bytes()
+    assert view.max == 20
+    assert view.current(6) == 17
+    with raises(TypeError):
+        view.use(1, 100)
+    with raises(TypeError):
+        view.config(max=20)
+    with raises(ValueError):
+        EnergyView(b'\xff' * 42)
+
+
+def test_next_change_at():
+    energy = Energy(10, 300)
+    assert energy.next_change_at(0) is None
+    energy.use(3, 0)
+    assert energy.next_change_at(0) == 300
+    assert energy.next_change_at(300) == 600
+    assert energy.next_change_at(899) == 900
+    assert energy.next_change_at(900) is None
+    energy.use(12, 900, force=True)
+    assert energy.debt(900) == 2
+    # the presentative energy changes when the debt is paid
+    assert energy.next_change_at(900) == 900 + 300 * 3
+    assert energy.current(900 + 300 * 3 - 1) == 0
+    assert energy.current(900 + 300 * 3) == 1
+
+
+def test_memoized_energy():
+    from energy import MemoizedEnergy
+    for state in make_various_energies():
+        energy = MemoizedEnergy(state.max, state.recovery_interval,
+                                state.recovery_quantity)
+        energy.used, energy.used_at = state.used, state.used_at
+        for time in [2, 3, 4, 7, 5, 10, 14, 30, 3]:
+            assert energy.status(time) == state.status(time)
+            assert energy.current(time) == state.current(time)
+            assert energy.debt(time) == state.debt(time)
+            assert energy.recover_in(time) == state.recover_in(time)
+            assert energy.recover_fully_in(time) == \
+                state.recover_fully_in(time)
+            assert energy.next_change_at(time) == state.next_change_at(time)
+    energy = MemoizedEnergy(10, 300)
+    energy.use(3, 0)
+    assert energy.current(10) == 7
+    memo = energy._memo
+    assert energy.current(299) == 7
+    assert energy.recover_in(100) == 200
+    assert energy._memo is memo
+    assert energy.current(300) == 8
+    assert energy._memo is not memo
+    # changes invalidate the memo
+    energy.use(1, 300)
+    assert energy.current(300) == 7
+    energy.set(10, 300)
+    assert energy.current(300) == 10
+    energy.use(5, 300)
+    assert energy.status(300).max == 10
+    energy.config(max=20, time=300)
+    assert energy.status(300).max == 20
+
+
+def test_memoized_energy_future_tolerance():
+    import random
+    from energy import MemoizedEnergy
+    energy = MemoizedEnergy(12, 5, future_tolerance=2.5, used=12, used_at=65)
+    state = Energy(12, 5, future_tolerance=2.5, used=12, used_at=65)
+    assert energy.recover_in(64) == state.recover_in(64) == 5
+    assert energy.recover_in(67) == state.recover_in(67) == 3
+    assert state.next_change_at(63) == state.next_change_at(66) == 70
+    rand = random.Random(0)
+    for x in range(300):
+        used_at = rand.randint(60, 70)
+        params = dict(used=rand.randint(-3, 20), used_at=used_at,
+                      future_tolerance=rand.choice([2, 2.5, 5]))
+        energy = MemoizedEnergy(12, 5, **params)
+        state = Energy(12, 5, **params)
+        time = used_at - int(params['future_tolerance'])
+        for y in range(5):
+            time += rand.choice([0, 1, 2, 3])
+            assert energy.status(time) == state.status(time)
+            assert energy.recover_in(time) == state.recover_in(time)
+            assert energy.recover_fully_in(time) == \
+                state.recover_fully_in(time)
+            assert energy.next_change_at(time) == state.next_change_at(time)
+
+
+def test_recovery_index():
+    import random
+    from energy import RecoveryIndex
+    index = RecoveryIndex()
+    index.load = 4
+    rand = random.Random(0)
+    energies = {}
+    for x in range(500):
+        key = rand.randrange(100)
+        energy = energies.setdefault(key, Energy(10, rand.choice([5, 7])))
+        time = x
+        op = rand.random()
+        if op < 0.6:
+            try:
+                index.use(key, energy, rand.randint(1, 12), time)
+            except ValueError:
+                index.use(key, energy, 1, time, force=True)
+        elif op < 0.8:
+            index.set(key, energy, rand.randint(0, 15), time)
+        elif op < 0.9:
+            index.config(key, energy, max=rand.randint(5, 15), time=time)
+        else:
+            index.remove(key)
+            del energies[key]
+    assert len(index) == len(energies)
+    def full_at(energy):
+        recover_fully_in = energy.recover_fully_in(500)
+        if recover_fully_in is not None:
+            return 500 + recover_fully_in
+    for key, energy in energies.items():
+        assert key in index
+        indexed = index.full_at(key)
+        if indexed is not None and indexed > 500:
+            assert indexed == full_at(energy)
+        else:
+            assert full_at(energy) is None
+    for start, end in [(500, 520), (510, 600), (500, 1000), (530, 531)]:
+        expected = [key for key, energy in energies.items()
+                    if full_at(energy) is not None and
+                    start < full_at(energy) <= end]
+        keys = index.full_keys(start, end)
+        assert sorted(keys) == sorted(expected)
+        assert [index.full_at(key) for key in keys] == \
+            sorted(index.full_at(key) for key in keys)
+        assert index.count(start, end) == len(expected)
+    for time in [500, 510, 530, 600]:
+        assert index.count_full(time) == \
+            sum(energy.current(time) >= energy.max
+                for energy in energies.values())
+    assert len(index.full_keys(500)) == len(index.full_keys(500, 10 ** 9))
+    assert len(index._times) > 1
+    for time in range(0, 700, 7):
+        assert index.count(0, time) == \
+            sum(0 < full_at <= time for full_at in index._index.values())
+    assert 'unknown' not in index
+    with raises(KeyError):
+        index.full_at('unknown')
+
+
+def test_energy_snapshot(tmpdir):
+    from energy import EnergySnapshot
+    energies = make_various_energies()
+    energies.append(Energy(10, 250, future_tolerance=10, resolution=1000,
+                           used=3, used_at=1500))
+    keys = [x * 7 % 13 for x in range(len(energies))]
+    path = str(tmpdir.join('energy.snapshot'))
+    EnergySnapshot.write(path, zip(keys, energies))
+    by_key = dict(zip(keys, energies))
+    with EnergySnapshot(path) as snapshot:
+        assert len(snapshot) == len(energies)
+        assert list(snapshot.column('key')) == sorted(keys)
+        assert list(snapshot.column('used')) == \
+            [by_key[key].used for key in sorted(keys)]
+        for key, energy in snapshot.items():
+            assert energy == by_key[key]
+            assert energy.policy is by_key[key].policy
+        assert snapshot.get(keys[3]) == energies[3]
+        assert snapshot.get(100) is None
+        assert snapshot[-1] == by_key[max(keys)]
+        chunks = list(snapshot.chunks(5))
+        assert [len(array) for ks, array in chunks] == [5, 5, 3]
+        for ks, array in chunks:
+            assert array.current(3000) == \
+                [by_key[key].current(3000) for key in ks]
+            expected = EnergyArray.from_energies(by_key[key] for key in ks)
+            for name in ['used', 'used_at', 'max', 'recovery_interval',
+                         'recovery_quantity', 'future_tolerance',
+                         'resolution']:
+                values = getattr(array, name)
+                assert values == getattr(expected, name)
+                assert list(map(type, values)) == \
+                    list(map(type, getattr(expected, name)))
+        assert snapshot.offsets['key'] % 8 == 0
+    with raises(ValueError):
+        EnergySnapshot(__file__)
+
+
+def test_simulation():
+    from energysim import Simulation
+    params = dict(players=50, max=5, recovery_interval=60, seed=42,
+                  sessions_per_day=48, force_ratio=0.1)
+    simulation = Simulation(**params)
+    series = simulation.run(3 * 3600, sample_interval=1800)
+    assert len(series) == 6
+    assert sum(sample['calls'] for sample in series) > 0
+    assert sum(sample['rejections'] for sample in series) > 0
+    for sample in series:
+        assert sum(sample['distribution']) == 50
+    # reproducible
+    assert Simulation(**params).run(3 * 3600, sample_interval=1800) == series
+    # the operations replay on the energies
+    energies = [Energy(5, 60) for x in range(50)]
+    for time, player, quantity, force in \
+            Simulation(**params).operations(3 * 3600):
+        energies[player].try_use(quantity, time, force)
+    assert energies == simulation.energies.to_energies()
+
+
+def test_async_energy_store(tmpdir):
+    import asyncio
+    import threading
+    import time
+    from energy import AsyncEnergyStore
+    path = str(tmpdir.join('energy.db'))
+    sent = []
+    class Connection(SQLiteEnergyStore):
+        def get_many(self, keys):
+            sent.append(('get_many', threading.current_thread()))
+            return super(Connection, self).get_many(keys)
+        def use(self, key, quantity=1, time_=None, force=False):
+            if key == 'slow':
+                time.sleep(0.2)
+            return super(Connection, self).use(key, quantity, time_, force)
+    loop = asyncio.new_event_loop()
+    store = AsyncEnergyStore(partial(Connection, path, default=partial(
+        Energy, 10, 5)), size=2, loop=loop)
+    run = loop.run_until_complete
+    energies = dict(enumerate(make_various_energies()))
+    run(store.put_many(energies))
+    # pipelined gets are merged
+    del sent[:]
+    results = run(asyncio.gather(store.get(0), store.get(0), store.get('x'),
+                                 store.get_many([1, 2, 'x'])))
+    assert len(sent) == 1
+    assert results == [energies[0], energies[0], None,
+                       {1: energies[1], 2: energies[2]}]
+    assert results[0] is not results[1]
+    # the calls in an iteration are sent in order
+    energy = Energy(10, 5)
+    results = run(asyncio.gather(store.put('a', energy), store.use('a', 3, 0),
+                                 store.get('a'), store.use('a', 20, 0),
+                                 return_exceptions=True))
+    assert results[1] == results[2] == Energy(10, 5, used=3, used_at=0)
+    assert isinstance(results[3], ValueError)
+    assert energy.used == 0
+    # per-call timeouts
+    with raises(asyncio.TimeoutError):
+        run(store.use('slow', timeout=0.05))
+    assert run(store.use('slow', timeout=1)).used == 2
+    # the pool is bounded
+    futures = []
+    for x in range(5):
+        futures.append(store.use('slow'))
+        run(asyncio.sleep(0.01))
+    assert run(asyncio.gather(*futures))[-1].used == 7
+    assert len(store._made) == 2
+    store.close()
+    loop.close()
+    # across event loops like asyncio.run()
+    def run_in_new_loop(func, *args):
+        loop = asyncio.new_event_loop()
+        result = loop.create_future()
+        def start():
+            future = asyncio.ensure_future(func(*args))
+            future.add_done_callback(
+                lambda future: result.set_result(future.result()))
+        loop.call_soon(start)
+        try:
+            return loop.run_until_complete(result)
+        finally:
+            loop.close()
+    store = AsyncEnergyStore(partial(Connection, path))
+    with raises(RuntimeError):
+        store.get(0)
+    run_in_new_loop(store.put, 'b', Energy(10, 5))
+    assert run_in_new_loop(store.use, 'b', 4, 0).used == 4
+    assert run_in_new_loop(store.get, 'b').used == 4
+    # closing in the event loop
+    connections = list(store._made)
+    run_in_new_loop(store.aclose)
+    assert not store._made
+    import sqlite3
+    with raises(sqlite3.ProgrammingError):
+        connections[0].connection.execute('SELECT 1')